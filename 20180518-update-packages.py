@@ -1,16 +1,16 @@
 import datetime, logging, re
-from ckancrawler import Crawler
+from popstats import client
 from config import CONFIG
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('update-packages')
 
-crawler = Crawler(ckan_url=CONFIG['ckanurl'], apikey=CONFIG['apikey'])
+ckan = client.from_config(CONFIG)
 
-for package in crawler.packages(fq='organization:unhcr'):
+for package in client.packages(ckan, fq='organization:unhcr'):
     if re.match('^refugees-(originating|residing)-[a-z]{3}$', package['name']):
         logger.info("Updating %s...", package['name'])
-        crawler.ckan.call_action('package_hxl_update', package)
+        ckan.call_action('package_hxl_update', package)
     else:
         logger.warn('Skipping %s...', package['name'])
     
@@ -2,18 +2,19 @@
 Remove demographics from "originating" datasets
 Fix HXL Proxy recipe for "residing" datasets
 """
-import ckancrawler, logging, re
+import logging, re
+from popstats import client
 from config import CONFIG
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("fix-demographics")
 
-DELAY=1
-"""Delay in seconds between ops"""
+RATE=1
+"""Starting rate of API calls per second"""
 
-crawler = ckancrawler.Crawler(ckan_url=CONFIG['ckanurl'], apikey=CONFIG['apikey'], delay=DELAY)
+ckan = client.from_config(CONFIG, rate=RATE)
 
-for package in crawler.packages(fq='organization:unhcr'):
+for package in client.packages(ckan, fq='organization:unhcr'):
     m = re.match('^refugees-(originating|residing)-[a-z]{3}$', package['name'])
     if m:
         logger.info("Updating %s...", package['name'])
@@ -23,7 +24,7 @@ for package in crawler.packages(fq='organization:unhcr'):
             if 'demographics' in url:
                 if loc == 'originating':
                     try:
-                        crawler.ckan.call_action('resource_delete', resource)
+                        ckan.call_action('resource_delete', resource)
                         logger.info('Deleted %s', url)
                     except Exception as e:
                         logger.exception(e)
@@ -35,7 +36,7 @@ for package in crawler.packages(fq='organization:unhcr'):
                         url += '&filter02=rename&rename-oldtag02=country%2Borigin&rename-newtag02=loc%2Bname'
                     resource['url'] = url
                     try:
-                        crawler.ckan.call_action('resource_update', resource)
+                        ckan.call_action('resource_update', resource)
                         logger.info('Updated %s', url)
                     except Exception as e:
                         logger.exception(e)
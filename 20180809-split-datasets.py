@@ -1,120 +1,39 @@
 """2018-07-04 patch for UNHCR PopStats datasets
 Put each resource into its own dataset
 """
-import ckancrawler, copy, logging, re, pprint
+import copy, functools, logging, re, pprint
+from popstats import client, executor, journal, shards, snapshot
+from popstats.registry import SPECS
 from config import CONFIG
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("fix-demographics")
 
-DEFAULT_DELAY = 1
+DEFAULT_RATE = 4
+DEFAULT_WORKERS = 8
+OPERATION = 'split-datasets'
 
-SPECS = [
-    {
-        "stub_pattern": r"unhcr_time_series_residence_([a-z]{3}).csv",
-        "title": "Time-series data for UNHCR's populations of concern residing in {country_name}",
-        "name": "unhcr-time-series-residing-{country_code}",
-        "notes": "information about UNHCR's populations of concern for a given year and country of residence. Data is presented as a yearly time series across the page.",
-        "caveats": "In the data for the most-recent year, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['asylum-seekers', 'hxl', 'idps', 'migration', 'refugee', 'refugees', 'returnees', 'stateless'],
-        "url": "http://popstats.unhcr.org/en/time_series",
-        "subnational": False,
-        "start_date": "01/01/1951",
-    },
-    {
-        "stub_pattern": r"unhcr_demographics_residence_([a-z]{3}).csv",
-        "title": "Demographics for UNHCR's populations of concern residing in {country_name}",
-        "name": "unhcr-demographics-residing-{country_code}",
-        "notes": "Information about persons of concern broken down by sex and age, as well as by location within the country of residence (where such information is available). Such data is available since 2000.",
-        "caveats": "Note that data broken down in this way is not always available, so it may not be possible to reconcile the figures on this page with those on the Persons of Concern and Time Series pages. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['hxl', 'migration', 'refugee', 'refugees', 'sadd'],
-        "url": "http://popstats.unhcr.org/en/demographics",
-        "subnational": True,
-        "start_date": "01/01/2005",
-    },
-    {
-        "stub_pattern": r"unhcr_asylum_seekers_residence_([a-z]{3}).csv",
-        "title": "Refugee status determinations for asylum seekers in {country_name}",
-        "name": "unhcr-asylum-seekers-determination-{country_code}",
-        "notes": "Information about asylum applications in a given year and the progress of asylum-seekers through the refugee status determination process.",
-        "caveats": "Data is available from 2000. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['asylum-seekers', 'hxl', 'migration'],
-        "url": "http://popstats.unhcr.org/en/asylum_seekers",
-        "subnational": False,
-        "start_date": "01/01/2000",
-    },
-    {
-        "stub_pattern": r"unhcr_asylum_seekers_monthly_residence_([a-z]{3}).csv",
-        "title": "Monthly data on asylum seekers residing in {country_name}",
-        "name": "unhcr-asylum-seekers-residing-{country_code}",
-        "notes": "Information about asylum applications lodged in 38 European and 6 non-European countries. Data are broken down by month and origin. Where possible, figures exclude repeat/re-opened asylum applications and applications lodged on appeal or with courts. For some countries, the monthly data are available since 1999 while for others at a later period.",
-        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Due to retroactive adjustments implemented by States, totals in this dataset may differ from annual totals published by the competent national authorities. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['asylum-seekers', 'hxl', 'migration', 'refugee', 'refugees'],
-        "url": "http://popstats.unhcr.org/en/asylum_seekers_monthly",
-        "subnational": False,
-        "start_date": "01/01/1999",
-    },
-    {
-        "stub_pattern": r"unhcr_resettlement_residence_([a-z]{3}).csv",
-        "title": "Resettlement arrivals of refugees in {country_name}",
-        "name": "unhcr-resettlement-residing-{country_code}",
-        "notes": "This page presents information on resettlement arrivals of refugees, with or without UNHCR assistance. This dataset is based on Government statistics and, in principle, excludes humanitarian admissions.",
-        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['hxl', 'migration', 'refugee', 'refugees', 'resettlement'],
-        "url": "http://popstats.unhcr.org/en/resettlement",
-        "subnational": False,
-        "start_date": "01/01/1959",
-    },
-    {
-        "stub_pattern": r"unhcr_time_series_origin_([a-z]{3}).csv",
-        "title": "Time-series data for UNHCR's populations of concern originating from {country_name}",
-        "name": "unhcr-time-series-originating-{country_code}",
-        "notes": "information about UNHCR's populations of concern for a given year and country of origin. Data is presented as a yearly time series across the page.",
-        "caveats": "In the data for the most-recent year, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['asylum-seekers', 'hxl', 'idps', 'migration', 'refugee', 'refugees', 'returnees', 'stateless'],
-        "url": "http://popstats.unhcr.org/en/time_series",
-        "subnational": False,
-        "start_date": "01/01/1951",
-    },
-    {
-        "stub_pattern": r"unhcr_asylum_seekers_monthly_origin_([a-z]{3}).csv",
-        "title": "Monthly data on asylum seekers originating from {country_name}",
-        "name": "unhcr-asylum-seekers-originating-{country_code}",
-        "notes": "Information about asylum applications lodged in 38 European and 6 non-European countries. Data are broken down by month and origin. Where possible, figures exclude repeat/re-opened asylum applications and applications lodged on appeal or with courts. For some countries, the monthly data are available since 1999 while for others at a later period.",
-        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Due to retroactive adjustments implemented by States, totals in this dataset may differ from annual totals published by the competent national authorities. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['asylum-seekers', 'hxl', 'migration', 'refugee', 'refugees'],
-        "url": "http://popstats.unhcr.org/en/asylum_seekers_monthly",
-        "subnational": False,
-        "start_date": "01/01/1999",
-    },
-    {
-        "stub_pattern": r"unhcr_resettlement_origin_([a-z]{3}).csv",
-        "title": "Resettlement arrivals of refugees originating from {country_name}",
-        "name": "unhcr-resettlement-originating-{country_code}",
-        "notes": "This page presents information on resettlement arrivals of refugees, with or without UNHCR assistance. This dataset is based on Government statistics and, in principle, excludes humanitarian admissions.",
-        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
-        "tags": ['hxl', 'migration', 'refugee', 'refugees', 'resettlement'],
-        "url": "http://popstats.unhcr.org/en/resettlement",
-        "subnational": False,
-        "start_date": "01/01/1959",
-    },
-]
+def crawl_unhcr_packages(config, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, snapshot_path=None, journal_path=None, shard=None):
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    checkpoints = journal.open_journal(journal_path)
+    packages = snapshot.open_packages(ckan, ['refugees-residing', 'refugees-originating'], snapshot_path, shard=shard)
+    return executor.PatchExecutor(workers, journal=checkpoints, operation=OPERATION).run(
+        packages, functools.partial(split_package, ckan, checkpoints=checkpoints)
+    )
 
-def crawl_unhcr_packages(ckanurl, apikey, delay=1):
-    crawler = ckancrawler.Crawler(ckan_url=ckanurl, apikey=apikey, delay=delay)
-    for package in crawler.packages(fq='organization:unhcr'):
-        m = re.match('^refugees-(originating|residing)-([a-z]{3})$', package['name'])
-        if m:
-            logger.info("Splitting {}".format(package['name']))
-            situation = m.group(1)
-            country_code = m.group(2)
-            m = re.match(r'^UNHCR\'s populations of concern (?:originating from|residing in) (.+)$', package['title'])
-            country_name = m.group(1)
-            split_popstats_package(crawler.ckan, package, situation, country_name, country_code)
-        else:
-            logger.warn('Skipping %s...', package['name'])
+def split_package(ckan, package, checkpoints=None):
+    m = re.match('^refugees-(originating|residing)-([a-z]{3})$', package['name'])
+    if m:
+        logger.info("Splitting {}".format(package['name']))
+        situation = m.group(1)
+        country_code = m.group(2)
+        m = re.match(r'^UNHCR\'s populations of concern (?:originating from|residing in) (.+)$', package['title'])
+        country_name = m.group(1)
+        split_popstats_package(ckan, package, situation, country_name, country_code, checkpoints)
+    else:
+        logger.warn('Skipping %s...', package['name'])
 
-def split_popstats_package(ckan, package, situation, country_name, country_code):
+def split_popstats_package(ckan, package, situation, country_name, country_code, checkpoints=None):
     resources = copy.deepcopy(package['resources'])
     for resource in resources:
         for spec in SPECS:
@@ -151,8 +70,14 @@ def split_popstats_package(ckan, package, situation, country_name, country_code)
                 #pprint.pprint(new_package)
                 #exit()
 
-                logger.info("    Creating dataset " + new_package['name'])
-                ckan.call_action('package_create', new_package)
+                if checkpoints is not None and checkpoints.done(name, OPERATION):
+                    # created by an earlier, interrupted run
+                    logger.info("    Dataset %s already created", name)
+                else:
+                    logger.info("    Creating dataset " + new_package['name'])
+                    ckan.call_action('package_create', new_package)
+                    if checkpoints is not None:
+                        checkpoints.record(name, OPERATION)
 
                 for i, old_resource in enumerate(package['resources']):
                     if old_resource['id'] == resource['id']:
@@ -181,4 +106,6 @@ def split_popstats_package(ckan, package, situation, country_name, country_code)
     ckan.call_action('package_update', package)
 
 if __name__ == '__main__':
-    crawl_unhcr_packages(CONFIG['ckanurl'], CONFIG['apikey'], DEFAULT_DELAY);
+    args = shards.argument_parser(__doc__).parse_args()
+    config = shards.shard_config(CONFIG, args.shard)
+    shards.finish(args, crawl_unhcr_packages(config, DEFAULT_RATE, DEFAULT_WORKERS, config.get('snapshot'), config.get('journal'), args.shard))
@@ -1,30 +1,37 @@
 """2018-12-05 patch for UNHCR PopStats datasets
 Put each resource into its own dataset
 """
-import ckancrawler, copy, logging, re, pprint
+import copy, functools, logging, re, pprint
+from popstats import client, executor, journal, shards, snapshot, writes
 from config import CONFIG
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("update")
 
-DEFAULT_DELAY = 1
+DEFAULT_RATE = 4
+DEFAULT_WORKERS = 8
+OPERATION = 'update-concern'
 
-def crawl_unhcr_packages(ckanurl, apikey, delay=1):
-    crawler = ckancrawler.Crawler(ckan_url=ckanurl, apikey=apikey, delay=delay)
-    for package in crawler.packages(fq='organization:unhcr'):
-        m = re.match('^refugees-(originating|residing)-([a-z]{3})$', package['name'])
-        if m:
-            logger.info('Updating %s...', package['name'])
-            notes = "Year-by-year data about UNHCR's populations of concern {context} {country}. Populations of concern include refugees, asylum seekers, internally-displaced people (IDPs), returned IDPs, returned refugees, stateless people, and others of concern.".format(
-                context="residing in" if m.group(1) == "residing" else "originating from",
-                country=package['groups'][0]['display_name']
-            )
-            print(notes)
-            package['notes'] = notes
-            result = crawler.ckan.call_action('package_update', package)
-        else:
-            logger.warn('Skipping %s...', package['name'])
+def update_package(ckan, package):
+    m = re.match('^refugees-(originating|residing)-([a-z]{3})$', package['name'])
+    if m:
+        logger.info('Updating %s...', package['name'])
+        notes = "Year-by-year data about UNHCR's populations of concern {context} {country}. Populations of concern include refugees, asylum seekers, internally-displaced people (IDPs), returned IDPs, returned refugees, stateless people, and others of concern.".format(
+            context="residing in" if m.group(1) == "residing" else "originating from",
+            country=package['groups'][0]['display_name']
+        )
+        print(notes)
+        writes.patch_package(ckan, package, {'notes': notes})
+    else:
+        logger.warn('Skipping %s...', package['name'])
+
+def crawl_unhcr_packages(config, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, snapshot_path=None, journal_path=None, shard=None):
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    packages = snapshot.open_packages(ckan, ['refugees-residing', 'refugees-originating'], snapshot_path, shard=shard)
+    return executor.PatchExecutor(workers, journal=journal.open_journal(journal_path), operation=OPERATION).run(packages, functools.partial(update_package, ckan))
 
 
 if __name__ == '__main__':
-    crawl_unhcr_packages(CONFIG['ckanurl'], CONFIG['apikey'], DEFAULT_DELAY);
+    args = shards.argument_parser(__doc__).parse_args()
+    config = shards.shard_config(CONFIG, args.shard)
+    shards.finish(args, crawl_unhcr_packages(config, DEFAULT_RATE, DEFAULT_WORKERS, config.get('snapshot'), config.get('journal'), args.shard))
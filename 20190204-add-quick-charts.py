@@ -1,102 +1,48 @@
 """2019-02-04 enable Quick Charts for UNHCR datasets"""
 
-import ckanapi, ckancrawler, copy, logging, re
+import functools, logging
+from popstats import client, executor, journal, quickcharts, registry, shards, snapshot
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("add-quickcharts")
 """Python logging object"""
 
-DEFAULT_DELAY = 1
-"""Default delay between API calls, in seconds"""
+DEFAULT_RATE = 4
+"""Default global limit on API calls per second"""
 
-PATTERNS = [
-    r"(refugees-residing)-([a-z]{3})",
-    r"(refugees-originating)-([a-z]{3})",
-    r"unhcr-(time-series-residing)-([a-z]{3})",
-    r"unhcr-(time-series-originating)-([a-z]{3})",
-    r"unhcr-(demographics-residing)-([a-z]{3})",
-    r"unhcr-(asylum-seekers-determination)-([a-z]{3})",
-    r"unhcr-(asylum-seekers-residing)-([a-z]{3})",
-    r"unhcr-(asylum-seekers-originating)-([a-z]{3})",
-    r"unhcr-(resettlement-residing)-([a-z]{3})",
-    r"unhcr-(resettlement-originating)-([a-z]{3})",
-]
-"""Regular expressions to match dataset shortnames.
-First group is the type, and second is the ISO3 country code
-"""
+DEFAULT_WORKERS = 8
+"""Default number of worker threads"""
 
-MODEL_QUICKCHARTS = [
-    ["refugees-residing", "refugees-residing-jor"],
-    ["refugees-originating", "refugees-originating-mmr"],
-    ["time-series-residing", "unhcr-time-series-residing-syr"],
-    ["time-series-originating", "unhcr-time-series-originating-mli"],
-    ["demographics-residing", "unhcr-demographics-residing-nga"],
-    ["asylum-seekers-determination", "unhcr-asylum-seekers-determination-dnk"],
-    ["asylum-seekers-residing", "unhcr-asylum-seekers-residing-ita"],
-    ["asylum-seekers-originating", "unhcr-asylum-seekers-originating-afg"],
-    ["resettlement-residing", "unhcr-resettlement-residing-can"],
-    ["resettlement-originating", "unhcr-resettlement-originating-syr"],
-]
-"""Datasets containing model Quick Charts configurations to copy to others of the same type"""
+OPERATION = "add-quickcharts"
+"""Operation name for the checkpoint journal"""
 
-quickcharts_configurations = {}
+MODEL_CACHE = "quickcharts-models.json"
+"""On-disk cache of the model Quick Charts configurations"""
+
+models = quickcharts.Models(MODEL_CACHE)
 """Quick Charts configuration strings, keyed by dataset type (to be loaded)"""
 
+view_index = None
+"""Known Quick Charts views, keyed by resource id (from a snapshot, if any)"""
+
 def load_models(ckan):
     """Load model Quick Charts configurations
-    Populates quickcharts_configurations
+    Refreshes the on-disk cache only for models that have changed.
     @param ckan: the CKAN API access object
     """
-    for entry in MODEL_QUICKCHARTS:
-        package = ckan.action.package_show(id=entry[1])
-        resource_id = package["resources"][0]["id"]
-        views = ckan.action.resource_view_list(id=resource_id)
-        for view in views:
-            # Find the Quick Charts view
-            if view["view_type"] == "hdx_hxl_preview":
-                quickcharts_configurations[entry[0]] = view["hxl_preview_config"]
-                logger.info("Loaded Quick Charts configuration for %s from %s", entry[0], entry[1])
-                break
-        if entry[0] not in quickcharts_configurations:
-            # Oops! Couldn't find config.
-            raise Exception("Failed to load model configuration for {}".format(entry[0]))
+    models.load(ckan)
 
 def add_quickcharts(ckan, package, dataset_type, iso3):
     """Add Quick Charts to a dataset after a match.
     Invoked by try_patterns()
+    Skips the package and view writes when they already match the model.
     @param ckan: the CKAN API access object
     @param package: the CKAN package (dataset) structure
     @param dataset_type: a string identifying the dataset type (e.g. "refugees-originating")
     @param iso3: the ISO3 code for the country
     """
-
     logger.info("Adding Quick Charts to %s", package["name"])
-
-    # Set up the package to preview
-    package["dataset_preview"] = "first_resource",
-    package["has_quickcharts"] = True
-    ckan.call_action("package_update", package)
-
-    # Set the Quick Charts configuration
-    resource_id = package["resources"][0]["id"]
-    views = ckan.action.resource_view_list(id=resource_id)
-    for view in views:
-        # Find the Quick Charts view and set the configuration
-        if view["view_type"] == "hdx_hxl_preview":
-            view["hxl_preview_config"] = quickcharts_configurations[dataset_type]
-            ckan.call_action("resource_view_update", view)
-            return
-
-    # If we get to here, then we need to add the view
-    logger.warn("Missing Quick Charts view for %s (creating)", package["name"])
-    view = {
-        "description": "",
-        "title": "Quick Charts",
-        "resource_id": resource_id,
-        "view_type": "hdx_hxl_preview",
-        "hxl_preview_config": quickcharts_configurations[dataset_type],
-    }
-    ckan.call_action("resource_view_create", view)
+    quickcharts.add_quickcharts(ckan, package, dataset_type, iso3, models, view_index)
 
 def try_patterns(ckan, package):
     """Match a dataset short name against all known patterns.
@@ -106,28 +52,44 @@ def try_patterns(ckan, package):
     @param ckan: the CKAN API access object
     @param package: the CKAN package (dataset) structure
     """
-    for pattern in PATTERNS:
-        result = re.fullmatch(pattern, package["name"])
-        if result:
-            add_quickcharts(ckan, package, result.group(1), result.group(2))
-            return
+    result = registry.parse_name(package["name"])
+    if result:
+        add_quickcharts(ckan, package, result[0], result[1])
+        return
     logger.warning("Skipping %s", package["name"])
     
-def scan_datasets(ckanurl, apikey, delay=1):
+def scan_datasets(config, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, snapshot_path=None, journal_path=None, shard=None):
     """Add Quick Charts to matching datasets
     This is the main external entry point.
-    @param ckanurl: the URL of the CKAN installation
-    @param apikey: the key for CKAN API access
-    @param delay: the delay in seconds between API calls
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent)
+    @param rate: the starting rate of API calls per second
+    @param workers: the number of packages to process in parallel
+    @param snapshot_path: a local snapshot file to sync and read packages from, or None to crawl
+    @param journal_path: a checkpoint journal file for resuming interrupted runs, or None
+    @param shard: an optional popstats.shards.Shard, to process only that part of the catalogue
+    @returns: the (succeeded, failed) package counts
     """
-    crawler = ckancrawler.Crawler(ckan_url=ckanurl, apikey=apikey, delay=delay)
-    load_models(crawler.ckan)
-    for package in crawler.packages(fq="organization:unhcr"): # scan only UNHCR datasets
-        try_patterns(crawler.ckan, package)
+    global view_index
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    load_models(ckan)
+    store = None
+    if snapshot_path:
+        store = snapshot.Snapshot(snapshot_path)
+        store.sync(ckan, views=True)
+        view_index = store.view_index(quickcharts.VIEW_TYPE)
+        packages = shards.stored(store, shard)
+    else:
+        packages = shards.crawl(ckan, shard) # scan only known UNHCR dataset types
+    result = executor.PatchExecutor(workers, journal=journal.open_journal(journal_path), operation=OPERATION).run(packages, functools.partial(try_patterns, ckan))
+    if store is not None:
+        store.put_view_index(view_index) # the views we wrote, which the next sync wouldn't see
+    return result
 
 #
 # Invoke as a command-line script using the info in config.py
 #
 if __name__ == '__main__':
     from config import CONFIG
-    scan_datasets(CONFIG['ckanurl'], CONFIG['apikey'], DEFAULT_DELAY);
+    args = shards.argument_parser(__doc__).parse_args()
+    config = shards.shard_config(CONFIG, args.shard)
+    shards.finish(args, scan_datasets(config, DEFAULT_RATE, DEFAULT_WORKERS, config.get('snapshot'), config.get('journal'), args.shard))
@@ -2,30 +2,21 @@
 All resources must have url_type="api" and resource_type="api"
 """
 
-import ckanapi, ckancrawler, copy, logging, re
+import functools, logging
+from popstats import client, executor, journal, registry, shards, snapshot, writes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("fix-resource-metadata")
 """Python logging object"""
 
-DEFAULT_DELAY = 0
-"""Default delay between API calls, in seconds"""
+DEFAULT_RATE = 10
+"""Default global limit on API calls per second"""
 
-PATTERNS = [
-    r"(refugees-residing)-([a-z]{3})",
-    r"(refugees-originating)-([a-z]{3})",
-    r"unhcr-(time-series-residing)-([a-z]{3})",
-    r"unhcr-(time-series-originating)-([a-z]{3})",
-    r"unhcr-(demographics-residing)-([a-z]{3})",
-    r"unhcr-(asylum-seekers-determination)-([a-z]{3})",
-    r"unhcr-(asylum-seekers-residing)-([a-z]{3})",
-    r"unhcr-(asylum-seekers-originating)-([a-z]{3})",
-    r"unhcr-(resettlement-residing)-([a-z]{3})",
-    r"unhcr-(resettlement-originating)-([a-z]{3})",
-]
-"""Regular expressions to match dataset shortnames.
-First group is the type, and second is the ISO3 country code
-"""
+DEFAULT_WORKERS = 8
+"""Default number of worker threads"""
+
+OPERATION = "fix-resource-metadata"
+"""Operation name for the checkpoint journal"""
 
 def update_resource_metadata(ckan, package):
     """Match a dataset short name against all known patterns.
@@ -35,32 +26,33 @@ def update_resource_metadata(ckan, package):
     @param ckan: the CKAN API access object
     @param package: the CKAN package (dataset) structure
     """
-    for pattern in PATTERNS:
-        result = re.fullmatch(pattern, package["name"])
-        if result:
-            logger.info("Updating %s", package["name"])
-            for resource in package["resources"]:
-                if resource["url_type"] != "api" or resource["resource_type"] != "api":
-                    resource["url_type"] = "api"
-                    resource["resource_type"] = "api"
-                    ckan.call_action("resource_update", resource)
-            return
+    if registry.parse_name(package["name"]):
+        logger.info("Updating %s", package["name"])
+        for resource in package["resources"]:
+            writes.patch_resource(ckan, resource, {"url_type": "api", "resource_type": "api"})
+        return
     logger.warning("Skipping %s", package["name"])
     
-def scan_datasets(ckanurl, apikey, delay=1):
+def scan_datasets(config, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, snapshot_path=None, journal_path=None, shard=None):
     """Update resource metadata in matching datasets.
     This is the main external entry point.
-    @param ckanurl: the URL of the CKAN installation
-    @param apikey: the key for CKAN API access
-    @param delay: the delay in seconds between API calls
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent)
+    @param rate: the starting rate of API calls per second
+    @param workers: the number of packages to process in parallel
+    @param snapshot_path: a local snapshot file to sync and read packages from, or None to crawl
+    @param journal_path: a checkpoint journal file for resuming interrupted runs, or None
+    @param shard: an optional popstats.shards.Shard, to process only that part of the catalogue
+    @returns: the (succeeded, failed) package counts
     """
-    crawler = ckancrawler.Crawler(ckan_url=ckanurl, apikey=apikey, delay=delay)
-    for package in crawler.packages(fq="organization:unhcr"): # scan only UNHCR datasets
-        update_resource_metadata(crawler.ckan, package)
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    packages = snapshot.open_packages(ckan, None, snapshot_path, shard=shard) # scan only known UNHCR dataset types
+    return executor.PatchExecutor(workers, journal=journal.open_journal(journal_path), operation=OPERATION).run(packages, functools.partial(update_resource_metadata, ckan))
 
 #
 # Invoke as a command-line script using the info in config.py
 #
 if __name__ == '__main__':
     from config import CONFIG
-    scan_datasets(CONFIG['ckanurl'], CONFIG['apikey'], DEFAULT_DELAY);
+    args = shards.argument_parser(__doc__).parse_args()
+    config = shards.shard_config(CONFIG, args.shard)
+    shards.finish(args, scan_datasets(config, DEFAULT_RATE, DEFAULT_WORKERS, config.get('snapshot'), config.get('journal'), args.shard))
@@ -2,16 +2,24 @@
 Add new caveats as requested by UNHCR.
 """
 
-import ckancrawler, logging, re
+import functools, logging
+from popstats import client, executor, journal, registry, shards, snapshot, writes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("fix caveats")
 """Python logging object"""
 
-DEFAULT_DELAY = 0
-"""Default delay between API calls, in seconds"""
+DEFAULT_RATE = 10
+"""Default global limit on API calls per second"""
 
-NEW_CAVEATS = """Data is available from 2000. In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Due to retroactive adjustments implemented by States, totals in this dataset may differ from annual totals published by the competent national authorities. Dataset may be empty if the UNHCR dataset does not currently contain any matching records."""
+DEFAULT_WORKERS = 8
+"""Default number of worker threads"""
+
+OPERATION = "fix-caveats"
+"""Operation name for the checkpoint journal"""
+
+NEW_CAVEATS = registry.PATCHED_FIELDS["asylum-seekers-determination"]["caveats"]
+"""New caveats requested by UNHCR (kept with the other dataset specs in popstats.registry)"""
 
 def update_resource_metadata(ckan, package):
     """Match a dataset short name against all known patterns.
@@ -21,26 +29,33 @@ def update_resource_metadata(ckan, package):
     @param ckan: the CKAN API access object
     @param package: the CKAN package (dataset) structure
     """
-    result = re.fullmatch(r"unhcr-(asylum-seekers-determination)-([a-z]{3})", package["name"])
-    if result:
+    result = registry.parse_name(package["name"])
+    if result and result[0] == "asylum-seekers-determination":
         logger.info("Updating %s", package["name"])
-        package["caveats"] = NEW_CAVEATS
-        ckan.call_action("package_update", package)
+        writes.patch_package(ckan, package, {"caveats": NEW_CAVEATS})
 
-def scan_datasets(ckanurl, apikey, delay=1):
+def scan_datasets(config, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, snapshot_path=None, journal_path=None, shard=None):
     """Update resource metadata in matching datasets.
     This is the main external entry point.
-    @param ckanurl: the URL of the CKAN installation
-    @param apikey: the key for CKAN API access
-    @param delay: the delay in seconds between API calls
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent)
+    @param rate: the starting rate of API calls per second
+    @param workers: the number of packages to process in parallel
+    @param snapshot_path: a local snapshot file to sync and read packages from, or None to crawl
+    @param journal_path: a checkpoint journal file for resuming interrupted runs, or None
+    @param shard: an optional popstats.shards.Shard, to process only that part of the catalogue
+    @returns: the (succeeded, failed) package counts
     """
-    crawler = ckancrawler.Crawler(ckan_url=ckanurl, apikey=apikey, delay=delay)
-    for package in crawler.packages(fq="organization:unhcr"): # scan only UNHCR datasets
-        update_resource_metadata(crawler.ckan, package)
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    packages = snapshot.open_packages(
+        ckan, ["asylum-seekers-determination"], snapshot_path, fl=["id", "name", "extras_caveats"], shard=shard
+    ) # fetch only the datasets and fields we might change
+    return executor.PatchExecutor(workers, journal=journal.open_journal(journal_path), operation=OPERATION).run(packages, functools.partial(update_resource_metadata, ckan))
 
 #
 # Invoke as a command-line script using the info in config.py
 #
 if __name__ == '__main__':
     from config import CONFIG
-    scan_datasets(CONFIG['ckanurl'], CONFIG['apikey'], DEFAULT_DELAY);
+    args = shards.argument_parser(__doc__).parse_args()
+    config = shards.shard_config(CONFIG, args.shard)
+    shards.finish(args, scan_datasets(config, DEFAULT_RATE, DEFAULT_WORKERS, config.get('snapshot'), config.get('journal'), args.shard))
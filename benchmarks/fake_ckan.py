@@ -0,0 +1,427 @@
+"""A local fake CKAN server for benchmarking the maintenance scripts.
+
+Implements the parts of the CKAN action API that the scripts use, over
+an in-memory catalogue of synthetic UNHCR datasets shaped like
+sample.json: one dataset per known type (see popstats.registry) and
+country in the input tables, about 2,000 in all, with resources built
+from the input tables and Quick Charts views on most of them.
+
+Latency, random server errors and 429 throttling (with Retry-After) can
+be injected, to see how the scripts behave against a slow or overloaded
+server.  Every call is counted by action.
+
+Usage: python3 benchmarks/fake_ckan.py [--port N] [--latency SECONDS] [--error-rate P] [--throttle-rate P]
+"""
+
+import argparse, ast, copy, datetime, gzip, http.server, json, logging, os, random, re, sys, threading, uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from popstats import inputs, quickcharts, registry, tables
+
+logger = logging.getLogger("fake-ckan")
+"""Python logging object"""
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+"""The repository root"""
+
+SAMPLE_PATH = os.path.join(ROOT, "sample.json")
+"""The sample package used as the template for every synthetic package (a Python literal)"""
+
+PARENT_TYPES = {"refugees-residing": "residence", "refugees-originating": "origin"}
+"""Parent dataset types, and their category in the input tables"""
+
+DEFAULT_SEED = 1
+"""Default random seed, so that catalogues and injected failures are repeatable"""
+
+STALE_VIEW_RATE = 0.2
+"""Share of synthetic Quick Charts views with an out-of-date configuration"""
+
+MISSING_VIEW_RATE = 0.05
+"""Share of synthetic resources with no Quick Charts view"""
+
+
+def now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+class NotFound(Exception):
+    pass
+
+
+class ValidationError(Exception):
+    pass
+
+
+class Catalogue(object):
+    """In-memory CKAN packages and resource views."""
+
+    def __init__(self):
+        self.packages = {} # id -> package
+        self.ids_by_name = {}
+        self.views = {} # resource id -> list of views
+        self.lock = threading.RLock()
+
+    def seed(self, split=True, seed=DEFAULT_SEED):
+        """Build the synthetic UNHCR catalogue.
+        @param split: if False, leave out the split dataset types, as before the 2018-08-09 split
+        @param seed: the random seed
+        """
+        rng = random.Random(seed)
+        with open(SAMPLE_PATH, "r", encoding="utf-8") as input:
+            template = ast.literal_eval(input.read())
+        countries, datasets, resources_by_category = tables.load(cache_path=None, inputs_dir=os.path.join(ROOT, "Inputs"), offline=True)
+        datasets_by_category = {dataset.category: dataset for dataset in datasets}
+        model_config = json.dumps({"charts": [{"title": "Model chart"}]})
+        models = dict(quickcharts.MODEL_QUICKCHARTS)
+
+        for dataset_type in registry.TYPES.values():
+            if not split and dataset_type.spec is not None:
+                continue
+            for country in countries:
+                package = copy.deepcopy(template)
+                category = PARENT_TYPES.get(dataset_type.name)
+                if category is not None:
+                    rendered = inputs.render_package(country, datasets_by_category[category], resources_by_category[category], "benchmark")
+                    package.update({key: rendered[key] for key in ("title", "notes", "caveats", "methodology", "license_id")})
+                    resources = rendered["resources"]
+                else:
+                    spec = dataset_type.spec
+                    package.update({
+                        "title": spec["title"].format(country_name=country.full_name),
+                        "notes": spec["notes"],
+                        "caveats": spec["caveats"],
+                    })
+                    resources = [{"name": dataset_type.dataset_name(country.code) + ".csv", "url": "http://example.org/{}.csv".format(country.stub_code), "format": "CSV"}]
+                package.update({
+                    "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                    "name": dataset_type.dataset_name(country.code),
+                    "groups": [{"name": country.stub_code, "id": country.stub_code, "display_name": country.name}],
+                    "organization": dict(template["organization"], name=registry.ORGANIZATION),
+                    "metadata_modified": now(),
+                })
+                base_resource = template["resources"][0]
+                package["resources"] = [
+                    dict(base_resource, id=str(uuid.UUID(int=rng.getrandbits(128))), package_id=package["id"], position=i, url_type=None, resource_type=None, **resource)
+                    for i, resource in enumerate(resources)
+                ]
+                package["num_resources"] = len(package["resources"])
+                self.put(package)
+
+                # Quick Charts views
+                resource_id = package["resources"][0]["id"]
+                roll = rng.random()
+                if models.get(dataset_type.name) == package["name"] or roll >= MISSING_VIEW_RATE:
+                    config = model_config if models.get(dataset_type.name) == package["name"] or roll >= STALE_VIEW_RATE else json.dumps({"charts": []})
+                    self.views[resource_id] = [{
+                        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                        "resource_id": resource_id,
+                        "view_type": quickcharts.VIEW_TYPE,
+                        "title": "Quick Charts",
+                        "description": "",
+                        "hxl_preview_config": config,
+                    }]
+        logger.info("Seeded %d packages", len(self.packages))
+        return self
+
+    def put(self, package):
+        self.packages[package["id"]] = package
+        self.ids_by_name[package["name"]] = package["id"]
+
+    def get(self, id_or_name):
+        package = self.packages.get(id_or_name) or self.packages.get(self.ids_by_name.get(id_or_name))
+        if package is None or package.get("state") == "deleted":
+            raise NotFound("Package {} not found".format(id_or_name))
+        return package
+
+    def find_resource(self, resource_id):
+        for package in self.packages.values():
+            for resource in package["resources"]:
+                if resource["id"] == resource_id:
+                    return package, resource
+        raise NotFound("Resource {} not found".format(resource_id))
+
+    def _touch(self, package):
+        package["metadata_modified"] = now()
+        package["num_resources"] = len(package["resources"])
+        for i, resource in enumerate(package["resources"]):
+            resource.setdefault("id", str(uuid.uuid4()))
+            resource["package_id"] = package["id"]
+            resource["position"] = i
+
+    #
+    # Actions
+    #
+
+    def package_search(self, params):
+        matches = parse_fq(params.get("fq"))
+        rows = int(params.get("rows", 10))
+        start = int(params.get("start", 0))
+        results = sorted(
+            (package for package in self.packages.values() if package.get("state") != "deleted" and matches(package)),
+            key=lambda package: package["id"]
+        )
+        page = results[start:start + rows]
+        fl = params.get("fl")
+        if fl:
+            fields = fl if isinstance(fl, list) else fl.split(",")
+            page = [{field: package.get(field[7:] if field.startswith("extras_") else field) for field in fields} for package in page]
+        return {"count": len(results), "results": copy.deepcopy(page)}
+
+    def package_show(self, params):
+        return copy.deepcopy(self.get(params["id"]))
+
+    def package_list(self, params):
+        return sorted(package["name"] for package in self.packages.values() if package.get("state") != "deleted")
+
+    def package_create(self, params):
+        if params.get("name") in self.ids_by_name and self.packages[self.ids_by_name[params["name"]]].get("state") != "deleted":
+            raise ValidationError({"name": ["That URL is already in use."]})
+        package = copy.deepcopy(params)
+        package["id"] = str(uuid.uuid4())
+        package.setdefault("resources", [])
+        package["state"] = "active"
+        package["organization"] = {"name": package.get("owner_org")}
+        self._touch(package)
+        self.put(package)
+        return copy.deepcopy(package)
+
+    def package_update(self, params):
+        old = self.get(params.get("id") or params["name"])
+        package = copy.deepcopy(params)
+        package["id"] = old["id"]
+        self._touch(package)
+        self.put(package)
+        return copy.deepcopy(package)
+
+    def package_patch(self, params):
+        package = self.get(params["id"])
+        package.update({key: copy.deepcopy(value) for key, value in params.items() if key != "id"})
+        self._touch(package)
+        return copy.deepcopy(package)
+
+    def package_delete(self, params):
+        self.get(params["id"])["state"] = "deleted"
+
+    def resource_create(self, params):
+        package = self.get(params["package_id"])
+        resource = copy.deepcopy(params)
+        resource["id"] = str(uuid.uuid4())
+        package["resources"].append(resource)
+        self._touch(package)
+        return copy.deepcopy(resource)
+
+    def resource_update(self, params):
+        package, resource = self.find_resource(params["id"])
+        resource.clear()
+        resource.update(copy.deepcopy(params))
+        self._touch(package)
+        return copy.deepcopy(resource)
+
+    def resource_patch(self, params):
+        package, resource = self.find_resource(params["id"])
+        resource.update(copy.deepcopy(params))
+        self._touch(package)
+        return copy.deepcopy(resource)
+
+    def resource_delete(self, params):
+        package, resource = self.find_resource(params["id"])
+        package["resources"].remove(resource)
+        self.views.pop(resource["id"], None)
+        self._touch(package)
+
+    def resource_view_list(self, params):
+        self.find_resource(params["id"])
+        return copy.deepcopy(self.views.get(params["id"], []))
+
+    def resource_view_create(self, params):
+        self.find_resource(params["resource_id"])
+        view = dict(copy.deepcopy(params), id=str(uuid.uuid4()))
+        self.views.setdefault(params["resource_id"], []).append(view)
+        return copy.deepcopy(view)
+
+    def resource_view_update(self, params):
+        for view in self.views.get(params.get("resource_id"), []):
+            if view["id"] == params["id"]:
+                view.update(copy.deepcopy(params))
+                return copy.deepcopy(view)
+        raise NotFound("View {} not found".format(params["id"]))
+
+    ACTIONS = (
+        "package_search", "package_show", "package_list", "package_create", "package_update", "package_patch",
+        "package_delete", "resource_create", "resource_update", "resource_patch", "resource_delete",
+        "resource_view_list", "resource_view_create", "resource_view_update",
+    )
+
+    def call(self, action, params):
+        if action not in self.ACTIONS:
+            raise NotFound("Action {} not found".format(action))
+        with self.lock:
+            return getattr(self, action)(params)
+
+
+def _term_pattern(term):
+    """Convert one Solr query term (quoted, wildcard or plain) to a regular expression."""
+    if term.startswith('"') and term.endswith('"'):
+        return re.escape(term[1:-1])
+    parts = re.split(r"(\\.|\*)", term)
+    return "".join(".*" if part == "*" else re.escape(part[1:] if part.startswith("\\") else part) for part in parts)
+
+
+def parse_fq(fq):
+    """Compile the subset of Solr filter queries that the scripts send into a test function.
+    Supports field:term, field:(term OR term ...), field:[low TO high] and AND.
+    """
+    if not fq:
+        return lambda package: True
+    tests = []
+    for clause in re.split(r"\s+AND\s+", fq.strip()):
+        field, value = clause.split(":", 1)
+        if value.startswith("["):
+            low, high = value[1:-1].split(" TO ")
+            low = None if low == "*" else low.rstrip("Z")
+            high = None if high == "*" else high.rstrip("Z")
+            tests.append(lambda package, field=field, low=low, high=high: (
+                (low is None or str(package.get(field)) >= low) and (high is None or str(package.get(field)) <= high)
+            ))
+            continue
+        terms = value[1:-1].split(" OR ") if value.startswith("(") else [value]
+        regex = re.compile("^(?:{})$".format("|".join(_term_pattern(term.strip()) for term in terms)))
+        if field == "organization":
+            tests.append(lambda package, regex=regex: bool(regex.match((package.get("organization") or {}).get("name") or "")))
+        else:
+            tests.append(lambda package, field=field, regex=regex: bool(regex.match(str(package.get(field)))))
+    return lambda package: all(test(package) for test in tests)
+
+
+class FakeCKANServer(http.server.ThreadingHTTPServer):
+    """Threaded HTTP server for a Catalogue, with fault injection."""
+
+    daemon_threads = True
+
+    def __init__(self, address, catalogue, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=DEFAULT_SEED):
+        """
+        @param address: the (host, port) to listen on (port 0 for any free port)
+        @param catalogue: the Catalogue to serve
+        @param latency: the mean added latency per call in seconds (exponentially distributed)
+        @param error_rate: the share of calls that fail with a 500
+        @param throttle_rate: the share of calls that are refused with a 429
+        @param retry_after: the Retry-After value (seconds) sent with each 429
+        @param seed: the random seed for injected latency and failures
+        """
+        super().__init__(address, FakeCKANHandler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def count(self, key):
+        with self.counts_lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def reset_counts(self):
+        with self.counts_lock:
+            self.counts = {}
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class FakeCKANHandler(http.server.BaseHTTPRequestHandler):
+    """Handler for /api/action/<name> (and /api/3/action/<name>) requests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_json(self, status, body, headers={}):
+        data = json.dumps(body).encode("utf-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data, 1)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_action(self, params):
+        server = self.server
+        m = re.match(r"^/api/(?:3/)?action/([a-z_]+)", self.path)
+        if m is None:
+            return self.send_json(404, {"success": False, "error": {"__type": "Not Found Error", "message": "Not found"}})
+        action = m.group(1)
+        with server.counts_lock:
+            roll = server.random.random()
+            delay = server.random.expovariate(1.0 / server.latency) if server.latency else 0
+        if delay:
+            threading.Event().wait(delay)
+        if roll < server.throttle_rate:
+            server.count("429")
+            return self.send_json(429, {"success": False, "error": {"message": "Too many requests"}}, {"Retry-After": str(server.retry_after)})
+        if roll < server.throttle_rate + server.error_rate:
+            server.count("500")
+            return self.send_json(500, {"success": False, "error": {"message": "Internal server error"}})
+        server.count(action)
+        try:
+            result = server.catalogue.call(action, params)
+        except NotFound as e:
+            return self.send_json(404, {"success": False, "error": {"__type": "Not Found Error", "message": str(e)}})
+        except ValidationError as e:
+            return self.send_json(409, {"success": False, "error": dict(e.args[0], __type="Validation Error")})
+        except (KeyError, TypeError, ValueError) as e:
+            return self.send_json(409, {"success": False, "error": {"__type": "Validation Error", "message": repr(e)}})
+        self.send_json(200, {"success": True, "result": result})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            params = json.loads(body.decode("utf-8")) if body else {}
+        except ValueError:
+            return self.send_json(400, {"success": False, "error": {"message": "Bad JSON"}})
+        self.handle_action(params)
+
+    def do_GET(self):
+        if self.path == "/_counts":
+            return self.send_json(200, self.server.counts)
+        from urllib.parse import parse_qsl, urlparse
+        self.handle_action(dict(parse_qsl(urlparse(self.path).query)))
+
+
+def serve(port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, split=True, seed=DEFAULT_SEED):
+    """Seed a catalogue and start a server for it in a background thread.
+    @returns: the running FakeCKANServer (see its url property)
+    """
+    catalogue = Catalogue().seed(split=split, seed=seed)
+    return FakeCKANServer(("127.0.0.1", port), catalogue, latency, error_rate, throttle_rate, seed=seed).start()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run a fake CKAN server with a synthetic UNHCR catalogue.")
+    parser.add_argument("--port", type=int, default=5000, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean added latency per call, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls that fail with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of calls refused with a 429")
+    parser.add_argument("--no-split", action="store_true", help="leave out the split datasets (as before 2018-08-09)")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.error_rate, args.throttle_rate, split=not args.no_split)
+    logger.info("Serving on %s", server.url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
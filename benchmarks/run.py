@@ -0,0 +1,128 @@
+"""Benchmark the maintenance scripts against the local fake CKAN server.
+
+Each script's entry point (scan_datasets or crawl_unhcr_packages) runs
+against a freshly seeded fake catalogue, with popstats.instrument
+switched on, and the runner reports packages per second and API calls
+per package.  Nothing touches data.humdata.org.
+
+Usage: python3 benchmarks/run.py [--latency SECONDS] [--error-rate P] [--throttle-rate P] [--rate N] [--max-rate N] [--workers N] [--json FILE] [SCRIPT ...]
+"""
+
+import argparse, importlib.util, json, logging, os, sys, tempfile, time, types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import fake_ckan
+from popstats import instrument
+
+logger = logging.getLogger("benchmark")
+"""Python logging object"""
+
+SCRIPTS = (
+    ("20190204-add-quick-charts.py", {}),
+    ("20190829-fix-metadata.py", {}),
+    ("20191009-fix-caveats.py", {}),
+    ("20181205-update-concern.py", {}),
+    ("20180809-split-datasets.py", {"split": False}),
+)
+"""The scripts to benchmark, with the options for seeding their catalogue"""
+
+DEFAULT_MAX_RATE = 1000
+"""Default ceiling for the adaptive rate, high enough that the fake server's latency is what limits throughput"""
+
+ENTRY_POINTS = ("scan_datasets", "crawl_unhcr_packages")
+"""Names of the script entry points, which take (config, rate, workers, snapshot_path, journal_path)"""
+
+
+def load_script(filename, config):
+    """Import a hyphenated script file as a module.
+    The scripts read config.CONFIG, so a config module pointing at the
+    fake server is installed first.
+    """
+    config_module = types.ModuleType("config")
+    config_module.CONFIG = config
+    sys.modules["config"] = config_module
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace("-", "_"), os.path.join(fake_ckan.ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_script(filename, seed_options, latency=0.0, error_rate=0.0, throttle_rate=0.0, rate=None, workers=None, max_rate=DEFAULT_MAX_RATE):
+    """Benchmark one script against a freshly seeded fake server.
+    @returns: a dict of measurements
+    """
+    server = fake_ckan.serve(latency=latency, error_rate=error_rate, throttle_rate=throttle_rate, **seed_options)
+    config = {"ckanurl": server.url, "apikey": "benchmark", "user_agent": "popstats-benchmark", "max_rate": max_rate}
+    try:
+        module = load_script(filename, config)
+        entry = next(getattr(module, name) for name in ENTRY_POINTS if hasattr(module, name))
+        recorder = instrument.recorder = instrument.Recorder()
+        start = time.monotonic()
+        failure = None
+        try:
+            entry(config, rate if rate is not None else module.DEFAULT_RATE, workers or module.DEFAULT_WORKERS, None, None)
+        except Exception as e:
+            # e.g. an injected error outside the per-package isolation; report it with the partial figures
+            logger.exception("%s stopped early", filename)
+            failure = "{}: {}".format(type(e).__name__, e)
+        seconds = time.monotonic() - start
+    finally:
+        instrument.recorder = None
+        server.shutdown()
+        server.server_close()
+
+    summary = recorder.summary()
+    packages = summary["packages"]["count"]
+    calls = sum(action["count"] for action in summary["actions"].values())
+    return {
+        "script": filename,
+        "packages": packages,
+        "seconds": round(seconds, 3),
+        "packages_per_second": round(packages / seconds, 2) if seconds else None,
+        "calls": calls,
+        "calls_per_package": round(calls / packages, 2) if packages else None,
+        "retries": sum(action["retries"] for action in summary["actions"].values()),
+        "errors": sum(action["errors"] for action in summary["actions"].values()),
+        "mean_concurrency": summary["mean_concurrency"],
+        "server_counts": dict(server.counts),
+        "actions": {name: action["count"] for name, action in summary["actions"].items()},
+        "failure": failure,
+    }
+
+
+def print_results(results, output=None):
+    print("{:32} {:>8} {:>9} {:>10} {:>8} {:>10} {:>8} {:>7}".format(
+        "script", "packages", "seconds", "pkg/sec", "calls", "calls/pkg", "retries", "errors"), file=output)
+    for result in results:
+        print("{script:32} {packages:>8} {seconds:>9.1f} {packages_per_second:>10} {calls:>8} {calls_per_package:>10} {retries:>8} {errors:>7}".format(**result), file=output)
+        if result["failure"]:
+            print("    stopped early: " + result["failure"][:200], file=output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the maintenance scripts against a fake CKAN server.")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean added latency per call, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls that fail with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of calls refused with a 429")
+    parser.add_argument("--rate", type=float, help="starting API calls per second (default: each script's own)")
+    parser.add_argument("--max-rate", type=float, default=DEFAULT_MAX_RATE, help="ceiling for the adaptive rate")
+    parser.add_argument("--workers", type=int, help="worker threads (default: each script's own)")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    parser.add_argument("scripts", nargs="*", help="scripts to run (default: all)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir) # caches written by the scripts (e.g. quickcharts-models.json) stay out of the tree
+        for filename, seed_options in SCRIPTS:
+            if args.scripts and filename not in args.scripts:
+                continue
+            logger.warning("Running %s", filename)
+            results.append(run_script(filename, seed_options, args.latency, args.error_rate, args.throttle_rate, args.rate, args.workers, args.max_rate))
+        os.chdir(fake_ckan.ROOT)
+    print_results(results)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
@@ -0,0 +1,52 @@
+"""Delete the resources and datasets that the current layout no longer uses.
+
+Scans the UNHCR catalogue once, compares it with the desired state (see
+popstats/gc.py) and prints the orphaned and duplicate resources and the
+superseded datasets.  Nothing is deleted unless --apply is given; the
+deletions then run in parallel, batched by dataset.
+
+Usage: python3 collect-garbage.py [--apply] [--workers N] [--rate N] [--offline]
+"""
+
+import argparse, logging
+from popstats import client, executor, gc, inputs, reconcile, snapshot, tables
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("collect-garbage")
+"""Python logging object"""
+
+DEFAULT_RATE = 4
+"""Default global limit on API calls per second"""
+
+def collect_garbage(config, apply=False, rate=DEFAULT_RATE, workers=executor.DEFAULT_WORKERS, snapshot_path=None, offline=False):
+    """Find (and optionally delete) everything the desired state doesn't reference.
+    This is the main external entry point.
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent, creator)
+    @param apply: if True, delete; otherwise just print the deletions
+    @param rate: the starting rate of API calls per second
+    @param workers: the number of datasets to clean up in parallel
+    @param snapshot_path: a local snapshot file to sync and read packages from, or None to crawl
+    @param offline: if True, use the cached input tables or Inputs/ without checking the Google Sheet
+    @returns: the list of deletions
+    """
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    inputs.configure(config)
+    countries, datasets, resources_by_category = tables.load(offline=offline)
+    desired = reconcile.desired_state(countries, datasets, resources_by_category, config.get('creator'))
+    operations = gc.find_garbage(desired, snapshot.open_packages(ckan, None, snapshot_path))
+    reconcile.print_plan(operations)
+
+    if apply and operations:
+        succeeded, failed = reconcile.apply(ckan, operations, workers)
+        logger.info("Cleaned up %d datasets (%d failed)", succeeded, failed)
+    return operations
+
+if __name__ == '__main__':
+    from config import CONFIG
+    parser = argparse.ArgumentParser(description="Delete resources and datasets that the current layout no longer uses.")
+    parser.add_argument("--apply", action="store_true", help="delete (default: dry run)")
+    parser.add_argument("--workers", type=int, default=executor.DEFAULT_WORKERS, help="datasets to clean up in parallel")
+    parser.add_argument("--offline", action="store_true", help="use the cached input tables or Inputs/ without checking the Google Sheet")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="starting API calls per second (adapts to the server)")
+    args = parser.parse_args()
+    collect_garbage(CONFIG, apply=args.apply, rate=args.rate, workers=args.workers, snapshot_path=CONFIG.get('snapshot'), offline=args.offline)
@@ -0,0 +1,33 @@
+"""Split the UNHCR PopStats HXL sources into per-country CSV files locally.
+
+Streams each source once (instead of once per country through the HXL
+Proxy) and writes one file per resource, named as in the resources table
+(e.g. unhcr_time_series_residence_afg.csv).  With --parquet, also
+writes typed Parquet partitions (see popstats.columnar).
+
+Usage: python3 partition-popstats.py [--max-open N] [--offline] [--parquet DIR] OUTPUT_DIR
+"""
+
+import argparse, logging
+from popstats import partition, tables
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("partition-popstats")
+"""Python logging object"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Partition the UNHCR PopStats sources by country.")
+    parser.add_argument("--max-open", type=int, default=partition.DEFAULT_MAX_OPEN, help="maximum number of output files open at once")
+    parser.add_argument("--offline", action="store_true", help="use the cached input tables or Inputs/ without checking the Google Sheet")
+    parser.add_argument("--parquet", metavar="DIR", help="also write Parquet partitions under this directory (needs pyarrow)")
+    parser.add_argument("output_dir", help="directory for the per-country files")
+    args = parser.parse_args()
+
+    countries, datasets, resources_by_category = tables.load(offline=args.offline)
+    counts = partition.partition_all(args.output_dir, countries, resources_by_category, args.max_open)
+    logger.info("Wrote %d files", len(counts))
+
+    if args.parquet:
+        from popstats import columnar # optional: needs numpy and pyarrow
+        counts = columnar.write_all(args.parquet, countries, resources_by_category)
+        logger.info("Wrote %d Parquet partitions", len(counts))
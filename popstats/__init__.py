@@ -0,0 +1,6 @@
+"""Shared support code for the UNHCR PopStats maintenance scripts.
+
+The dated scripts in the top-level directory are one-off patches; the
+modules in this package hold the logic they have in common (CKAN access,
+concurrency, and so on).
+"""
@@ -0,0 +1,294 @@
+"""asyncio engine for crawl-and-patch runs.
+
+Most of a patch run is spent waiting on package_search pages, view
+lists and update calls.  This engine keeps many API calls in flight on
+one event loop (bounded by a semaphore and the same adaptive global
+rate limit as popstats.client), and fetches the next package_search
+page while the current page's packages are being processed.
+
+Existing per-package callbacks run unchanged: a callback with the
+try_patterns/update_resource_metadata shape, func(ckan, package), runs
+in a worker thread and gets a ckan object whose call_action() and
+action.* are forwarded to the event loop.  A coroutine function with
+the same shape is awaited directly, with no thread at all.
+
+Requires the optional aiohttp package.
+"""
+
+import asyncio, concurrent.futures, logging, time
+from popstats import client, instrument, registry
+
+logger = logging.getLogger("popstats.aio")
+"""Python logging object"""
+
+DEFAULT_CONCURRENCY = 100
+"""Default maximum number of API calls (and packages) in flight at once"""
+
+
+class AsyncClient(object):
+    """Rate-limited asyncio CKAN client.
+    Requests are built and responses decoded by ckanapi itself, so
+    results and exceptions (NotFound, ValidationError, ...) are the
+    same as for ckanapi.RemoteCKAN.
+    """
+
+    def __init__(self, ckanurl, apikey=None, user_agent=None, rate=client.DEFAULT_RATE, max_rate=client.DEFAULT_MAX_RATE, retries=client.DEFAULT_RETRIES, concurrency=DEFAULT_CONCURRENCY):
+        """
+        @param ckanurl: the URL of the CKAN installation
+        @param apikey: the key for CKAN API access
+        @param user_agent: the HTTP user agent, if needed for access
+        @param rate: the starting number of calls per second (None to start at max_rate)
+        @param max_rate: the ceiling for the adaptive rate
+        @param retries: the number of times to retry a throttled or timed-out call
+        @param concurrency: the maximum number of calls in flight at once
+        """
+        self.ckanurl = ckanurl.rstrip("/")
+        self.apikey = apikey
+        self.user_agent = user_agent
+        self.limiter = client.AdaptiveRateLimiter(rate, max_rate=max_rate)
+        self.retries = retries
+        self.concurrency = concurrency
+        self.session = None
+        self._semaphore = None
+
+    async def open(self):
+        import aiohttp
+        from popstats import session
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=session.DEFAULT_CONNECT_TIMEOUT, sock_read=session.DEFAULT_READ_TIMEOUT),
+            headers={"Accept-Encoding": "gzip, deflate"},
+        )
+        self._timeout_errors = (asyncio.TimeoutError, aiohttp.ClientConnectionError)
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def call_action(self, action, data_dict=None):
+        """Call a CKAN action under the semaphore and rate limit, retrying as popstats.client does.
+        @param action: the name of the CKAN action (e.g. "package_show")
+        @param data_dict: the parameters for the action
+        @returns: the action result
+        """
+        from ckanapi.common import prepare_action, reverse_apicontroller_action
+        path, data, headers = prepare_action(action, data_dict, self.apikey)
+        if self.user_agent:
+            headers["User-Agent"] = self.user_agent
+        url = self.ckanurl + "/" + path
+        start = time.monotonic()
+        attempt = 0
+        sent = received = 0
+        waited = 0.0
+        error = None
+        try:
+            while True:
+                wait = self.limiter.reserve()
+                waited += wait
+                await asyncio.sleep(wait)
+                sent_at = time.monotonic()
+                try:
+                    async with self._semaphore:
+                        async with self.session.post(url, data=data, headers=headers) as response:
+                            status = response.status
+                            retry_after = response.headers.get("Retry-After")
+                            body = await response.text()
+                            length = response.headers.get("Content-Length")
+                        sent += len(data or b"")
+                        # as received, before gzip decoding, where the server says
+                        received += int(length) if length and length.isdigit() else len(body.encode("utf-8"))
+                except self._timeout_errors as e:
+                    timeout_error = e
+                    reason, retryable, delay = "timeout", client.is_retryable(action), None
+                else:
+                    if status not in client.THROTTLE_STATUSES:
+                        self.limiter.success()
+                        return reverse_apicontroller_action(url, status, body)
+                    reason, retryable, delay = "HTTP {}".format(status), client.is_retryable(action, status), client.parse_retry_after(retry_after)
+                self.limiter.backoff(delay, sent_at)
+                if not retryable or attempt >= self.retries:
+                    if reason == "timeout":
+                        raise timeout_error
+                    return reverse_apicontroller_action(url, status, body) # raises the ckanapi error
+                backoff = client.backoff_delay(attempt)
+                attempt += 1
+                logger.warning("%s for %s; retry %d of %d in %.1f seconds", reason, action, attempt, self.retries, max(backoff, delay or 0))
+                await asyncio.sleep(backoff)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            instrument.record_action(action, start, time.monotonic() - start, sent, received, attempt, error, waited)
+
+
+class SyncBridge(object):
+    """Blocking CKAN access object for callbacks running in worker threads.
+    Has the same call_action() and action.* interface as popstats.client.Client,
+    but forwards every call to an AsyncClient on the event loop.
+    """
+
+    def __init__(self, async_client, loop):
+        self.async_client = async_client
+        self.loop = loop
+        self.action = client.ActionShortcut(self)
+
+    def call_action(self, action, data_dict=None):
+        future = asyncio.run_coroutine_threadsafe(self.async_client.call_action(action, data_dict), self.loop)
+        return future.result()
+
+
+async def packages(async_client, q=None, fq=None, rows=client.DEFAULT_ROWS, fl=None):
+    """Stream packages from package_search, prefetching the next page.
+    Same results and paging as popstats.client.packages().
+    @param async_client: the AsyncClient
+    @param q: the search query, if any
+    @param fq: the filter query, if any
+    @param rows: the number of packages to request per page
+    @param fl: a list of the only fields to return for each package, if any
+    """
+    params = {"rows": rows, "sort": "id asc"}
+    if q is not None:
+        params["q"] = q
+    if fq is not None:
+        params["fq"] = fq
+    if fl is not None:
+        params["fl"] = list(fl)
+    start = 0
+    next_page = asyncio.ensure_future(async_client.call_action("package_search", dict(params, start=start)))
+    while next_page is not None:
+        result = await next_page
+        start += rows
+        if result["results"] and start < result["count"]:
+            next_page = asyncio.ensure_future(async_client.call_action("package_search", dict(params, start=start)))
+        else:
+            next_page = None
+        for package in result["results"]:
+            if fl is not None:
+                for key in [key for key in package if key.startswith("extras_")]:
+                    package.setdefault(key[7:], package[key])
+            yield package
+
+
+class AsyncPatchEngine(object):
+    """Run a per-package callback over a package stream on an event loop.
+    Counts, failure isolation and journal handling are the same as for
+    popstats.executor.PatchExecutor.
+    """
+
+    def __init__(self, async_client, concurrency=DEFAULT_CONCURRENCY, journal=None, operation=None):
+        """
+        @param async_client: an open AsyncClient
+        @param concurrency: the maximum number of packages in progress at once
+        @param journal: an optional popstats.journal.Journal for resuming runs
+        @param operation: the operation name to record in the journal
+        """
+        self.async_client = async_client
+        self.concurrency = concurrency
+        self.journal = journal
+        self.operation = operation
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self._skipped_names = []
+
+    async def run(self, packages, func):
+        """Apply func(ckan, package) to every package.
+        @param packages: an async iterable (e.g. from packages()) or an
+        ordinary iterable (e.g. from a popstats.snapshot.Snapshot) of packages
+        @param func: the callback, either a plain function (run in a worker
+        thread with a blocking ckan object) or a coroutine function (passed
+        the AsyncClient)
+        @returns: a tuple of (succeeded, failed) counts
+        """
+        loop = asyncio.get_running_loop()
+        is_async = asyncio.iscoroutinefunction(func)
+        threads = None if is_async else concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        bridge = SyncBridge(self.async_client, loop)
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def run_one(package):
+            started = time.monotonic()
+            try:
+                if is_async:
+                    await func(self.async_client, package)
+                else:
+                    await loop.run_in_executor(threads, func, bridge, package)
+            except Exception:
+                logger.exception("Failed to process %s", package.get("name"))
+                self.failed += 1
+            else:
+                if self.journal is not None:
+                    await loop.run_in_executor(threads, self.journal.record, package["name"], self.operation)
+                self.succeeded += 1
+            finally:
+                instrument.record_package(package.get("name"), started, time.monotonic() - started)
+                slots.release()
+
+        async def start(package):
+            if self.journal is not None and self.journal.done(package["name"], self.operation):
+                self.skipped += 1
+                self._skipped_names.append(package["name"])
+                instrument.record_skip("journal")
+                return
+            await slots.acquire()
+            task = asyncio.ensure_future(run_one(package))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        try:
+            if hasattr(packages, "__aiter__"):
+                async for package in packages:
+                    await start(package)
+            else:
+                for package in packages:
+                    await start(package)
+            if tasks:
+                await asyncio.wait(list(tasks))
+        finally:
+            if threads is not None:
+                threads.shutdown(wait=False)
+        logger.info(
+            "Finished: %d succeeded, %d failed, %d already done", self.succeeded, self.failed, self.skipped
+        )
+        if self.journal is not None and not self.failed:
+            self.journal.finish(self.operation, self._skipped_names)
+        return (self.succeeded, self.failed)
+
+
+def run_patch(config, func, fq=None, source=None, rate=client.DEFAULT_RATE, concurrency=DEFAULT_CONCURRENCY, journal=None, operation=None):
+    """Run a patch callback over the UNHCR packages on the asyncio engine.
+    This is the blocking entry point for scripts.
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent, and max_rate,
+    profile and trace if set, as for popstats.client.from_config())
+    @param func: the callback, func(ckan, package), e.g. update_resource_metadata
+    @param fq: the package_search filter query (ignored if source is given; default: all of the
+    known UNHCR dataset types, from popstats.registry.search_fq())
+    @param source: an iterable of packages to use instead of searching (e.g. from a snapshot)
+    @param rate: the starting rate of API calls per second
+    @param concurrency: the maximum number of calls and packages in flight at once
+    @param journal: an optional popstats.journal.Journal for resuming runs
+    @param operation: the operation name to record in the journal
+    @returns: a tuple of (succeeded, failed) counts
+    """
+    instrument.configure(config)
+    max_rate = config.get("max_rate") or client.DEFAULT_MAX_RATE
+    if fq is None:
+        fq = registry.search_fq() # never the whole of HDX
+
+    async def main():
+        async with AsyncClient(
+            config["ckanurl"], config.get("apikey"), config.get("user_agent"), rate=rate, max_rate=max_rate, concurrency=concurrency
+        ) as async_client:
+            engine = AsyncPatchEngine(async_client, concurrency, journal, operation)
+            return await engine.run(source if source is not None else packages(async_client, fq=fq), func)
+    return asyncio.run(main())
@@ -0,0 +1,185 @@
+"""Response cache for the read-only CKAN actions.
+
+The same reads repeat within and across runs: the Quick Charts models,
+resource_view_list for views read minutes earlier, packages re-read
+after a write.  popstats.client.Client looks up package_show,
+resource_view_list, package_list and package_search calls here first,
+so a hit costs no API call and no wait for the rate limit.
+
+Entries expire after a per-action time to live.  The in-memory tier is
+bounded, with least-recently-used eviction; an optional SQLite file
+keeps entries across runs.  Every entry is tagged with the package,
+resource and view ids (and package names) it contains, and any write
+this process makes through the client drops the entries that share a
+tag with the write's parameters or result, so a package is never served
+stale after we changed it.  Package searches and lists are dropped on
+any package or resource write.
+
+Entries are stored as JSON text, so callers get a fresh copy on every
+hit and can modify it freely (as popstats.writes does).
+"""
+
+import collections, json, logging, sqlite3, threading, time
+
+logger = logging.getLogger("popstats.cache")
+"""Python logging object"""
+
+DEFAULT_TTLS = {
+    "package_show": 15 * 60,
+    "resource_view_list": 15 * 60,
+    "package_search": 5 * 60,
+    "package_list": 60 * 60,
+}
+"""Seconds each cacheable action's results stay fresh"""
+
+DEFAULT_MAX_ENTRIES = 2000
+"""Default number of entries kept in memory"""
+
+SEARCH_TAG = "*search"
+"""Tag for results that list many packages (invalidated by any package or resource write)"""
+
+ID_KEYS = ("id", "name", "package_id", "resource_id")
+"""Keys whose values identify the packages, resources and views an object refers to"""
+
+READ_SUFFIXES = ("_show", "_list", "_search", "_autocomplete")
+"""Action name endings for reads, which never invalidate anything"""
+
+RECENT_INVALIDATIONS = 1000
+"""Number of recent invalidations remembered, to check reads that were in flight during them"""
+
+
+def _tags(value, tags=None):
+    """Collect the ids and names in an action's parameters or result, including nested resources and views."""
+    if tags is None:
+        tags = set()
+    if isinstance(value, dict):
+        for key in ID_KEYS:
+            if isinstance(value.get(key), str) and value[key]:
+                tags.add(value[key])
+        for item in value.get("resources") or ():
+            _tags(item, tags)
+        for item in value.get("results") or ():
+            _tags(item, tags)
+    elif isinstance(value, list):
+        for item in value:
+            _tags(item, tags)
+    return tags
+
+
+class ResponseCache(object):
+    """Thread-safe TTL/LRU cache of CKAN action results, with an optional disk tier."""
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, ttls=None):
+        """
+        @param path: an SQLite file for entries that outlive the process, or None for memory only
+        @param max_entries: the number of entries kept in memory
+        @param ttls: a dict of action name -> seconds, replacing DEFAULT_TTLS
+        """
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict() # key -> (expires, tags, text), in LRU order
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0 # bumped by every invalidation
+        self._recent = collections.deque(maxlen=RECENT_INVALIDATIONS) # (generation, tags)
+        self._lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, text TEXT);
+                CREATE TABLE IF NOT EXISTS tags (tag TEXT, key TEXT);
+                CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+            """)
+            self.db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self.db.execute("DELETE FROM tags WHERE key NOT IN (SELECT key FROM responses)")
+            self.db.commit()
+
+    def cacheable(self, action):
+        return action in self.ttls
+
+    @staticmethod
+    def key(action, data_dict):
+        return action + " " + json.dumps(data_dict or {}, sort_keys=True)
+
+    def get(self, action, data_dict):
+        """Look up a fresh result.
+        @returns: a copy of the cached result, or None on a miss
+        """
+        key = self.key(action, data_dict)
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < now:
+                del self.entries[key]
+                entry = None
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT expires, text FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] >= now:
+                    tags = set(tag for (tag,) in self.db.execute("SELECT tag FROM tags WHERE key = ?", (key,)))
+                    entry = (row[0], tags, row[1])
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            text = entry[2]
+        return json.loads(text)
+
+    def put(self, action, data_dict, result, generation=None):
+        """Store the result of a successful read.
+        @param generation: the generation when the read started; if a write
+        since then touched anything in the result, it may be stale and isn't stored
+        """
+        key = self.key(action, data_dict)
+        tags = _tags(data_dict) | _tags(result)
+        if action in ("package_search", "package_list"):
+            tags.add(SEARCH_TAG)
+        entry = (time.time() + self.ttls[action], tags, json.dumps(result))
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                if not self._recent or self._recent[0][0] > generation + 1:
+                    return # too long ago to tell
+                if any(tags & invalidated for number, invalidated in self._recent if number > generation):
+                    return
+            self._remember(key, entry)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses (key, expires, text) VALUES (?, ?, ?)", (key, entry[0], entry[2]))
+                self.db.execute("DELETE FROM tags WHERE key = ?", (key,))
+                self.db.executemany("INSERT INTO tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+                self.db.commit()
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, action, data_dict, result=None):
+        """Drop everything a write could have changed.
+        @param action: the write action (e.g. "package_patch")
+        @param data_dict: its parameters
+        @param result: its result, if it succeeded
+        """
+        if action.endswith(READ_SUFFIXES):
+            return
+        tags = _tags(data_dict) | _tags(result)
+        if action.startswith("package_") or (action.startswith("resource_") and not action.startswith("resource_view_")):
+            tags.add(SEARCH_TAG)
+        if not tags:
+            return
+        with self._lock:
+            self.generation += 1
+            self._recent.append((self.generation, tags))
+            stale = [key for key, entry in self.entries.items() if entry[1] & tags]
+            for key in stale:
+                del self.entries[key]
+            if self.db is not None:
+                marks = ",".join("?" * len(tags))
+                keys = [key for (key,) in self.db.execute("SELECT DISTINCT key FROM tags WHERE tag IN ({})".format(marks), list(tags))]
+                self.db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+                self.db.executemany("DELETE FROM tags WHERE key = ?", [(key,) for key in keys])
+                self.db.commit()
+        if stale:
+            logger.debug("%s dropped %d cached responses", action, len(stale))
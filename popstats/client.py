@@ -0,0 +1,422 @@
+"""Thread-safe, rate-limited access to the CKAN API.
+
+Wraps a ckanapi.RemoteCKAN object so that every action call, from any
+thread, draws from a single global requests-per-second budget, and
+provides a package-search pager that streams results a page at a time.
+
+The budget adapts to the server: it climbs steadily while responses are
+healthy, and halves (pausing every thread for any Retry-After period)
+on a 429, a 503/504 or a timeout, after which the call is retried with
+jittered exponential backoff.
+"""
+
+import email.utils, logging, random, threading, time
+from popstats import cache, instrument
+
+logger = logging.getLogger("popstats.client")
+"""Python logging object"""
+
+DEFAULT_RATE = 5
+"""Default starting rate of API calls per second"""
+
+DEFAULT_MAX_RATE = 20
+"""Default ceiling for the adaptive rate (calls per second)"""
+
+DEFAULT_MIN_RATE = 0.2
+"""Default floor for the adaptive rate (calls per second)"""
+
+DEFAULT_INCREASE = 0.5
+"""Default additive increase in the rate for each second of healthy responses"""
+
+DEFAULT_RETRIES = 5
+"""Default number of retries for a throttled or timed-out call"""
+
+DEFAULT_BACKOFF = 1.0
+"""Base delay in seconds for exponential backoff between retries"""
+
+MAX_BACKOFF = 60.0
+"""Longest delay in seconds between retries"""
+
+THROTTLE_STATUSES = {429, 503, 504}
+"""HTTP statuses that mean the server is overloaded (back off and retry)"""
+
+IDEMPOTENT_SUFFIXES = ("_show", "_list", "_search", "_autocomplete", "_update", "_patch", "_delete")
+"""Action name endings for calls that are safe to repeat after a timeout or 503/504.
+Anything else (e.g. package_create) is retried only after a 429, which
+the server rejected without processing.
+"""
+
+DEFAULT_ROWS = 100
+"""Default number of packages to request per package_search page"""
+
+
+class RateLimiter(object):
+    """Global requests-per-second limit shared by any number of threads.
+    Each caller reserves the next free slot on the schedule, then sleeps
+    (outside the lock) until that slot arrives.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE):
+        """
+        @param rate: the maximum number of calls per second, or None for no limit
+        """
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Reserve the next free slot without waiting for it.
+        @returns: the number of seconds until the slot arrives
+        """
+        if not self.interval:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        return slot - now
+
+    def acquire(self):
+        """Block until the caller may make its next call."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Global rate limit that adapts to the server (additive increase, multiplicative decrease).
+    Each healthy response raises the rate so that it climbs by about
+    increase calls per second every second, up to max_rate; a throttled
+    response halves it, down to min_rate.  The responses to one burst
+    of calls only halve the rate once: a throttled call that was sent
+    before the last slowdown is ignored.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE, min_rate=DEFAULT_MIN_RATE, increase=DEFAULT_INCREASE):
+        """
+        @param rate: the starting number of calls per second (None to start at max_rate)
+        @param max_rate: the ceiling for the rate
+        @param min_rate: the floor for the rate
+        @param increase: the increase in calls per second for each second of healthy responses
+        """
+        self.rate = min(rate or max_rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self._slowed = float("-inf") # when the rate was last halved
+        super().__init__(self.rate)
+
+    def success(self):
+        """Record a healthy response, and speed up."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+                self.interval = 1.0 / self.rate
+
+    def backoff(self, delay=None, sent=None):
+        """Record a throttled response, and slow down.
+        @param delay: if given, hold back every caller for this many seconds (e.g. from Retry-After)
+        @param sent: the time.monotonic() when the throttled call was sent; without
+        it, throttled responses within one interval of the last slowdown are ignored
+        """
+        with self._lock:
+            now = time.monotonic()
+            if sent is not None:
+                same_burst = sent < self._slowed
+            else:
+                same_burst = now - self._slowed < self.interval
+            if not same_burst:
+                old_interval = self.interval
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.interval = 1.0 / self.rate
+                self._slowed = now
+                # stretch the slots already reserved at the old rate to the new one
+                self._next = now + max(0.0, self._next - now) * self.interval / old_interval
+            if delay:
+                self._next = max(self._next, now + delay)
+        if not same_burst:
+            logger.warning("Backing off to %.2f calls/second", self.rate)
+
+
+class ResponseMonitor(object):
+    """requests response hook that remembers each thread's last HTTP status.
+    ckanapi reports a 429 or 503 only as a generic error with the status
+    buried in the message, and drops the headers, so the client reads
+    them from here instead.  It also counts the bytes sent and received
+    by each thread, for popstats.instrument; bytes received are counted
+    as they came over the wire, before gzip decoding.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __call__(self, response, *args, **kwargs):
+        self._local.status = response.status_code
+        self._local.retry_after = response.headers.get("Retry-After")
+        self._local.sent = getattr(self._local, "sent", 0) + len(response.request.body or b"")
+        self._local.received = getattr(self._local, "received", 0) + wire_bytes(response)
+
+    def reset(self):
+        self._local.status = None
+        self._local.retry_after = None
+
+    def last(self):
+        """@returns: a tuple of (status, Retry-After header) for this thread's last response"""
+        return (getattr(self._local, "status", None), getattr(self._local, "retry_after", None))
+
+    def take_bytes(self):
+        """@returns: a tuple of (sent, received) byte counts for this thread since the last call"""
+        counts = (getattr(self._local, "sent", 0), getattr(self._local, "received", 0))
+        self._local.sent = self._local.received = 0
+        return counts
+
+
+def wire_bytes(response):
+    """Count the bytes of a requests response body as received, before any gzip decoding.
+    Falls back to Content-Length, then to the decoded size, if the raw stream can't say.
+    """
+    content = response.content # reads the whole body, so the raw stream has been consumed
+    tell = getattr(response.raw, "tell", None)
+    if tell is not None:
+        try:
+            return tell()
+        except Exception:
+            pass
+    try:
+        return int(response.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return len(content)
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def is_retryable(action, status=None):
+    """Test whether a failed call is safe to retry.
+    @param action: the name of the CKAN action
+    @param status: the HTTP status of the failed response, or None for a timeout
+    """
+    return status == 429 or action.endswith(IDEMPOTENT_SUFFIXES)
+
+
+def backoff_delay(attempt):
+    """Jittered exponential backoff ("full jitter") before a retry.
+    @param attempt: the number of retries already made
+    @returns: the delay in seconds
+    """
+    return random.uniform(0, min(MAX_BACKOFF, DEFAULT_BACKOFF * 2 ** attempt))
+
+
+class ActionShortcut(object):
+    """Allow client.action.package_show(id=...) as with ckanapi."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        def action(**kwargs):
+            return self._client.call_action(name, kwargs)
+        return action
+
+
+class Client(object):
+    """CKAN API access object with an adaptive global rate limit and retries.
+    Has the same call_action() and action.* interface as ckanapi.RemoteCKAN,
+    so it can be passed anywhere the scripts used to pass crawler.ckan.
+    """
+
+    def __init__(self, ckan, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE, retries=DEFAULT_RETRIES, monitor=None, timeout_errors=(), cache=None):
+        """
+        @param ckan: the underlying ckanapi.RemoteCKAN object
+        @param rate: the starting number of calls per second (None to start at max_rate)
+        @param max_rate: the ceiling for the adaptive rate
+        @param retries: the number of times to retry a throttled or timed-out call
+        @param monitor: the ResponseMonitor hooked into the HTTP session, if any
+        @param timeout_errors: a tuple of exception classes that mean a timeout or dropped connection
+        @param cache: an optional popstats.cache.ResponseCache for read-only actions
+        """
+        self.ckan = ckan
+        self.limiter = AdaptiveRateLimiter(rate, max_rate=max_rate)
+        self.retries = retries
+        self.monitor = monitor
+        self.timeout_errors = tuple(timeout_errors)
+        self.cache = cache
+        self.action = ActionShortcut(self)
+
+    def call_action(self, action, data_dict=None, **kwargs):
+        """Call a CKAN action, waiting for a slot under the rate limit first.
+        Read-only actions are answered from the cache if possible, and
+        writes drop any cached results they affect.
+        Throttled calls (and timed-out idempotent calls) are retried with
+        jittered exponential backoff, honouring any Retry-After header.
+        @param action: the name of the CKAN action (e.g. "package_show")
+        @param data_dict: the parameters for the action
+        @returns: the action result
+        """
+        if self.cache is None:
+            return self._call_action(action, data_dict, **kwargs)
+        if self.cache.cacheable(action) and not kwargs:
+            result = self.cache.get(action, data_dict)
+            if result is not None:
+                instrument.record_cache_hit(action)
+                return result
+            generation = self.cache.generation
+            result = self._call_action(action, data_dict)
+            self.cache.put(action, data_dict, result, generation)
+            return result
+        result = None
+        try:
+            result = self._call_action(action, data_dict, **kwargs)
+            return result
+        finally:
+            # even a failed write may have changed something
+            self.cache.invalidate(action, data_dict, result)
+
+    def _call_action(self, action, data_dict=None, **kwargs):
+        start = time.monotonic()
+        attempt = 0
+        waited = 0.0
+        error = None
+        try:
+            while True:
+                wait = self.limiter.reserve()
+                if wait > 0:
+                    time.sleep(wait)
+                    waited += wait
+                if self.monitor is not None:
+                    self.monitor.reset()
+                sent_at = time.monotonic()
+                try:
+                    result = self.ckan.call_action(action, data_dict, **kwargs)
+                except Exception as e:
+                    status, retry_after = self.monitor.last() if self.monitor is not None else (None, None)
+                    if isinstance(e, self.timeout_errors):
+                        reason = "timeout"
+                        retryable = is_retryable(action)
+                    elif status in THROTTLE_STATUSES:
+                        reason = "HTTP {}".format(status)
+                        retryable = is_retryable(action, status)
+                    else:
+                        # an ordinary error response: the server is healthy
+                        self.limiter.success()
+                        raise
+                    delay = parse_retry_after(retry_after)
+                    self.limiter.backoff(delay, sent_at)
+                    if not retryable or attempt >= self.retries:
+                        raise
+                    backoff = backoff_delay(attempt)
+                    attempt += 1
+                    logger.warning("%s for %s; retry %d of %d in %.1f seconds", reason, action, attempt, self.retries, max(backoff, delay or 0))
+                    # any Retry-After delay is enforced by the limiter, for every thread
+                    time.sleep(backoff)
+                else:
+                    self.limiter.success()
+                    return result
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if instrument.recorder is not None:
+                sent, received = self.monitor.take_bytes() if self.monitor is not None else (0, 0)
+                instrument.record_action(action, start, time.monotonic() - start, sent, received, attempt, error, waited)
+
+
+def connect(ckanurl, apikey, rate=DEFAULT_RATE, user_agent=None, max_rate=DEFAULT_MAX_RATE, retries=DEFAULT_RETRIES, workers=None, cache=None):
+    """Create a rate-limited Client for a CKAN installation.
+    All calls go through one pooled keep-alive session (see popstats.session).
+    @param ckanurl: the URL of the CKAN installation
+    @param apikey: the key for CKAN API access
+    @param rate: the starting number of calls per second (None to start at max_rate)
+    @param user_agent: the HTTP user agent, if needed for access
+    @param max_rate: the ceiling for the adaptive rate
+    @param retries: the number of times to retry a throttled or timed-out call
+    @param workers: the number of threads that will share the client, to size the connection pool
+    @param cache: an optional popstats.cache.ResponseCache for read-only actions
+    """
+    import ckanapi, requests
+    from popstats import session
+    monitor = ResponseMonitor()
+    http = session.make_session(
+        pool_size=max(session.DEFAULT_POOL_SIZE, (workers or 0) + 1), # +1 for the main thread's package_search pager
+        hooks=[monitor],
+    )
+    return Client(
+        ckanapi.RemoteCKAN(ckanurl, apikey=apikey, user_agent=user_agent, session=http),
+        rate=rate,
+        max_rate=max_rate,
+        retries=retries,
+        monitor=monitor,
+        timeout_errors=(requests.exceptions.Timeout, requests.exceptions.ConnectionError),
+        cache=cache,
+    )
+
+
+def from_config(config, rate=DEFAULT_RATE, workers=None, **kwargs):
+    """Create a Client from the settings in config.py.
+    This is the one place the scripts get their CKAN access object from,
+    so it also turns on popstats.instrument if config.py asks for it.
+    @param config: the CONFIG dict (uses ckanurl, apikey, user_agent, and
+    max_rate if set, to raise or lower the ceiling for the adaptive rate;
+    cache turns on the read cache: True to cache in memory, or an SQLite file to keep read
+    results across runs; there is no cache unless it is set)
+    @param rate: the starting number of calls per second
+    @param workers: the number of threads that will share the client
+    @param kwargs: any other parameters for connect()
+    """
+    instrument.configure(config)
+    defaults = {
+        'max_rate': config.get('max_rate') or DEFAULT_MAX_RATE,
+        'cache': cache.ResponseCache(None if config['cache'] is True else config['cache']) if config.get('cache') else None,
+    }
+    return connect(
+        config['ckanurl'],
+        config.get('apikey'),
+        rate=rate,
+        user_agent=config.get('user_agent'),
+        workers=workers,
+        **dict(defaults, **kwargs)
+    )
+
+
+def packages(ckan, q=None, fq=None, rows=DEFAULT_ROWS, fl=None):
+    """Stream packages from package_search, one page at a time.
+    Results are sorted by id so that paging stays stable while other
+    threads are updating (and so re-sorting) the packages already returned.
+    @param ckan: the CKAN API access object
+    @param q: the search query, if any
+    @param fq: the filter query, if any (e.g. "organization:unhcr")
+    @param rows: the number of packages to request per page
+    @param fl: a list of the only fields to return for each package, if any
+    (default: full package structures); extra fields such as "caveats" are
+    indexed as "extras_caveats", and are returned under both names
+    """
+    params = {"rows": rows, "sort": "id asc"}
+    if q is not None:
+        params["q"] = q
+    if fq is not None:
+        params["fq"] = fq
+    if fl is not None:
+        params["fl"] = list(fl)
+    start = 0
+    while True:
+        result = ckan.call_action("package_search", dict(params, start=start))
+        for package in result["results"]:
+            if fl is not None:
+                for key in [key for key in package if key.startswith("extras_")]:
+                    package.setdefault(key[7:], package[key])
+            yield package
+        start += rows
+        if not result["results"] or start >= result["count"]:
+            break
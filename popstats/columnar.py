@@ -0,0 +1,219 @@
+"""Columnar Parquet partitions of the UNHCR PopStats sources.
+
+The same per-country partitions as popstats.partition, written as
+compressed Parquet files with typed columns, so that heavy consumers
+don't re-parse CSV on every read.  Columns are named by their HXL
+tagspec (e.g. "#affected+refugees"), with the text header kept in the
+column metadata; years and counts are integers (null where the value is
+blank or suppressed), each count column gets a boolean column alongside
+it that is true where UNHCR suppressed the figure (e.g.
+"#affected+refugees+suppressed"), other columns are dictionary-encoded
+strings, and each country column gets an ISO3 code column alongside it
+(e.g. "#country+residence+code").  The sources are parsed by
+popstats.loader, one chunk at a time.
+
+The layout is hive-style, one file per partition:
+
+    ROOT/source=time_series/category=residence/iso3=AFG/data.parquet
+
+so a single partition can be read directly with read_partition()
+(memory-mapped, loading only the columns asked for), or all of one
+source's partitions opened with open_dataset() for filtering on
+category and iso3.  The sources have different columns, so each one is
+a separate dataset.
+"""
+
+import logging, os
+import numpy
+import pyarrow, pyarrow.dataset, pyarrow.parquet
+from popstats import loader, partition
+
+logger = logging.getLogger("popstats.columnar")
+"""Python logging object"""
+
+PATH_TEMPLATE = os.path.join("source={source}", "category={category}", "iso3={iso3}", "data.parquet")
+"""Partition path under the root directory"""
+
+COMPRESSION = "zstd"
+"""Parquet compression codec"""
+
+COUNT_PATTERNS = ("#affected",)
+"""HXL tag patterns for the count columns, which get a +suppressed column"""
+
+
+def partition_path(root, source, category, iso3):
+    """Get the path of one Parquet partition.
+    @param root: the root directory of the partitions
+    @param source: the source key (see popstats.partition.source_key())
+    @param category: "residence" or "origin"
+    @param iso3: the ISO3 country code
+    """
+    return os.path.join(root, PATH_TEMPLATE.format(source=source, category=category, iso3=iso3.upper()))
+
+
+def integer_arrays(column):
+    """Convert a typed column from popstats.loader to Arrow arrays.
+    @param column: a popstats.loader.IntegerColumn
+    @returns: a tuple of (int64 array, null where the value is blank, suppressed or not a number;
+    boolean array, True where the value is suppressed)
+    """
+    values = pyarrow.array(column.values, mask=~column.valid, type=pyarrow.int64())
+    return values, pyarrow.array(column.suppressed, type=pyarrow.bool_())
+
+
+def country_indices(values, countries_by_name):
+    """Map an array of UNHCR country names to indices in the countries list (-1 if unknown)."""
+    names, inverse = numpy.unique(values, return_inverse=True)
+    lookup = numpy.array([countries_by_name.get(partition.normalise_string(name), -1) for name in names], dtype=int)
+    return lookup[inverse]
+
+
+def build_table(text_headers, hashtags, chunk, renames, countries, countries_by_name):
+    """Build the typed table for a chunk of a source, as seen through one route's hashtag renames.
+    @param chunk: a popstats.loader.Chunk with every column of the source
+    @returns: a pyarrow.Table
+    """
+    codes = pyarrow.array([country.code for country in countries] + [None]).dictionary_encode()
+    fields, arrays, used = [], [], set()
+
+    def add(name, array, title):
+        # HXL allows repeated tagspecs; Parquet column names need to be unique
+        unique_name, n = name, 1
+        while unique_name in used:
+            n += 1
+            unique_name = "{}_{}".format(name, n)
+        used.add(unique_name)
+        fields.append(pyarrow.field(unique_name, array.type, metadata={"title": title or ""}))
+        arrays.append(array)
+
+    for i, tagspec in enumerate(hashtags):
+        column = chunk.columns[i]
+        for old, new in renames:
+            if tagspec and partition.pattern_matches(old, tagspec):
+                tagspec = new
+                break
+        name = partition.display_tagspec(tagspec) or "column{}".format(i + 1)
+        title = text_headers[i] if text_headers is not None and i < len(text_headers) else None
+        if isinstance(column, loader.IntegerColumn):
+            values, suppressed = integer_arrays(column)
+            add(name, values, title)
+            if any(partition.pattern_matches(pattern, tagspec) for pattern in COUNT_PATTERNS):
+                # tells a suppressed figure (1-4) apart from a blank one, which are both null
+                add(name + "+suppressed", suppressed, None)
+        else:
+            add(name, pyarrow.array(column, type=pyarrow.string()).dictionary_encode(), title)
+            if tagspec and partition.parse_tagspec(tagspec)[0] == "#country":
+                # typed ISO3 code alongside each country name column (null if not in the countries table)
+                indices = country_indices(column, countries_by_name)
+                indices[indices < 0] = len(countries)
+                add(name + "+code", codes.take(pyarrow.array(indices, type=pyarrow.int64())), None)
+    return pyarrow.Table.from_arrays(arrays, schema=pyarrow.schema(fields))
+
+
+def empty_chunk(reader):
+    """Make a Chunk with no rows, for the schema of empty partitions.
+    @param reader: an open popstats.loader.TypedReader
+    """
+    empty = numpy.array([], dtype=str)
+    return loader.Chunk(0, 0, {
+        i: reader.to_integers(empty) if i in reader.integers else empty for i in reader.wanted
+    })
+
+
+def write_source(root, source_url, source, routes, countries, chunk_rows=loader.CHUNK_ROWS):
+    """Stream one source and write its Parquet partitions for every route and country.
+    Each chunk of the source adds a row group to the partitions it has
+    rows for, so memory stays flat however large the source is.
+    Countries with no matching rows get an empty partition with the same schema.
+    @param root: the root directory of the partitions
+    @param source_url: the source URL (for the partition key)
+    @param source: the source URL or local file to read
+    @param routes: the popstats.partition.Route objects for the source
+    @param countries: a list of popstats.inputs.Country records
+    @param chunk_rows: the number of rows per chunk (see popstats.loader.CHUNK_ROWS)
+    @returns: a dict of output path -> number of rows
+    """
+    logger.info("Writing Parquet partitions for %s", source)
+    countries_by_name = {partition.normalise_string(country.unhcr_name): n for n, country in enumerate(countries)}
+    key = partition.source_key(source_url)
+    counts = {}
+    writers = {}
+    try:
+        with loader.TypedReader(source, chunk_rows=chunk_rows) as reader:
+            hashtags = reader.hashtags
+            empty_tables = [
+                build_table(reader.text_headers, hashtags, empty_chunk(reader), route.renames, countries, countries_by_name)
+                for route in routes
+            ]
+            for chunk in reader.chunks():
+                for route, empty in zip(routes, empty_tables):
+                    table = build_table(reader.text_headers, hashtags, chunk, route.renames, countries, countries_by_name)
+
+                    # (country, row) pairs, once per country even if it is in more than one matching column
+                    keys = [numpy.zeros(0, dtype=numpy.int64)]
+                    for i, tagspec in enumerate(hashtags):
+                        if tagspec and partition.pattern_matches(route.pattern, tagspec):
+                            country_index = country_indices(chunk.columns[i], countries_by_name)
+                            rows = numpy.nonzero(country_index >= 0)[0]
+                            keys.append(country_index[rows] * chunk.size + rows)
+                    keys = numpy.unique(numpy.concatenate(keys)) # sorted by country, then row
+                    bounds = numpy.searchsorted(keys, numpy.arange(len(countries) + 1) * chunk.size)
+                    for n in numpy.nonzero(bounds[1:] > bounds[:-1])[0]:
+                        path = partition_path(root, key, route.category, countries[n].code)
+                        writer = writers.get(path)
+                        if writer is None:
+                            os.makedirs(os.path.dirname(path), exist_ok=True)
+                            writer = writers[path] = pyarrow.parquet.ParquetWriter(path, empty.schema, compression=COMPRESSION)
+                        rows = keys[bounds[n]:bounds[n + 1]] - n * chunk.size
+                        writer.write_table(table.take(pyarrow.array(rows)))
+                        counts[path] = counts.get(path, 0) + len(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for route, empty in zip(routes, empty_tables):
+        for country in countries:
+            path = partition_path(root, key, route.category, country.code)
+            if path not in counts:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                pyarrow.parquet.write_table(empty, path, compression=COMPRESSION)
+                counts[path] = 0
+    return counts
+
+
+def write_all(root, countries, resources_by_category, sources=None):
+    """Write the Parquet partitions for every PopStats source, one pass per source.
+    @param root: the root directory of the partitions
+    @param countries: a list of popstats.inputs.Country records
+    @param resources_by_category: as returned by popstats.inputs.compile_inputs()
+    @param sources: an optional dict mapping source URLs to local copies
+    @returns: a dict of output path -> number of rows
+    """
+    counts = {}
+    for source_url, routes in partition.routes_by_source(resources_by_category).items():
+        counts.update(write_source(root, source_url, (sources or {}).get(source_url, source_url), routes, countries))
+    return counts
+
+
+def read_partition(root, source, category, iso3, columns=None):
+    """Read one partition, memory-mapped and loading only the columns needed.
+    e.g. read_partition(root, "time_series", "residence", "AFG", ["#date+year", "#affected"])
+    @param root: the root directory of the partitions
+    @param source: the source key (see popstats.partition.source_key())
+    @param category: "residence" or "origin"
+    @param iso3: the ISO3 country code
+    @param columns: a list of column names (HXL tagspecs), or None for all
+    @returns: a pyarrow.Table
+    """
+    return pyarrow.parquet.read_table(partition_path(root, source, category, iso3), columns=columns, memory_map=True)
+
+
+def open_dataset(root, source):
+    """Open all of one source's partitions as a dataset.
+    e.g. open_dataset(root, "time_series").to_table(columns=["#affected"],
+    filter=pyarrow.dataset.field("iso3") == "AFG")
+    @param root: the root directory of the partitions
+    @param source: the source key (see popstats.partition.source_key())
+    @returns: a pyarrow.dataset.Dataset with category and iso3 partition fields
+    """
+    return pyarrow.dataset.dataset(os.path.join(root, "source={}".format(source)), format="parquet", partitioning="hive")
@@ -0,0 +1,86 @@
+"""Run a per-package function over a stream of packages in parallel.
+
+The package listing keeps streaming in the calling thread while a
+bounded pool of worker threads runs the per-package function.  An
+exception for one package is logged and counted, and does not stop the
+run.  With a journal (see popstats.journal), packages already completed
+by an earlier, unfinished run are skipped, and each success is recorded;
+once a run finishes with no failures, its entries are cleared.
+"""
+
+import logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from popstats import instrument
+
+logger = logging.getLogger("popstats.executor")
+"""Python logging object"""
+
+DEFAULT_WORKERS = 8
+"""Default number of worker threads"""
+
+
+class PatchExecutor(object):
+    """Bounded thread pool for per-package patch functions."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, backlog=None, journal=None, operation=None):
+        """
+        @param workers: the number of worker threads
+        @param backlog: the maximum number of packages waiting for a worker
+        (defaults to twice the number of workers)
+        @param journal: an optional popstats.journal.Journal for resuming runs
+        @param operation: the operation name to record in the journal
+        """
+        self.workers = workers
+        self.backlog = backlog if backlog is not None else 2 * workers
+        self.journal = journal
+        self.operation = operation
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self._skipped_names = []
+        self._lock = threading.Lock()
+
+    def run(self, packages, func):
+        """Apply func(package) to every package.
+        Use functools.partial to bind any leading arguments (e.g. the CKAN
+        API access object) to an existing patch function.
+        Pulls from the packages iterator only as fast as workers free up,
+        so the listing never gets far ahead of the writes.
+        @param packages: an iterable of CKAN package (dataset) structures
+        @param func: the function to invoke for each package
+        @returns: a tuple of (succeeded, failed) counts
+        """
+        slots = threading.BoundedSemaphore(self.workers + self.backlog)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for package in packages:
+                if self.journal is not None and self.journal.done(package["name"], self.operation):
+                    self.skipped += 1
+                    self._skipped_names.append(package["name"])
+                    instrument.record_skip("journal")
+                    continue
+                slots.acquire()
+                future = pool.submit(self._run_one, func, package)
+                future.add_done_callback(lambda future: slots.release())
+        logger.info(
+            "Finished: %d succeeded, %d failed, %d already done", self.succeeded, self.failed, self.skipped
+        )
+        if self.journal is not None and not self.failed:
+            self.journal.finish(self.operation, self._skipped_names)
+        return (self.succeeded, self.failed)
+
+    def _run_one(self, func, package):
+        """Run func for a single package, isolating any exception."""
+        start = time.monotonic()
+        try:
+            func(package)
+        except Exception:
+            logger.exception("Failed to process %s", package.get("name"))
+            with self._lock:
+                self.failed += 1
+        else:
+            if self.journal is not None:
+                self.journal.record(package["name"], self.operation)
+            with self._lock:
+                self.succeeded += 1
+        finally:
+            instrument.record_package(package.get("name"), start, time.monotonic() - start)
@@ -0,0 +1,56 @@
+"""Garbage collection for the UNHCR catalogue.
+
+The 2018-08-09 split moved resources into new datasets without deleting
+the originals, and earlier fixes deleted stray resources one call at a
+time.  Leftovers make every later crawl and package_search page bigger.
+From one scan of the catalogue, this works out what the current layout
+(the input tables, SPECS and PATTERNS, as popstats.reconcile renders
+them) no longer references:
+
+  * datasets of a known type (by the full name, as popstats.registry
+    parses it) that aren't in the desired state at all;
+  * resources on a wanted dataset that aren't among its resources; and
+  * duplicate resources with the same name (the first one, which
+    carries the Quick Charts view, is kept).
+
+The deletions are reconcile.Operation objects, so they print and apply
+like a reconciliation plan: in parallel, batched by package, with the
+dataset deletions last.
+"""
+
+import logging
+from popstats import reconcile, registry
+
+logger = logging.getLogger("popstats.gc")
+"""Python logging object"""
+
+
+def find_garbage(desired, packages):
+    """List the deletions needed to remove everything the desired state doesn't reference.
+    @param desired: the desired state, from popstats.reconcile.desired_state()
+    @param packages: an iterable of the current CKAN packages of the known types (with resources)
+    @returns: a list of Operation objects, in popstats.reconcile.ORDER
+    """
+    if not desired:
+        raise Exception("The desired state is empty; refusing to collect garbage")
+    operations = []
+    for package in packages:
+        if registry.parse_name(package["name"]) is None:
+            # the search matches name prefixes, so it can return other datasets that merely start like ours
+            logger.debug("Ignoring %s (not a known dataset type)", package["name"])
+            continue
+        want = desired.get(package["name"])
+        if want is None:
+            operations.append(reconcile.Operation("package_delete", package["name"], None, {"id": package["id"]}))
+            continue
+        wanted = set(resource["name"] for resource in want.resources)
+        seen = set()
+        for resource in package.get("resources", []):
+            if resource["name"] in wanted and resource["name"] not in seen:
+                seen.add(resource["name"])
+                continue
+            reason = "duplicate" if resource["name"] in seen else "orphaned"
+            logger.debug("%s resource %s in %s", reason, resource["name"], package["name"])
+            operations.append(reconcile.Operation("resource_delete", package["name"], resource["name"], {"id": resource["id"]}))
+    operations.sort(key=lambda operation: reconcile.ORDER.index(operation.action))
+    return operations
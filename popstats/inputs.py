@@ -0,0 +1,218 @@
+"""Compiled records for the dataset-creation input tables.
+
+The countries, datasets and resources tables (the Google Sheet, or the
+backups in Inputs/) are compiled once into compact __slots__ records,
+with every template lookup and URL fragment worked out up front.  The
+country x dataset x resource expansion is then just string formatting
+and dict building, kept separate from any network access.
+"""
+
+import urllib.parse
+
+DEMOGRAPHICS_URL = 'http://popstats.unhcr.org/en/demographics.hxl'
+
+RECIPE_FIXES = {
+    (DEMOGRAPHICS_URL, 'residence'): {
+        'pattern': '#country+residence',
+        'renames': [('#country+origin', '#loc+name')],
+    },
+    (DEMOGRAPHICS_URL, 'origin'): None,
+}
+"""Corrections to the recipes in the resources table, keyed by (source URL, category).
+These match the 2018-05-25 fix-demographics patch: the residence select
+uses #country+residence, and the mis-tagged #country+origin column is
+renamed to #loc+name.  The origin demographics resources were deleted,
+so that one is dropped (None).
+"""
+
+
+class Country(object):
+    """A country from the countries table."""
+
+    __slots__ = ("code", "stub_code", "name", "unhcr_name", "article", "full_name", "quoted_unhcr_name")
+
+    def __init__(self, code, name, unhcr_name, article=None):
+        self.code = code
+        self.stub_code = code.lower()
+        self.name = name
+        self.unhcr_name = unhcr_name
+        self.article = article or None
+        self.full_name = "{} {}".format(article, name) if article else name
+        self.quoted_unhcr_name = urllib.parse.quote(unhcr_name)
+
+    @classmethod
+    def from_row(cls, row):
+        """Compile a country from an HXL row."""
+        return cls(
+            code=row.get('country+code+iso3'),
+            name=row.get('country+name+display'),
+            unhcr_name=row.get('country+name+unhcr'),
+            article=row.get('country+article+display'),
+        )
+
+
+class Dataset(object):
+    """A dataset template (one per category) from the datasets table."""
+
+    __slots__ = ("category", "stub", "title", "description", "source", "license", "methodology", "caveats", "tags")
+
+    def __init__(self, category, stub, title, description, source, license, methodology, caveats, tags):
+        self.category = category
+        self.stub = stub
+        self.title = title
+        self.description = description
+        self.source = source
+        self.license = license
+        self.methodology = methodology
+        self.caveats = caveats
+        self.tags = tags
+
+    @classmethod
+    def from_row(cls, row):
+        """Compile a dataset template from an HXL row."""
+        return cls(
+            category=row.get('category'),
+            stub=row.get('id'),
+            title=row.get('title'),
+            description=row.get('description+general'),
+            source=row.get('source'),
+            license=row.get('description+license'),
+            methodology=row.get('description+method'),
+            caveats=row.get('description+caveats'),
+            tags=tuple(tag.strip() for tag in row.get('description+tags').split("\n")),
+        )
+
+
+class Resource(object):
+    """A resource template for one category, from the resources table.
+    A row in the resources table yields up to one Resource per category
+    (there is none for a category with no description).
+    """
+
+    __slots__ = ("category", "source_url", "pattern", "filename", "description", "renames", "url_prefix", "url_suffix")
+
+    PROXY_URL = 'http://proxy.hxlstandard.org'
+
+    URL_PATTERN = '/data.csv?url={url}&filter01=select&select-query01-01={pattern}={country}'
+
+    RENAME_PATTERN = '&filter{n:02d}=rename&rename-oldtag{n:02d}={old}&rename-newtag{n:02d}={new}'
+
+    def __init__(self, category, source_url, pattern, filename, description, renames=()):
+        self.category = category
+        self.source_url = source_url
+        self.pattern = pattern
+        self.filename = filename
+        self.description = description
+        self.renames = list(renames)
+        # everything in the URL except the proxy and the (quoted) country name
+        self.url_prefix = self.URL_PATTERN.format(
+            url=urllib.parse.quote(source_url),
+            pattern=urllib.parse.quote(pattern),
+            country=''
+        )
+        self.url_suffix = ''.join(
+            self.RENAME_PATTERN.format(
+                n=n,
+                old=urllib.parse.quote(old.lstrip('#')),
+                new=urllib.parse.quote(new.lstrip('#'))
+            ) for n, (old, new) in enumerate(self.renames, start=2)
+        )
+
+    def name(self, country):
+        return self.filename.format(self.category, country.stub_code)
+
+    def url(self, country):
+        return self.PROXY_URL + self.url_prefix + country.quoted_unhcr_name + self.url_suffix
+
+    @classmethod
+    def from_row(cls, row, category):
+        """Compile a resource template from an HXL row, applying any RECIPE_FIXES.
+        @returns: the Resource, or None if it is not included for the category
+        """
+        description = row.get('title+' + category)
+        if not description:
+            return None
+        source_url = row.get('x_resource+link+source')
+        fix = RECIPE_FIXES.get((source_url, category), {})
+        if fix is None:
+            return None
+        return cls(
+            category=category,
+            source_url=source_url,
+            pattern=fix.get('pattern', row.get('x_pattern+' + category)),
+            filename=row.get('x_filename'),
+            description=description,
+            renames=fix.get('renames', ()),
+        )
+
+
+def configure(config):
+    """Point the resource URLs at another HXL Proxy-compatible server, if config.py sets 'proxy'
+    (e.g. the slice server in popstats.slices).
+    """
+    if config.get('proxy'):
+        Resource.PROXY_URL = config['proxy'].rstrip('/')
+
+
+def compile_inputs(country_rows, dataset_rows, resource_rows):
+    """Compile the three input tables.
+    @param country_rows: an iterable of HXL rows from the countries table
+    @param dataset_rows: an iterable of HXL rows from the datasets table
+    @param resource_rows: an iterable of HXL rows from the resources table
+    @returns: a tuple of (countries, datasets, resources_by_category)
+    """
+    countries = [Country.from_row(row) for row in country_rows]
+    datasets = [Dataset.from_row(row) for row in dataset_rows]
+    resource_rows = list(resource_rows)
+    resources_by_category = {}
+    for dataset in datasets:
+        resources_by_category[dataset.category] = [
+            resource for resource in (Resource.from_row(row, dataset.category) for row in resource_rows)
+            if resource is not None
+        ]
+    return (countries, datasets, resources_by_category)
+
+
+def render_package(country, dataset, resources, creator):
+    """Build the CKAN package structure for one country and dataset template.
+    @param country: the Country
+    @param dataset: the Dataset template
+    @param resources: the Resource templates for the dataset's category
+    @param creator: the CKAN username to record as package_creator
+    @returns: a dict ready for package_create or package_update
+    """
+    full_name = country.full_name
+    return {
+        'name': dataset.stub.format(country.stub_code),
+        'title': dataset.title.format(full_name),
+        'notes': dataset.description.format(full_name),
+        'dataset_source': dataset.source,
+        'owner_org': 'unhcr',
+        'package_creator': creator,
+        'license_id': dataset.license,
+        'methodology': dataset.methodology,
+        'data_update_frequency': '0',
+        'dataset_date': '01/01/1990-12/31/2027',
+        'caveats': dataset.caveats,
+        'groups': [{'name': country.stub_code}],
+        'tags': [{'name': tag} for tag in dataset.tags],
+        'resources': [
+            {
+                'name': resource.name(country),
+                'description': resource.description.format(full_name),
+                'url': resource.url(country),
+                'mimetype': 'text/csv',
+                'format': 'CSV'
+            } for resource in resources
+        ]
+    }
+
+
+def render_all(countries, datasets, resources_by_category, creator):
+    """Expand every country x dataset template into a CKAN package structure.
+    @returns: a list of package dicts
+    """
+    return [
+        render_package(country, dataset, resources_by_category[dataset.category], creator)
+        for country in countries for dataset in datasets
+    ]
@@ -0,0 +1,219 @@
+"""Run instrumentation for the maintenance scripts.
+
+When enabled, every CKAN action records its latency (in a histogram per
+action), bytes sent and received, retries and errors; every package
+records its wall time; and writes that were skipped because nothing had
+changed are counted.  A JSON summary is written when the script exits,
+and optionally a timeline in the Chrome trace format (load it in
+chrome://tracing or https://ui.perfetto.dev) with one row per thread,
+which shows how much of the time the workers actually overlap.
+
+Set 'profile' (the summary file) and optionally 'trace' in config.py;
+client.from_config() turns instrumentation on from those.  When it is
+off, every record_* function returns immediately.
+"""
+
+import atexit, bisect, json, logging, os, threading, time
+
+logger = logging.getLogger("popstats.instrument")
+"""Python logging object"""
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Upper bounds in seconds of the latency histogram buckets (plus one for anything slower)"""
+
+SLOWEST_PACKAGES = 20
+"""Number of slowest packages to list in the summary"""
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Estimate a percentile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], round(self.max, 3)) if i < len(BUCKETS) else round(self.max, 3)
+        return round(self.max, 3)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 3),
+            "mean_seconds": round(self.total / self.count, 4) if self.count else None,
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+            "max_seconds": round(self.max, 3),
+            "buckets": {("<={}".format(bound) if i < len(BUCKETS) else ">{}".format(BUCKETS[-1])): n
+                        for i, (bound, n) in enumerate(zip(BUCKETS + (None,), self.counts)) if n},
+        }
+
+
+class Recorder(object):
+    """Thread-safe collector for one run's measurements."""
+
+    def __init__(self, trace=False):
+        """
+        @param trace: if True, also keep every event for a Chrome trace
+        """
+        self.start = time.monotonic()
+        self.started = time.time()
+        self.actions = {}
+        self.skips = {}
+        self.cache_hits = {}
+        self.packages = Histogram()
+        self.package_times = []
+        self.events = [] if trace else None
+        self._lock = threading.Lock()
+
+    def _event(self, name, category, start, seconds, args):
+        if self.events is not None:
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int((start - self.start) * 1e6),
+                "dur": int(seconds * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+    def action(self, action, start, seconds, sent=0, received=0, retries=0, error=None, waited=0.0):
+        with self._lock:
+            entry = self.actions.get(action)
+            if entry is None:
+                entry = self.actions[action] = {"latency": Histogram(), "errors": 0, "retries": 0, "bytes_sent": 0, "bytes_received": 0, "rate_wait_seconds": 0.0}
+            entry["latency"].add(seconds)
+            entry["rate_wait_seconds"] += waited
+            entry["retries"] += retries
+            entry["bytes_sent"] += sent
+            entry["bytes_received"] += received
+            if error is not None:
+                entry["errors"] += 1
+            self._event(action, "action", start, seconds, {"retries": retries, "error": error, "rate_wait": round(waited, 3)})
+
+    def package(self, name, start, seconds):
+        with self._lock:
+            self.packages.add(seconds)
+            self.package_times.append((seconds, name))
+            self._event(name, "package", start, seconds, {})
+
+    def skip(self, kind):
+        with self._lock:
+            self.skips[kind] = self.skips.get(kind, 0) + 1
+
+    def cache_hit(self, action):
+        with self._lock:
+            self.cache_hits[action] = self.cache_hits.get(action, 0) + 1
+
+    def summary(self):
+        """Build the machine-readable summary of the run."""
+        with self._lock:
+            wall = time.monotonic() - self.start
+            # time actually waiting on the server, leaving out waits for the rate limit
+            busy = sum(entry["latency"].total - entry["rate_wait_seconds"] for entry in self.actions.values())
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.started)),
+                "wall_seconds": round(wall, 3),
+                "api_seconds": round(busy, 3),
+                # average number of API calls in flight: ~1 means no effective parallelism
+                "mean_concurrency": round(busy / wall, 2) if wall else None,
+                "actions": {
+                    action: dict(entry["latency"].as_dict(), **{key: round(value, 3) if isinstance(value, float) else value
+                                                                for key, value in entry.items() if key != "latency"})
+                    for action, entry in sorted(self.actions.items(), key=lambda item: -item[1]["latency"].total)
+                },
+                "skipped_unchanged": dict(self.skips),
+                "cache_hits": dict(self.cache_hits),
+                "packages": dict(self.packages.as_dict(), slowest=[
+                    {"name": name, "seconds": round(seconds, 3)}
+                    for seconds, name in sorted(self.package_times, reverse=True)[:SLOWEST_PACKAGES]
+                ]),
+            }
+
+    def write(self, summary_path=None, trace_path=None):
+        if summary_path:
+            with open(summary_path, "w", encoding="utf-8") as output:
+                json.dump(self.summary(), output, indent=2)
+            logger.info("Wrote run profile to %s", summary_path)
+        if trace_path and self.events is not None:
+            with self._lock:
+                events = list(self.events)
+            with open(trace_path, "w", encoding="utf-8") as output:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, output)
+            logger.info("Wrote trace to %s", trace_path)
+
+
+recorder = None
+"""The active Recorder, or None when instrumentation is off"""
+
+
+def enable(summary_path=None, trace_path=None):
+    """Turn on instrumentation, writing the results when the process exits.
+    @param summary_path: the JSON summary file, if any
+    @param trace_path: the Chrome trace file, if any
+    @returns: the Recorder
+    """
+    global recorder
+    if recorder is None:
+        recorder = Recorder(trace=bool(trace_path))
+        atexit.register(recorder.write, summary_path, trace_path)
+    return recorder
+
+
+def configure(config):
+    """Turn on instrumentation if config.py asks for it ('profile' and/or 'trace')."""
+    if config.get('profile') or config.get('trace'):
+        enable(config.get('profile'), config.get('trace'))
+
+
+def record_action(action, start, seconds, sent=0, received=0, retries=0, error=None, waited=0.0):
+    """Record one CKAN action call (including all of its retries).
+    @param action: the action name
+    @param start: the time.monotonic() when the call started
+    @param seconds: the total time taken, including waits for the rate limit
+    @param sent: bytes sent
+    @param received: bytes received
+    @param retries: the number of retries needed
+    @param error: the exception class name if the call failed, else None
+    @param waited: the part of the time spent waiting for the rate limit
+    """
+    if recorder is not None:
+        recorder.action(action, start, seconds, sent, received, retries, error, waited)
+
+
+def record_package(name, start, seconds):
+    """Record the wall time for processing one package."""
+    if recorder is not None:
+        recorder.package(name, start, seconds)
+
+
+def record_skip(kind):
+    """Count a write skipped because nothing had changed (or already done), e.g. "package_patch"."""
+    if recorder is not None:
+        recorder.skip(kind)
+
+
+def record_cache_hit(action):
+    """Count a read answered from popstats.cache instead of the API."""
+    if recorder is not None:
+        recorder.cache_hit(action)
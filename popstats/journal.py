@@ -0,0 +1,125 @@
+"""Checkpoint journal of completed work, so long runs can resume.
+
+The journal is an append-only file with one JSON line per completed
+(package, operation) pair, fsync'd as each entry is written.  On start,
+the completed pairs are loaded into a set, so a restarted run skips work
+already done with an O(1) check per package.  One journal file can be
+shared by all of the scripts, since each records its own operation names.
+
+Entries only last until the run that they belong to finishes cleanly:
+the engine (popstats.executor or popstats.aio) then appends a line
+clearing the packages that it handled, so the next run of the script starts afresh (and picks up any
+changed data or code), while a run that failed or was interrupted still
+resumes.  Clearing only the run's own packages leaves the entries of
+other shards (see popstats.shards) running at the same time alone.
+"""
+
+import datetime, json, logging, os, threading
+
+logger = logging.getLogger("popstats.journal")
+"""Python logging object"""
+
+DEFAULT_PATH = "unhcr-journal.jsonl"
+"""Default location of the journal file"""
+
+
+class Journal(object):
+    """Append-only record of completed (package, operation) pairs."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        @param path: the journal file (created if it doesn't exist)
+        """
+        self.path = path
+        self.completed = set()
+        self.recorded = set() # the pairs recorded by this process
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as input:
+                for line in input:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write from a crash: the work wasn't recorded, so it will be redone
+                        logger.warning("Ignoring incomplete journal entry in %s", path)
+                        continue
+                    if "cleared" in entry:
+                        self.completed.difference_update((package, entry["operation"]) for package in entry["cleared"])
+                    else:
+                        self.completed.add((entry["package"], entry["operation"]))
+            logger.info("Loaded %d completed entries from %s", len(self.completed), path)
+        self._output = open(path, "a", encoding="utf-8")
+        if self._output.tell() > 0:
+            with open(path, "rb") as input:
+                input.seek(-1, os.SEEK_END)
+                if input.read(1) != b"\n":
+                    # terminate a torn last line so the next entry starts cleanly
+                    self._output.write("\n")
+
+    def done(self, package, operation):
+        """Test whether an operation has already been completed for a package.
+        @param package: the package name
+        @param operation: the operation name (e.g. "add-quickcharts")
+        """
+        return (package, operation) in self.completed
+
+    def record(self, package, operation):
+        """Durably record that an operation has been completed for a package.
+        Returns only once the entry is on disk.
+        @param package: the package name
+        @param operation: the operation name (e.g. "add-quickcharts")
+        """
+        self._write({
+            "package": package,
+            "operation": operation,
+            "time": datetime.datetime.utcnow().isoformat(),
+        })
+        with self._lock:
+            self.completed.add((package, operation))
+            self.recorded.add((package, operation))
+
+    def clear(self, operation, packages):
+        """Durably forget the completed entries for some packages, at the end of a clean run.
+        @param operation: the operation name
+        @param packages: an iterable of package names
+        """
+        packages = sorted(set(packages))
+        if not packages:
+            return
+        self._write({
+            "operation": operation,
+            "cleared": packages,
+            "time": datetime.datetime.utcnow().isoformat(),
+        })
+        with self._lock:
+            self.completed.difference_update((package, operation) for package in packages)
+        logger.info("Cleared %d completed %s entries from %s", len(packages), operation, self.path)
+
+    def finish(self, operation, skipped):
+        """Clear an operation's entries after a run of it finished with no failures,
+        so the next run starts afresh.
+        @param operation: the operation name
+        @param skipped: the names of the packages the run skipped as already done
+        """
+        self.clear(operation, list(skipped) + self.recorded_packages(operation))
+
+    def recorded_packages(self, operation):
+        """List the packages that this process has recorded for an operation."""
+        with self._lock:
+            return [package for package, recorded_operation in self.recorded if recorded_operation == operation]
+
+    def _write(self, entry):
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._output.write(line)
+            self._output.flush()
+            os.fsync(self._output.fileno())
+
+    def close(self):
+        with self._lock:
+            self._output.close()
+
+
+def open_journal(path):
+    """Open a journal, or return None if path is None (no checkpointing)."""
+    return Journal(path) if path is not None else None
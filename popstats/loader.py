@@ -0,0 +1,189 @@
+"""Streaming typed loader for the UNHCR PopStats HXL sources.
+
+The sources are CSV text, and UNHCR replaces figures between 1 and 4
+with an asterisk (as every caveat in popstats.registry.SPECS says), so
+anything that aggregates them would otherwise re-parse strings and
+special-case "*" row by row.  TypedReader reads a source in fixed-size
+chunks of rows, so memory stays flat even on the demographics source,
+and converts each count column into an IntegerColumn: an int64 array of
+values with parallel boolean masks for suppressed cells and for blank
+(or non-numeric) cells.  Suppressed figures are neither zero nor
+missing; callers decide what to do with them.  Other columns are numpy
+string arrays.
+
+Strings are parsed once per distinct value, not once per cell, and the
+parsed values are remembered across chunks.
+
+    with loader.TypedReader(source, ["#date+year", "#affected"]) as reader:
+        for chunk in reader.chunks():
+            counts = chunk.columns[i]
+            total += counts.values[counts.valid].sum()
+"""
+
+import csv, logging
+import numpy
+from popstats import partition
+
+logger = logging.getLogger("popstats.loader")
+"""Python logging object"""
+
+CHUNK_ROWS = 100000
+"""Default number of rows per chunk"""
+
+INTEGER_PATTERNS = ("#affected", "#date+year", "#date+month")
+"""HXL tag patterns for columns read as integers"""
+
+SUPPRESSED = "*"
+"""The value UNHCR substitutes for figures between 1 and 4"""
+
+
+def parse_count(value):
+    """Convert one source value to a number, or None if it is suppressed or blank."""
+    value = value.strip().replace(",", "")
+    if not value or value == SUPPRESSED:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class IntegerColumn(object):
+    """A typed count column: values, with masks for suppressed and missing cells."""
+
+    __slots__ = ("values", "suppressed", "missing")
+
+    def __init__(self, values, suppressed, missing):
+        """
+        @param values: an int64 array (0 wherever the cell is suppressed or missing)
+        @param suppressed: a boolean array, True where the source has "*"
+        @param missing: a boolean array, True where the cell is blank or not a number
+        """
+        self.values = values
+        self.suppressed = suppressed
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def valid(self):
+        """A boolean array, True where there is a real figure."""
+        return ~(self.suppressed | self.missing)
+
+
+class Chunk(object):
+    """A block of consecutive rows from a source, by column."""
+
+    __slots__ = ("start", "size", "columns")
+
+    def __init__(self, start, size, columns):
+        """
+        @param start: the number of data rows before this chunk
+        @param size: the number of rows in this chunk
+        @param columns: a dict of column index -> IntegerColumn or numpy string array
+        """
+        self.start = start
+        self.size = size
+        self.columns = columns
+
+
+class TypedReader(object):
+    """Chunked, typed reads of one PopStats source; use as a context manager."""
+
+    def __init__(self, source, patterns=None, integer_patterns=INTEGER_PATTERNS, chunk_rows=CHUNK_ROWS):
+        """
+        @param source: the source URL or local file
+        @param patterns: tag patterns for the columns to read, or None for all of them
+        @param integer_patterns: tag patterns for the columns to read as integers
+        @param chunk_rows: the number of rows per chunk
+        """
+        self.source = source
+        self.patterns = patterns
+        self.integer_patterns = integer_patterns
+        self.chunk_rows = chunk_rows
+        self.text_headers = None
+        self.hashtags = None
+        self.wanted = None
+        self.integers = None
+        self._input = None
+        self._reader = None
+        self._parsed = {} # string -> (value, suppressed, missing), shared by all of the chunks
+
+    def __enter__(self):
+        self._input = partition.open_source(self.source)
+        self._reader = csv.reader(self._input)
+        for row in self._reader:
+            if partition.is_hashtag_row(row):
+                self.hashtags = row
+                break
+            self.text_headers = row
+        if self.hashtags is None:
+            self._input.close()
+            raise Exception("No HXL hashtag row found in {}".format(self.source))
+        self.wanted = [
+            i for i, tagspec in enumerate(self.hashtags) if self.patterns is None or (
+                tagspec.strip() and any(partition.pattern_matches(pattern, tagspec) for pattern in self.patterns)
+            )
+        ]
+        self.integers = set(
+            i for i in self.wanted if self.hashtags[i].strip()
+            and any(partition.pattern_matches(pattern, self.hashtags[i]) for pattern in self.integer_patterns)
+        )
+        return self
+
+    def __exit__(self, *exc):
+        self._input.close()
+
+    def matching(self, pattern):
+        """List the indices of the columns read that match a tag pattern."""
+        return [i for i in self.wanted if partition.pattern_matches(pattern, self.hashtags[i])]
+
+    def chunks(self):
+        """Stream the source's data rows as Chunk objects."""
+        width = len(self.hashtags)
+        start = 0
+        rows = 0
+        columns = {i: [] for i in self.wanted}
+        for row in self._reader:
+            if len(row) < width:
+                row = row + [""] * (width - len(row))
+            for i, values in columns.items():
+                values.append(row[i])
+            rows += 1
+            if rows == self.chunk_rows:
+                yield self._convert(start, rows, columns)
+                start += rows
+                rows = 0
+                columns = {i: [] for i in self.wanted}
+        if rows:
+            yield self._convert(start, rows, columns)
+        logger.debug("Read %d rows from %s", start + rows, self.source)
+
+    def _convert(self, start, size, columns):
+        typed = {}
+        for i, values in columns.items():
+            strings = numpy.array(values, dtype=str)
+            typed[i] = self.to_integers(strings) if i in self.integers else strings
+        return Chunk(start, size, typed)
+
+    def to_integers(self, strings):
+        """Convert an array of strings to an IntegerColumn, parsing each distinct value once."""
+        distinct, inverse = numpy.unique(strings, return_inverse=True)
+        parsed = [self._parse(value) for value in distinct]
+        values = numpy.array([entry[0] for entry in parsed], dtype=numpy.int64)
+        suppressed = numpy.array([entry[1] for entry in parsed], dtype=bool)
+        missing = numpy.array([entry[2] for entry in parsed], dtype=bool)
+        return IntegerColumn(values[inverse], suppressed[inverse], missing[inverse])
+
+    def _parse(self, value):
+        entry = self._parsed.get(value)
+        if entry is None:
+            number = parse_count(value)
+            if number is not None:
+                entry = (int(round(number)), False, False)
+            else:
+                suppressed = value.strip() == SUPPRESSED
+                entry = (0, suppressed, not suppressed)
+            self._parsed[value] = entry
+        return entry
@@ -0,0 +1,131 @@
+"""Content-hash manifest of each country's slice of the PopStats sources.
+
+Every run used to treat all countries x dataset types as changed.  This
+module streams each source once and hashes the rows each resource would
+select, one SHA-256 per (source, category, country), so a later run can
+compare against the hashes it saved and schedule work only for the
+datasets whose data actually changed (see
+popstats.reconcile.datasets_for_changes()).
+
+The manifest is a small JSON file kept next to the Inputs/ tables.
+"""
+
+import csv, datetime, hashlib, json, logging, os
+from popstats import partition, tables
+
+logger = logging.getLogger("popstats.manifest")
+"""Python logging object"""
+
+DEFAULT_PATH = os.path.join(tables.DEFAULT_INPUTS_DIR, "manifest.json")
+"""Default location of the manifest"""
+
+MANIFEST_VERSION = 1
+"""Manifest format version; a manifest with a different version is ignored"""
+
+
+def key(source_url, category, code):
+    """Make the manifest key for one resource's slice (e.g. "time_series/residence/AFG")."""
+    return "{}/{}/{}".format(partition.source_key(source_url), category, code)
+
+
+def _row_bytes(row):
+    return ("\x1f".join(row) + "\n").encode("utf-8")
+
+
+def hash_source(source_url, source, routes, countries):
+    """Stream one source and hash every country's slice for each route.
+    The header rows are part of every hash, so a change of columns counts
+    as a change for all countries.
+    @param source_url: the source URL (for the keys)
+    @param source: the source URL or local file to read
+    @param routes: the popstats.partition.Route objects for the source
+    @param countries: a list of popstats.inputs.Country records
+    @returns: a dict of key -> SHA-256 hex digest
+    """
+    logger.info("Hashing %s", source)
+    countries_by_name = {partition.normalise_string(country.unhcr_name): country for country in countries}
+    with partition.open_source(source) as input:
+        reader = csv.reader(input)
+        header = hashlib.sha256()
+        hashtags = None
+        for row in reader:
+            header.update(_row_bytes(row))
+            if partition.is_hashtag_row(row):
+                hashtags = row
+                break
+        if hashtags is None:
+            raise Exception("No HXL hashtag row found in {}".format(source))
+
+        hashes = {}
+        plans = []
+        for route in routes:
+            columns = [i for i, tagspec in enumerate(hashtags) if tagspec and partition.pattern_matches(route.pattern, tagspec)]
+            for country in countries:
+                hashes[(route.category, country.code)] = header.copy()
+            plans.append((route, columns))
+
+        for row in reader:
+            data = _row_bytes(row)
+            for route, columns in plans:
+                seen = set()
+                for i in columns:
+                    if i >= len(row):
+                        continue
+                    country = countries_by_name.get(partition.normalise_string(row[i]))
+                    if country is not None and country.code not in seen:
+                        seen.add(country.code)
+                        hashes[(route.category, country.code)].update(data)
+    return {key(source_url, category, code): digest.hexdigest() for (category, code), digest in hashes.items()}
+
+
+def hash_all(countries, resources_by_category, sources=None):
+    """Hash every country's slice of every PopStats source, one pass per source.
+    @param countries: a list of popstats.inputs.Country records
+    @param resources_by_category: as returned by popstats.inputs.compile_inputs()
+    @param sources: an optional dict mapping source URLs to local copies
+    @returns: a dict of key -> SHA-256 hex digest
+    """
+    hashes = {}
+    for source_url, routes in partition.routes_by_source(resources_by_category).items():
+        hashes.update(hash_source(source_url, (sources or {}).get(source_url, source_url), routes, countries))
+    return hashes
+
+
+class Manifest(object):
+    """The content hashes saved by the last successful run."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        @param path: the JSON manifest file (it need not exist yet)
+        """
+        self.path = path
+        self.hashes = {}
+        self.updated = None
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as input:
+                manifest = json.load(input)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.hashes = manifest["hashes"]
+                self.updated = manifest.get("updated")
+            else:
+                logger.warning("Ignoring %s (old format)", path)
+
+    def changed(self, hashes):
+        """List the keys whose content is new or different from the manifest.
+        @param hashes: the current hashes, from hash_all()
+        @returns: a set of keys
+        """
+        return {key for key, digest in hashes.items() if self.hashes.get(key) != digest}
+
+    def update(self, hashes, keys=None):
+        """Record new hashes (all of them, or only the given keys)."""
+        for key in (hashes if keys is None else keys):
+            self.hashes[key] = hashes[key]
+
+    def save(self):
+        self.updated = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as output:
+            json.dump({"version": MANIFEST_VERSION, "updated": self.updated, "hashes": self.hashes}, output, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+        logger.info("Saved %d hashes to %s", len(self.hashes), self.path)
@@ -0,0 +1,226 @@
+"""Single-pass local partitioning of the UNHCR PopStats HXL sources.
+
+Every published resource is an HXL Proxy recipe that selects one
+country's rows from a full UNHCR source, so each download makes the
+proxy fetch and scan the whole source again.  This module streams each
+source once and routes every row into per-ISO3 output files, one per
+resource, with the same columns the proxy recipes produce (including the recipe
+fixes in popstats.inputs.RECIPE_FIXES).
+
+Only a bounded number of output files are open at once; the least
+recently used one is closed (and later reopened for appending) when the
+budget is exhausted, so memory stays constant however many partitions
+there are.
+"""
+
+import collections, csv, io, logging, os, re, urllib.request
+
+logger = logging.getLogger("popstats.partition")
+"""Python logging object"""
+
+DEFAULT_MAX_OPEN = 64
+"""Default maximum number of output files open at once"""
+
+def normalise_string(s):
+    """Normalise a value for comparison, as the HXL Proxy's select does."""
+    return " ".join(s.split()).lower()
+
+
+def parse_tagspec(tagspec):
+    """Split an HXL tagspec into a tag and a set of attributes.
+    @param tagspec: e.g. "#country +code +iso3"
+    @returns: a tuple of (tag, attributes), e.g. ("#country", {"code", "iso3"})
+    """
+    parts = re.sub(r"\s+", "", tagspec).lower().split("+")
+    return (parts[0], set(parts[1:]))
+
+
+def pattern_matches(pattern, tagspec):
+    """Test whether an HXL tag pattern (e.g. "#country+origin") matches a column tagspec."""
+    pattern_tag, pattern_attributes = parse_tagspec(pattern)
+    tag, attributes = parse_tagspec(tagspec)
+    return pattern_tag == tag and pattern_attributes <= attributes
+
+
+def is_hashtag_row(row):
+    """Test whether a CSV row is an HXL hashtag row."""
+    tags = [cell.strip() for cell in row if cell.strip()]
+    return bool(tags) and all(tag.startswith("#") for tag in tags)
+
+
+def source_key(source_url):
+    """Make a short key for a source (e.g. ".../time_series.hxl" -> "time_series")."""
+    return re.sub(r"\.[^.]*$", "", source_url.rstrip("/").rsplit("/", 1)[-1])
+
+
+def display_tagspec(tagspec):
+    """Format a tagspec as the HXL Proxy prints it (no spaces)."""
+    return re.sub(r"\s+", "", tagspec)
+
+
+class Route(object):
+    """One way to partition a source: by a country column, into one file per country."""
+
+    __slots__ = ("category", "pattern", "filename", "renames")
+
+    def __init__(self, category, pattern, filename, renames=()):
+        """
+        @param category: "origin" or "residence"
+        @param pattern: the HXL tag pattern for the country column (e.g. "#country+origin")
+        @param filename: the output filename template, filled with (category, iso3)
+        @param renames: a list of (old pattern, new tagspec) hashtag renames
+        """
+        self.category = category
+        self.pattern = pattern
+        self.filename = filename
+        self.renames = list(renames)
+
+
+def routes_by_source(resources_by_category):
+    """Group the resource templates into routes for each distinct source.
+    The templates already carry the recipe fixes (see popstats.inputs.RECIPE_FIXES).
+    @param resources_by_category: as returned by popstats.inputs.compile_inputs()
+    @returns: an ordered dict of source URL -> list of Route
+    """
+    result = collections.OrderedDict()
+    for category, resources in resources_by_category.items():
+        for resource in resources:
+            result.setdefault(resource.source_url, []).append(Route(
+                category=category,
+                pattern=resource.pattern,
+                filename=resource.filename,
+                renames=resource.renames,
+            ))
+    return result
+
+
+def open_source(source):
+    """Open a local file or URL for streaming text reads."""
+    if re.match(r"^https?:", source):
+        return io.TextIOWrapper(urllib.request.urlopen(source), encoding="utf-8", newline="")
+    else:
+        return open(source, "r", encoding="utf-8", newline="")
+
+
+class Partitioner(object):
+    """Stream PopStats sources into per-country output files."""
+
+    def __init__(self, output_dir, countries, max_open=DEFAULT_MAX_OPEN):
+        """
+        @param output_dir: the directory for the output files
+        @param countries: a list of popstats.inputs.Country records
+        @param max_open: the maximum number of output files open at once
+        """
+        self.output_dir = output_dir
+        self.countries = countries
+        self.max_open = max_open
+        self.countries_by_name = {normalise_string(country.unhcr_name): country for country in countries}
+        self.open_files = collections.OrderedDict() # path -> (file, writer), in LRU order
+        self.row_counts = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def writer(self, path, header_rows):
+        """Get a CSV writer for an output file, opening it if needed.
+        Writes the header rows when a file is first created.
+        """
+        entry = self.open_files.get(path)
+        if entry is not None:
+            self.open_files.move_to_end(path)
+            return entry[1]
+        while len(self.open_files) >= self.max_open:
+            _, (f, _) = self.open_files.popitem(last=False)
+            f.close()
+        started = path in self.row_counts
+        f = open(path, "a" if started else "w", encoding="utf-8", newline="")
+        writer = csv.writer(f)
+        if not started:
+            writer.writerows(header_rows)
+            self.row_counts[path] = 0
+        self.open_files[path] = (f, writer)
+        return writer
+
+    def close(self):
+        """Close all open output files."""
+        for f, _ in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+
+    def partition(self, source, routes):
+        """Stream one source and write every row to its partitions.
+        Countries with no matching rows still get a file with just the
+        header rows, as the proxy would return.
+        @param source: the source URL or local file
+        @param routes: a list of Route objects for the source
+        @returns: the number of data rows read
+        """
+        logger.info("Partitioning %s", source)
+        with open_source(source) as input:
+            reader = csv.reader(input)
+            text_headers = None
+            hashtags = None
+            for row in reader:
+                if is_hashtag_row(row):
+                    hashtags = row
+                    break
+                text_headers = row
+            if hashtags is None:
+                raise Exception("No HXL hashtag row found in {}".format(source))
+
+            # Work out the country columns and output headers for each route
+            plans = []
+            for route in routes:
+                columns = [i for i, tagspec in enumerate(hashtags) if tagspec and pattern_matches(route.pattern, tagspec)]
+                if not columns:
+                    logger.warning("No %s column in %s", route.pattern, source)
+                out_hashtags = []
+                for tagspec in hashtags:
+                    for old, new in route.renames:
+                        if tagspec and pattern_matches(old, tagspec):
+                            tagspec = new
+                            break
+                    out_hashtags.append(display_tagspec(tagspec))
+                header_rows = [text_headers, out_hashtags] if text_headers is not None else [out_hashtags]
+                plans.append((route, columns, header_rows))
+
+            count = 0
+            for row in reader:
+                count += 1
+                for route, columns, header_rows in plans:
+                    seen = set()
+                    for i in columns:
+                        if i >= len(row):
+                            continue
+                        country = self.countries_by_name.get(normalise_string(row[i]))
+                        if country is not None and country.code not in seen:
+                            seen.add(country.code)
+                            path = self.path(route, country)
+                            self.writer(path, header_rows).writerow(row)
+                            self.row_counts[path] += 1
+
+        # Header-only files for countries with no rows
+        for route, columns, header_rows in plans:
+            for country in self.countries:
+                path = self.path(route, country)
+                if path not in self.row_counts:
+                    self.writer(path, header_rows)
+        self.close()
+        logger.info("Read %d rows from %s", count, source)
+        return count
+
+    def path(self, route, country):
+        return os.path.join(self.output_dir, route.filename.format(route.category, country.stub_code))
+
+
+def partition_all(output_dir, countries, resources_by_category, max_open=DEFAULT_MAX_OPEN, sources=None):
+    """Partition every PopStats source, one pass per source.
+    @param output_dir: the directory for the output files
+    @param countries: a list of popstats.inputs.Country records
+    @param resources_by_category: as returned by popstats.inputs.compile_inputs()
+    @param max_open: the maximum number of output files open at once
+    @param sources: an optional dict mapping source URLs to local copies
+    @returns: a dict of output path -> number of data rows
+    """
+    partitioner = Partitioner(output_dir, countries, max_open)
+    for source_url, routes in routes_by_source(resources_by_category).items():
+        partitioner.partition((sources or {}).get(source_url, source_url), routes)
+    return partitioner.row_counts
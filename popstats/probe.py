@@ -0,0 +1,186 @@
+"""Bulk probe of resource URLs, to find empty or broken PopStats resources.
+
+A resource is empty when the UNHCR source has no rows for its country
+(often because UNHCR has renamed the country, e.g. "France: all
+regions"), so the HXL Proxy returns only the header rows.  Each probe
+streams the response and stops as soon as it has seen the hashtag row
+and one data row, so a healthy resource costs only its first few
+hundred bytes.  Results are cached by URL for a while, so a rerun only
+probes what has expired; errors are not cached, since they are often
+transient, so a rerun always probes those again.
+"""
+
+import csv, io, json, logging, os, threading, time, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from popstats import partition
+
+logger = logging.getLogger("popstats.probe")
+"""Python logging object"""
+
+DEFAULT_WORKERS = 16
+"""Default number of URLs to probe at once"""
+
+DEFAULT_TIMEOUT = 120
+"""Default seconds to wait for a response (the proxy can be slow on the large sources)"""
+
+DEFAULT_SLOW = 30
+"""Default number of seconds to the first data row above which a resource is reported as slow"""
+
+DEFAULT_CACHE_PATH = "probe-cache.json"
+"""Default location of the probe result cache"""
+
+DEFAULT_TTL = 24 * 60 * 60
+"""Default number of seconds before a cached probe result expires"""
+
+OK = "ok"
+EMPTY = "empty"
+ERROR = "error"
+
+
+def probe(url, timeout=DEFAULT_TIMEOUT):
+    """Probe one resource URL.
+    Reads only as far as the first data row after the HXL hashtag row.
+    @param url: the resource URL
+    @param timeout: the seconds to wait for the server
+    @returns: a result dict with url, status (OK, EMPTY or ERROR), http_status, seconds and error
+    """
+    result = {"url": url, "status": ERROR, "http_status": None, "seconds": None, "error": None}
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            result["http_status"] = response.status
+            reader = csv.reader(io.TextIOWrapper(response, encoding="utf-8", newline=""))
+            hashtags = None
+            for row in reader:
+                if hashtags is None:
+                    if partition.is_hashtag_row(row):
+                        hashtags = row
+                elif any(value.strip() for value in row):
+                    result["status"] = OK
+                    break
+            else:
+                if hashtags is None:
+                    result["error"] = "No HXL hashtag row"
+                else:
+                    result["status"] = EMPTY
+    except Exception as e:
+        if getattr(e, "code", None) is not None:
+            result["http_status"] = e.code
+        result["error"] = str(e)
+    result["seconds"] = round(time.monotonic() - start, 3)
+    return result
+
+
+class ProbeCache(object):
+    """JSON cache of probe results keyed by URL, with a time to live."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL):
+        """
+        @param path: the JSON cache file, or None for no disk cache
+        @param ttl: the number of seconds a result stays fresh
+        """
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as input:
+                self.entries = json.load(input)
+
+    def get(self, url):
+        """Return the cached result for a URL, or None if there is none or it has expired."""
+        entry = self.entries.get(url)
+        if entry is not None and entry["status"] != ERROR and time.time() - entry["time"] < self.ttl:
+            return entry
+        return None
+
+    def put(self, result):
+        """Store a probe result, unless it is an error (which is dropped, so it is probed again)."""
+        with self._lock:
+            if result["status"] == ERROR:
+                self.entries.pop(result["url"], None)
+            else:
+                self.entries[result["url"]] = dict(result, time=time.time())
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as output:
+                json.dump(self.entries, output)
+            os.replace(temp_path, self.path)
+
+
+def probe_all(targets, workers=DEFAULT_WORKERS, cache=None, timeout=DEFAULT_TIMEOUT):
+    """Probe many resources in parallel.
+    @param targets: an iterable of dicts with at least "url" (e.g. also "package" and "resource")
+    @param workers: the number of URLs to probe at once
+    @param cache: an optional ProbeCache; fresh results are reused, and new ones stored
+    @param timeout: the seconds to wait for each server response
+    @returns: a list of results, each the target dict updated with the probe result
+    """
+    def run_one(target):
+        cached = cache.get(target["url"]) if cache is not None else None
+        if cached is not None:
+            return dict(target, cached=True, **{key: cached[key] for key in ("status", "http_status", "seconds", "error")})
+        result = probe(target["url"], timeout)
+        if cache is not None:
+            cache.put(result)
+        if result["status"] != OK:
+            logger.info("%s: %s", target.get("resource", target["url"]), result["error"] or result["status"])
+        return dict(target, cached=False, **result)
+
+    targets = list(targets)
+    logger.info("Probing %d resources", len(targets))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_one, targets))
+    if cache is not None:
+        cache.save()
+    return results
+
+
+def targets_from_packages(packages):
+    """List the resources to probe in a stream of CKAN packages.
+    @param packages: an iterable of CKAN package (dataset) structures
+    @returns: a list of dicts with package, resource and url
+    """
+    return [
+        {"package": package["name"], "resource": resource["name"], "url": resource["url"]}
+        for package in packages for resource in package.get("resources", [])
+        if resource.get("url")
+    ]
+
+
+def report(results, slow=DEFAULT_SLOW, output=None):
+    """Print a report of the empty, erroring and slow resources.
+    @param results: as returned by probe_all()
+    @param slow: the number of seconds above which a resource is reported as slow
+    @param output: the output stream (defaults to stdout)
+    """
+    def label(result):
+        if result.get("package"):
+            return "{} / {}".format(result["package"], result.get("resource"))
+        return result["url"]
+
+    empty = [result for result in results if result["status"] == EMPTY]
+    errors = [result for result in results if result["status"] == ERROR]
+    slowest = sorted(
+        [result for result in results if result["status"] != ERROR and (result["seconds"] or 0) > slow],
+        key=lambda result: -result["seconds"]
+    )
+    print("Probed {} resources: {} ok, {} empty, {} errors, {} slow".format(
+        len(results), len(results) - len(empty) - len(errors), len(empty), len(errors), len(slowest)
+    ), file=output)
+    if empty:
+        print("\nEmpty (no matching records):", file=output)
+        for result in empty:
+            print("  " + label(result), file=output)
+    if errors:
+        print("\nErrors:", file=output)
+        for result in errors:
+            print("  {} [{}] {}".format(label(result), result["http_status"] or "-", result["error"]), file=output)
+    if slowest:
+        print("\nSlow (over {} seconds to the first row):".format(slow), file=output)
+        for result in slowest:
+            print("  {} {:.1f}s".format(label(result), result["seconds"]), file=output)
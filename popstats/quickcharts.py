@@ -0,0 +1,205 @@
+"""Quick Charts configuration for UNHCR datasets.
+
+The model configurations are copied from one hand-configured dataset of
+each type.  They are cached on disk with a hash of each configuration,
+and refreshed with a single package_search call that checks whether any
+model dataset has changed since it was cached.  Datasets whose preview
+flags and Quick Charts view already match the model are skipped without
+any write.
+"""
+
+import hashlib, json, logging, os, time
+from popstats import instrument, writes
+
+logger = logging.getLogger("popstats.quickcharts")
+"""Python logging object"""
+
+VIEW_TYPE = "hdx_hxl_preview"
+"""CKAN view type for Quick Charts"""
+
+MODEL_QUICKCHARTS = [
+    ["refugees-residing", "refugees-residing-jor"],
+    ["refugees-originating", "refugees-originating-mmr"],
+    ["time-series-residing", "unhcr-time-series-residing-syr"],
+    ["time-series-originating", "unhcr-time-series-originating-mli"],
+    ["demographics-residing", "unhcr-demographics-residing-nga"],
+    ["asylum-seekers-determination", "unhcr-asylum-seekers-determination-dnk"],
+    ["asylum-seekers-residing", "unhcr-asylum-seekers-residing-ita"],
+    ["asylum-seekers-originating", "unhcr-asylum-seekers-originating-afg"],
+    ["resettlement-residing", "unhcr-resettlement-residing-can"],
+    ["resettlement-originating", "unhcr-resettlement-originating-syr"],
+]
+"""Datasets containing model Quick Charts configurations to copy to others of the same type"""
+
+PACKAGE_FLAGS = {
+    "dataset_preview": "first_resource",
+    "has_quickcharts": True,
+}
+"""Package fields needed to show Quick Charts"""
+
+DEFAULT_CACHE_PATH = "quickcharts-models.json"
+"""Default location of the on-disk model cache"""
+
+DEFAULT_MAX_AGE = 24 * 60 * 60
+"""Default maximum age of a cached model, in seconds, before reloading it anyway
+(editing a view doesn't change its package's metadata_modified)
+"""
+
+
+def config_hash(config):
+    """Hash a Quick Charts configuration.
+    JSON configurations are compared by content, not formatting.
+    @param config: the hxl_preview_config value (usually a JSON string)
+    @returns: a hex digest
+    """
+    try:
+        canonical = json.dumps(json.loads(config), sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        canonical = str(config)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def find_view(views):
+    """Return the Quick Charts view from a list of resource views, or None."""
+    for view in views:
+        if view["view_type"] == VIEW_TYPE:
+            return view
+    return None
+
+
+class Models(object):
+    """Model Quick Charts configurations, keyed by dataset type."""
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_age=DEFAULT_MAX_AGE):
+        """
+        @param cache_path: the JSON cache file, or None to disable the disk cache
+        @param max_age: the maximum age of a cached model, in seconds
+        """
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.entries = {}
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r") as input:
+                    self.entries = json.load(input)
+            except ValueError:
+                # it is only a cache, so start again (load() fetches and rewrites it)
+                logger.warning("Ignoring unreadable Quick Charts model cache %s", cache_path)
+
+    def config(self, dataset_type):
+        return self.entries[dataset_type]["config"]
+
+    def hash(self, dataset_type):
+        return self.entries[dataset_type]["hash"]
+
+    def load(self, ckan, refresh=False):
+        """Make sure every model configuration is loaded and current.
+        Fetches all of the model datasets in one package_search call, then
+        reads views only for models that are new, changed, or too old.
+        @param ckan: the CKAN API access object
+        @param refresh: if True, reload every model regardless of the cache
+        """
+        names = [entry[1] for entry in MODEL_QUICKCHARTS]
+        result = ckan.call_action("package_search", {
+            "fq": "name:({})".format(" OR ".join('"{}"'.format(name) for name in names)),
+            "rows": len(names),
+        })
+        packages = {package["name"]: package for package in result["results"]}
+        now = time.time()
+        changed = False
+        for dataset_type, name in MODEL_QUICKCHARTS:
+            package = packages.get(name)
+            if package is None:
+                raise Exception("Model dataset {} not found".format(name))
+            cached = self.entries.get(dataset_type)
+            if (not refresh and cached and cached["package"] == name
+                    and cached["metadata_modified"] == package["metadata_modified"]
+                    and now - cached["loaded"] < self.max_age):
+                logger.debug("Using cached Quick Charts configuration for %s", dataset_type)
+                continue
+            resource_id = package["resources"][0]["id"]
+            view = find_view(ckan.call_action("resource_view_list", {"id": resource_id}))
+            if view is None:
+                # Oops! Couldn't find config.
+                raise Exception("Failed to load model configuration for {}".format(dataset_type))
+            self.entries[dataset_type] = {
+                "package": name,
+                "metadata_modified": package["metadata_modified"],
+                "loaded": now,
+                "config": view["hxl_preview_config"],
+                "hash": config_hash(view["hxl_preview_config"]),
+            }
+            changed = True
+            logger.info("Loaded Quick Charts configuration for %s from %s", dataset_type, name)
+        if changed and self.cache_path:
+            self.save()
+        return self
+
+    def save(self):
+        """Write the disk cache atomically, since shards running at once may share it."""
+        temp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        with open(temp_path, "w") as output:
+            json.dump(self.entries, output, indent=1)
+        os.replace(temp_path, self.cache_path)
+
+
+def add_quickcharts(ckan, package, dataset_type, iso3, models, view_index=None):
+    """Add Quick Charts to a dataset after a match, writing only what differs.
+    @param ckan: the CKAN API access object
+    @param package: the CKAN package (dataset) structure
+    @param dataset_type: a string identifying the dataset type (e.g. "refugees-originating")
+    @param iso3: the ISO3 code for the country
+    @param models: the loaded Models
+    @param view_index: an optional dict of resource id -> known Quick Charts view,
+    used instead of resource_view_list
+    @returns: the number of writes made
+    """
+    written = 0
+
+    # Set up the package to preview
+    if writes.patch_package(ckan, package, PACKAGE_FLAGS):
+        written += 1
+
+    # Set the Quick Charts configuration
+    written += update_view(ckan, package, dataset_type, models, view_index)
+    if not written:
+        logger.info("Quick Charts already up to date for %s (skipping)", package["name"])
+    return written
+
+
+def update_view(ckan, package, dataset_type, models, view_index=None):
+    """Create or update the Quick Charts view on a dataset's first resource, if it differs from the model.
+    @param ckan: the CKAN API access object
+    @param package: the CKAN package (dataset) structure
+    @param dataset_type: a string identifying the dataset type (e.g. "refugees-originating")
+    @param models: the loaded Models
+    @param view_index: an optional dict of resource id -> known Quick Charts view,
+    used instead of resource_view_list, and updated with any view written
+    (see popstats.snapshot.Snapshot.put_view_index())
+    @returns: the number of writes made (0 or 1)
+    """
+    resource_id = package["resources"][0]["id"]
+    if view_index is not None and resource_id in view_index:
+        view = view_index[resource_id]
+    else:
+        view = find_view(ckan.call_action("resource_view_list", {"id": resource_id}))
+
+    if view is None:
+        # We need to add the view
+        logger.warning("Missing Quick Charts view for %s (creating)", package["name"])
+        view = ckan.call_action("resource_view_create", {
+            "description": "",
+            "title": "Quick Charts",
+            "resource_id": resource_id,
+            "view_type": VIEW_TYPE,
+            "hxl_preview_config": models.config(dataset_type),
+        })
+    elif config_hash(view.get("hxl_preview_config")) != models.hash(dataset_type):
+        logger.info("Updating Quick Charts for %s", package["name"])
+        view = ckan.call_action("resource_view_update", dict(view, hxl_preview_config=models.config(dataset_type)))
+    else:
+        instrument.record_skip("resource_view_update")
+        return 0
+    if view_index is not None and isinstance(view, dict):
+        view_index[resource_id] = view
+    return 1
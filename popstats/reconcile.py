@@ -0,0 +1,381 @@
+"""Declarative desired-state reconciler for the whole UNHCR catalogue.
+
+Instead of another one-off patch that re-crawls the catalogue to nudge
+one aspect, compute the full desired state of every dataset, resource
+and Quick Charts view from the input tables, SPECS (and the later
+patches recorded in popstats.registry) and the model Quick Charts
+configurations.  Compare it against a snapshot of the catalogue, and
+emit a minimal, ordered plan of create, patch and delete operations that
+only touches what actually differs.  The plan can be printed as a dry
+run, or applied in bulk.
+
+Only the fields listed here are managed; anything else on a dataset is
+left alone.
+"""
+
+import collections, datetime, logging, re
+from popstats import executor, inputs, manifest, quickcharts, registry, writes
+
+logger = logging.getLogger("popstats.reconcile")
+"""Python logging object"""
+
+SITUATIONS = {
+    "residence": "residing",
+    "origin": "originating",
+}
+"""Dataset name situation for each input category"""
+
+MAINTENANCE_FIELDS = {
+    "data_update_frequency": "0", # live
+    "author": "Laurent Pitoiset",
+    "author_email": "pitoiset@unhcr.org",
+    "maintainer": "7ae95211-71dd-484e-8538-2c625315eb56", # David Megginson
+}
+"""Fields set on every dataset by the 2018-08-09 split"""
+
+PARENT_EXTRA_TAGS = ["idps", "migration", "refugees", "returnees", "stateless"]
+"""Tags added to the refugees-* datasets by the 2018-08-09 split"""
+
+PARENT_DATASET_DATE = "01/01/1951-12/31/2025"
+"""Dataset date for the refugees-* datasets (2018-08-09 split)"""
+
+PARENT_NOTES = "Year-by-year data about UNHCR's populations of concern {context} {country}. Populations of concern include refugees, asylum seekers, internally-displaced people (IDPs), returned IDPs, returned refugees, stateless people, and others of concern."
+"""Notes for the refugees-* datasets (2018-12-05 update-concern)"""
+
+RESOURCE_FIELDS = {
+    "url_type": "api",
+    "resource_type": "api",
+}
+"""Fields set on every resource (2019-08-29 fix-metadata)"""
+
+ORDER = [
+    "package_create",
+    "package_patch",
+    "resource_create",
+    "resource_patch",
+    "resource_view_create",
+    "resource_view_update",
+    "resource_delete",
+    "package_delete",
+]
+"""Order in which operations are planned and applied"""
+
+
+class DesiredDataset(object):
+    """The desired state of one dataset."""
+
+    __slots__ = ("name", "dataset_type", "fields", "create_fields", "resources", "view_config")
+
+    def __init__(self, name, dataset_type, fields, create_fields, resources, view_config=None):
+        """
+        @param name: the dataset name
+        @param dataset_type: the type name from popstats.registry
+        @param fields: the managed package fields
+        @param create_fields: extra fields used only when creating the package
+        @param resources: a list of managed resource dicts, matched by name
+        @param view_config: the Quick Charts configuration for the first resource, or None
+        """
+        self.name = name
+        self.dataset_type = dataset_type
+        self.fields = fields
+        self.create_fields = create_fields
+        self.resources = resources
+        self.view_config = view_config
+
+
+class Operation(object):
+    """One step in a reconciliation plan."""
+
+    __slots__ = ("action", "package", "target", "data")
+
+    def __init__(self, action, package, target, data):
+        """
+        @param action: the CKAN action (one of ORDER)
+        @param package: the name of the dataset affected
+        @param target: the resource name affected, if any
+        @param data: the data_dict for the action
+        """
+        self.action = action
+        self.package = package
+        self.target = target
+        self.data = data
+
+    def __str__(self):
+        detail = ""
+        if self.action.endswith("_patch"):
+            detail = " ({})".format(", ".join(sorted(key for key in self.data if key != "id")))
+        return "{:<22} {}{}{}".format(
+            self.action, self.package, " / " + self.target if self.target else "", detail
+        )
+
+
+def _normalise(value):
+    """Normalise a current value for comparison (CKAN may store CRLF line endings)."""
+    if isinstance(value, str):
+        return value.replace("\r\n", "\n")
+    elif isinstance(value, dict):
+        return {key: _normalise(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [_normalise(item) for item in value]
+    else:
+        return value
+
+
+def _diff(current, wanted):
+    return writes.diff(_normalise(current), wanted)
+
+
+def _sorted_tags(names):
+    return [{"name": name} for name in sorted(set(names))]
+
+
+def _spec_for_resource(resource_name):
+    """Find the SPECS entry that split a resource into its own dataset, if any."""
+    for dataset_type in registry.TYPES.values():
+        spec = dataset_type.spec
+        if spec is not None and re.fullmatch(spec["stub_pattern"], resource_name):
+            return dataset_type
+    return None
+
+
+def desired_state(countries, datasets, resources_by_category, creator, models=None, display_names=None):
+    """Compute the desired state of every dataset.
+    @param countries: a list of popstats.inputs.Country records
+    @param datasets: a list of popstats.inputs.Dataset templates
+    @param resources_by_category: the popstats.inputs.Resource templates by category
+    @param creator: the CKAN username to record as package_creator
+    @param models: loaded popstats.quickcharts.Models, or None to leave views alone
+    @param display_names: an optional dict of ISO3 code -> HDX country display name, for notes
+    @returns: an ordered dict of dataset name -> DesiredDataset
+    """
+    result = collections.OrderedDict()
+    display_names = display_names or {}
+
+    def view_config(dataset_type):
+        return models.config(dataset_type) if models is not None else None
+
+    for country in countries:
+        for dataset in datasets:
+            base = inputs.render_package(country, dataset, resources_by_category[dataset.category], creator)
+            situation = SITUATIONS[dataset.category]
+            common = {
+                "license_id": base["license_id"],
+                "methodology": base["methodology"],
+                "dataset_source": base["dataset_source"],
+                "groups": base["groups"],
+            }
+            common.update(MAINTENANCE_FIELDS)
+            if models is not None:
+                common.update(quickcharts.PACKAGE_FLAGS)
+            create_fields = {
+                "owner_org": base["owner_org"],
+                "package_creator": base["package_creator"],
+            }
+
+            parent_resources = []
+            for resource in base["resources"]:
+                resource = dict(resource, **RESOURCE_FIELDS)
+                split_type = _spec_for_resource(resource["name"])
+                if split_type is None:
+                    parent_resources.append(resource)
+                    continue
+                spec = split_type.spec
+                name = split_type.dataset_name(country.stub_code)
+                fields = dict(common)
+                fields.update({
+                    "title": spec["title"].format(country_name=country.full_name),
+                    "notes": spec["notes"],
+                    "caveats": spec["caveats"],
+                    "tags": _sorted_tags(spec["tags"]),
+                    "subnational": "1" if spec["subnational"] else "0",
+                    "dataset_date": "{}-12/31/2025".format(spec["start_date"]),
+                })
+                fields.update(registry.PATCHED_FIELDS.get(split_type.name, {}))
+                result[name] = DesiredDataset(
+                    name, split_type.name, fields, create_fields,
+                    [dict(resource, name=name + ".csv")], view_config(split_type.name)
+                )
+
+            parent_type = "refugees-" + situation
+            fields = dict(common)
+            fields.update({
+                "title": base["title"],
+                "notes": PARENT_NOTES.format(
+                    context="residing in" if situation == "residing" else "originating from",
+                    country=display_names.get(country.stub_code, country.name)
+                ),
+                "caveats": base["caveats"],
+                "tags": _sorted_tags([tag["name"] for tag in base["tags"]] + PARENT_EXTRA_TAGS),
+                "dataset_date": PARENT_DATASET_DATE,
+            })
+            result[base["name"]] = DesiredDataset(
+                base["name"], parent_type, fields, create_fields, parent_resources, view_config(parent_type)
+            )
+    return result
+
+
+def datasets_for_changes(changed, countries, datasets, resources_by_category):
+    """Work out which datasets and resources a set of data changes affects.
+    @param changed: a set of popstats.manifest keys whose content changed
+    @param countries: a list of popstats.inputs.Country records
+    @param datasets: a list of popstats.inputs.Dataset templates
+    @param resources_by_category: the popstats.inputs.Resource templates by category
+    @returns: a dict of dataset name -> set of resource names whose data changed
+    """
+    result = {}
+    for country in countries:
+        for dataset in datasets:
+            for resource in resources_by_category[dataset.category]:
+                if manifest.key(resource.source_url, dataset.category, country.code) not in changed:
+                    continue
+                resource_name = resource.name(country)
+                split_type = _spec_for_resource(resource_name)
+                if split_type is None:
+                    result.setdefault(dataset.stub.format(country.stub_code), set()).add(resource_name)
+                else:
+                    name = split_type.dataset_name(country.stub_code)
+                    result.setdefault(name, set()).add(name + ".csv")
+    return result
+
+
+def display_names_from(packages):
+    """Collect HDX country display names from existing refugees-* packages.
+    @param packages: an iterable of CKAN package structures
+    @returns: a dict of ISO3 code -> display name
+    """
+    result = {}
+    for package in packages:
+        parsed = registry.parse_name(package["name"])
+        if parsed and parsed[0].startswith("refugees-") and package.get("groups"):
+            result[parsed[1]] = package["groups"][0].get("display_name")
+    return result
+
+
+def plan(desired, store, delete=True, data_changed=None):
+    """Compare the desired state against a snapshot and list the operations needed.
+    @param desired: the desired state, from desired_state()
+    @param store: a synced popstats.snapshot.Snapshot (with views, if managing Quick Charts)
+    @param delete: if True, include deletions of unwanted resources and datasets
+    @param data_changed: an optional dict of dataset name -> resource names whose data changed
+    (from datasets_for_changes()); their last_modified is bumped so HDX shows the new data
+    @returns: a list of Operation objects, in ORDER
+    """
+    operations = []
+    data_changed = data_changed or {}
+    modified = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    current_packages = {package["name"]: package for package in store.packages(dataset_type=list(registry.TYPES))}
+
+    for name, want in desired.items():
+        current = current_packages.pop(name, None)
+
+        if current is None:
+            data = dict(want.create_fields, **want.fields)
+            data.update(name=name, resources=want.resources)
+            operations.append(Operation("package_create", name, None, data))
+            if want.view_config is not None and want.resources:
+                operations.append(Operation("resource_view_create", name, want.resources[0]["name"], {
+                    "description": "",
+                    "title": "Quick Charts",
+                    "view_type": quickcharts.VIEW_TYPE,
+                    "hxl_preview_config": want.view_config,
+                }))
+            continue
+
+        changed = _diff(current, want.fields)
+        if changed:
+            operations.append(Operation("package_patch", name, None, dict(changed, id=current["id"])))
+
+        current_resources = collections.OrderedDict((resource["name"], resource) for resource in current["resources"])
+        for resource in want.resources:
+            current_resource = current_resources.pop(resource["name"], None)
+            if current_resource is None:
+                operations.append(Operation("resource_create", name, resource["name"], dict(resource, package_id=current["id"])))
+            else:
+                changed = _diff(current_resource, resource)
+                if resource["name"] in data_changed.get(name, ()):
+                    changed["last_modified"] = modified
+                if changed:
+                    operations.append(Operation(
+                        "resource_patch", name, resource["name"], dict(changed, id=current_resource["id"])
+                    ))
+
+        if want.view_config is not None and want.resources:
+            first = next((r for r in current["resources"] if r["name"] == want.resources[0]["name"]), None)
+            view = quickcharts.find_view(store.views(first["id"])) if first is not None else None
+            if view is None:
+                data = {
+                    "description": "",
+                    "title": "Quick Charts",
+                    "view_type": quickcharts.VIEW_TYPE,
+                    "hxl_preview_config": want.view_config,
+                }
+                if first is not None:
+                    data["resource_id"] = first["id"]
+                operations.append(Operation("resource_view_create", name, want.resources[0]["name"], data))
+            elif quickcharts.config_hash(view.get("hxl_preview_config")) != quickcharts.config_hash(want.view_config):
+                operations.append(Operation(
+                    "resource_view_update", name, want.resources[0]["name"],
+                    dict(view, hxl_preview_config=want.view_config)
+                ))
+
+        if delete:
+            for resource in current_resources.values():
+                operations.append(Operation("resource_delete", name, resource["name"], {"id": resource["id"]}))
+
+    if delete:
+        for name, package in current_packages.items():
+            operations.append(Operation("package_delete", name, None, {"id": package["id"]}))
+
+    operations.sort(key=lambda operation: ORDER.index(operation.action))
+    return operations
+
+
+def print_plan(operations, output=None):
+    """Print a plan as a dry run, with a summary of counts by action."""
+    for operation in operations:
+        print(operation, file=output)
+    counts = collections.Counter(operation.action for operation in operations)
+    print("{} operations: {}".format(
+        len(operations), ", ".join("{} {}".format(counts[action], action) for action in ORDER if counts[action])
+    ), file=output)
+
+
+def _apply_package(ckan, group):
+    """Apply one dataset's operations, in order."""
+    resource_ids = {}
+    for operation in group["operations"]:
+        data = dict(operation.data)
+        if operation.action == "resource_view_create" and "resource_id" not in data:
+            # the resource was created earlier in this plan
+            data["resource_id"] = resource_ids[operation.target]
+        logger.info("%s", operation)
+        result = ckan.call_action(operation.action, data)
+        if operation.action in ("package_create", "resource_create"):
+            for resource in result.get("resources", [result]):
+                resource_ids[resource["name"]] = resource["id"]
+
+
+def apply(ckan, operations, workers=executor.DEFAULT_WORKERS):
+    """Apply a plan in bulk.
+    Each dataset's operations run in order; different datasets run in
+    parallel.  Dataset deletions run last, after everything else.
+    @param ckan: the CKAN API access object
+    @param operations: the plan, from plan()
+    @param workers: the number of datasets to process in parallel
+    @returns: a tuple of (succeeded, failed) dataset counts
+    """
+    groups = collections.OrderedDict()
+    deletions = []
+    for operation in operations:
+        if operation.action == "package_delete":
+            deletions.append({"name": operation.package, "operations": [operation]})
+        else:
+            groups.setdefault(operation.package, {"name": operation.package, "operations": []})["operations"].append(operation)
+    succeeded, failed = executor.PatchExecutor(workers).run(
+        list(groups.values()), lambda group: _apply_package(ckan, group)
+    )
+    if deletions:
+        deleted, not_deleted = executor.PatchExecutor(workers).run(deletions, lambda group: _apply_package(ckan, group))
+        succeeded += deleted
+        failed += not_deleted
+    return (succeeded, failed)
@@ -0,0 +1,209 @@
+"""Known UNHCR PopStats dataset types and how to recognise them by name.
+
+The registry is built from the PATTERNS and SPECS tables.  Dataset names
+are parsed with a single dictionary lookup on the name's prefix rather
+than by trying every pattern in turn, and the same table turns a set of
+target types into a package_search filter query, so that narrow patches
+only fetch the packages they touch.
+"""
+
+import re
+
+PATTERNS = [
+    r"(refugees-residing)-([a-z]{3})",
+    r"(refugees-originating)-([a-z]{3})",
+    r"unhcr-(time-series-residing)-([a-z]{3})",
+    r"unhcr-(time-series-originating)-([a-z]{3})",
+    r"unhcr-(demographics-residing)-([a-z]{3})",
+    r"unhcr-(asylum-seekers-determination)-([a-z]{3})",
+    r"unhcr-(asylum-seekers-residing)-([a-z]{3})",
+    r"unhcr-(asylum-seekers-originating)-([a-z]{3})",
+    r"unhcr-(resettlement-residing)-([a-z]{3})",
+    r"unhcr-(resettlement-originating)-([a-z]{3})",
+]
+"""Regular expressions to match dataset shortnames.
+First group is the type, and second is the ISO3 country code
+"""
+
+SPECS = [
+    {
+        "stub_pattern": r"unhcr_time_series_residence_([a-z]{3}).csv",
+        "title": "Time-series data for UNHCR's populations of concern residing in {country_name}",
+        "name": "unhcr-time-series-residing-{country_code}",
+        "notes": "information about UNHCR's populations of concern for a given year and country of residence. Data is presented as a yearly time series across the page.",
+        "caveats": "In the data for the most-recent year, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['asylum-seekers', 'hxl', 'idps', 'migration', 'refugee', 'refugees', 'returnees', 'stateless'],
+        "url": "http://popstats.unhcr.org/en/time_series",
+        "subnational": False,
+        "start_date": "01/01/1951",
+    },
+    {
+        "stub_pattern": r"unhcr_demographics_residence_([a-z]{3}).csv",
+        "title": "Demographics for UNHCR's populations of concern residing in {country_name}",
+        "name": "unhcr-demographics-residing-{country_code}",
+        "notes": "Information about persons of concern broken down by sex and age, as well as by location within the country of residence (where such information is available). Such data is available since 2000.",
+        "caveats": "Note that data broken down in this way is not always available, so it may not be possible to reconcile the figures on this page with those on the Persons of Concern and Time Series pages. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['hxl', 'migration', 'refugee', 'refugees', 'sadd'],
+        "url": "http://popstats.unhcr.org/en/demographics",
+        "subnational": True,
+        "start_date": "01/01/2005",
+    },
+    {
+        "stub_pattern": r"unhcr_asylum_seekers_residence_([a-z]{3}).csv",
+        "title": "Refugee status determinations for asylum seekers in {country_name}",
+        "name": "unhcr-asylum-seekers-determination-{country_code}",
+        "notes": "Information about asylum applications in a given year and the progress of asylum-seekers through the refugee status determination process.",
+        "caveats": "Data is available from 2000. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['asylum-seekers', 'hxl', 'migration'],
+        "url": "http://popstats.unhcr.org/en/asylum_seekers",
+        "subnational": False,
+        "start_date": "01/01/2000",
+    },
+    {
+        "stub_pattern": r"unhcr_asylum_seekers_monthly_residence_([a-z]{3}).csv",
+        "title": "Monthly data on asylum seekers residing in {country_name}",
+        "name": "unhcr-asylum-seekers-residing-{country_code}",
+        "notes": "Information about asylum applications lodged in 38 European and 6 non-European countries. Data are broken down by month and origin. Where possible, figures exclude repeat/re-opened asylum applications and applications lodged on appeal or with courts. For some countries, the monthly data are available since 1999 while for others at a later period.",
+        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Due to retroactive adjustments implemented by States, totals in this dataset may differ from annual totals published by the competent national authorities. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['asylum-seekers', 'hxl', 'migration', 'refugee', 'refugees'],
+        "url": "http://popstats.unhcr.org/en/asylum_seekers_monthly",
+        "subnational": False,
+        "start_date": "01/01/1999",
+    },
+    {
+        "stub_pattern": r"unhcr_resettlement_residence_([a-z]{3}).csv",
+        "title": "Resettlement arrivals of refugees in {country_name}",
+        "name": "unhcr-resettlement-residing-{country_code}",
+        "notes": "This page presents information on resettlement arrivals of refugees, with or without UNHCR assistance. This dataset is based on Government statistics and, in principle, excludes humanitarian admissions.",
+        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['hxl', 'migration', 'refugee', 'refugees', 'resettlement'],
+        "url": "http://popstats.unhcr.org/en/resettlement",
+        "subnational": False,
+        "start_date": "01/01/1959",
+    },
+    {
+        "stub_pattern": r"unhcr_time_series_origin_([a-z]{3}).csv",
+        "title": "Time-series data for UNHCR's populations of concern originating from {country_name}",
+        "name": "unhcr-time-series-originating-{country_code}",
+        "notes": "information about UNHCR's populations of concern for a given year and country of origin. Data is presented as a yearly time series across the page.",
+        "caveats": "In the data for the most-recent year, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['asylum-seekers', 'hxl', 'idps', 'migration', 'refugee', 'refugees', 'returnees', 'stateless'],
+        "url": "http://popstats.unhcr.org/en/time_series",
+        "subnational": False,
+        "start_date": "01/01/1951",
+    },
+    {
+        "stub_pattern": r"unhcr_asylum_seekers_monthly_origin_([a-z]{3}).csv",
+        "title": "Monthly data on asylum seekers originating from {country_name}",
+        "name": "unhcr-asylum-seekers-originating-{country_code}",
+        "notes": "Information about asylum applications lodged in 38 European and 6 non-European countries. Data are broken down by month and origin. Where possible, figures exclude repeat/re-opened asylum applications and applications lodged on appeal or with courts. For some countries, the monthly data are available since 1999 while for others at a later period.",
+        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Due to retroactive adjustments implemented by States, totals in this dataset may differ from annual totals published by the competent national authorities. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['asylum-seekers', 'hxl', 'migration', 'refugee', 'refugees'],
+        "url": "http://popstats.unhcr.org/en/asylum_seekers_monthly",
+        "subnational": False,
+        "start_date": "01/01/1999",
+    },
+    {
+        "stub_pattern": r"unhcr_resettlement_origin_([a-z]{3}).csv",
+        "title": "Resettlement arrivals of refugees originating from {country_name}",
+        "name": "unhcr-resettlement-originating-{country_code}",
+        "notes": "This page presents information on resettlement arrivals of refugees, with or without UNHCR assistance. This dataset is based on Government statistics and, in principle, excludes humanitarian admissions.",
+        "caveats": "In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where the figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.",
+        "tags": ['hxl', 'migration', 'refugee', 'refugees', 'resettlement'],
+        "url": "http://popstats.unhcr.org/en/resettlement",
+        "subnational": False,
+        "start_date": "01/01/1959",
+    },
+]
+"""Specifications for the single-resource datasets split out of the
+refugees-residing-* and refugees-originating-* datasets on 2018-08-09
+"""
+
+PATCHED_FIELDS = {
+    "asylum-seekers-determination": {
+        "caveats": """Data is available from 2000. In the most-recent data, figures between 1 and 4 have been replaced with an asterisk (*). These represent situations where figures are being kept confidential to protect the anonymity of individuals. Such figures are not included in any totals. Due to retroactive adjustments implemented by States, totals in this dataset may differ from annual totals published by the competent national authorities. Dataset may be empty if the UNHCR dataset does not currently contain any matching records.""",
+    },
+}
+"""Package fields changed by later patches, keyed by dataset type
+(the caveats were replaced on 2019-10-09 at UNHCR's request)
+"""
+
+ORGANIZATION = "unhcr"
+"""CKAN organisation that owns the datasets"""
+
+ISO3_PATTERN = re.compile(r"[a-z]{3}")
+"""Precompiled pattern for the country part of a dataset name"""
+
+
+class DatasetType(object):
+    """A known type of UNHCR dataset."""
+
+    __slots__ = ("name", "prefix", "spec")
+
+    def __init__(self, name, prefix, spec=None):
+        """
+        @param name: the type name (e.g. "time-series-residing")
+        @param prefix: the dataset name without the ISO3 code (e.g. "unhcr-time-series-residing")
+        @param spec: the matching entry from SPECS, if any
+        """
+        self.name = name
+        self.prefix = prefix
+        self.spec = spec
+
+    def dataset_name(self, iso3):
+        """Return the dataset name for a country."""
+        return "{}-{}".format(self.prefix, iso3.lower())
+
+
+def _build_types():
+    """Build the registry from PATTERNS and SPECS."""
+    types = {}
+    for pattern in PATTERNS:
+        m = re.fullmatch(r"(.*)\((.+)\)-\(\[a-z\]\{3\}\)", pattern)
+        types[m.group(2)] = DatasetType(m.group(2), m.group(1) + m.group(2))
+    by_prefix = {dataset_type.prefix: dataset_type for dataset_type in types.values()}
+    for spec in SPECS:
+        by_prefix[spec["name"].format(country_code="")[:-1]].spec = spec
+    return types, by_prefix
+
+TYPES, TYPES_BY_PREFIX = _build_types()
+"""Known dataset types, keyed by type name and by dataset name prefix"""
+
+
+def parse_name(name):
+    """Extract the dataset type and ISO3 code from a dataset shortname.
+    @param name: the dataset shortname (e.g. "unhcr-time-series-residing-syr")
+    @returns: a tuple of (dataset_type, iso3), or None if the name doesn't match
+    """
+    prefix, _, iso3 = name.rpartition("-")
+    dataset_type = TYPES_BY_PREFIX.get(prefix)
+    if dataset_type is not None and ISO3_PATTERN.fullmatch(iso3):
+        return (dataset_type.name, iso3)
+    return None
+
+
+def solr_escape(s):
+    """Escape Solr query syntax characters in a term."""
+    return re.sub(r'([+\-&|!(){}\[\]^"~*?:\\/ ])', r"\\\1", s)
+
+
+def search_fq(types=None, iso3=None, organization=ORGANIZATION):
+    """Build a package_search filter query for some dataset types.
+    @param types: a list of type names (e.g. ["asylum-seekers-determination"]), or None for all known types
+    @param iso3: a lowercase ISO3 code to restrict to a single country, a list of codes, or None for all
+    @param organization: the owning organisation
+    @returns: a Solr filter query string
+    """
+    fq = "organization:{}".format(organization)
+    if types is None:
+        types = list(TYPES)
+    if isinstance(iso3, str):
+        iso3 = [iso3]
+    terms = []
+    for type_name in types:
+        dataset_type = TYPES[type_name]
+        if iso3 is None:
+            terms.append(solr_escape(dataset_type.prefix + "-") + "*")
+        else:
+            terms.extend(solr_escape(dataset_type.dataset_name(code)) for code in iso3)
+    return "{} AND name:({})".format(fq, " OR ".join(terms))
@@ -0,0 +1,61 @@
+"""Pooled keep-alive HTTP sessions for CKAN API traffic.
+
+Every client shares one requests session, whose connection pool is
+sized to the number of worker threads, so connections (and their TLS
+handshakes) are reused across calls instead of being set up for each
+one.  Responses are requested gzip-compressed, and every request gets
+connect and read timeouts unless the caller sets its own.
+"""
+
+import requests, requests.adapters
+
+DEFAULT_POOL_SIZE = 10
+"""Default number of keep-alive connections to keep per host"""
+
+DEFAULT_CONNECT_TIMEOUT = 10
+"""Default seconds to wait for a connection to the server"""
+
+DEFAULT_READ_TIMEOUT = 120
+"""Default seconds to wait between bytes of a response (package_search pages can be slow)"""
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter that applies default timeouts to every request."""
+
+    def __init__(self, timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), **kwargs):
+        """
+        @param timeout: a tuple of (connect, read) timeouts in seconds
+        """
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, hooks=()):
+    """Create a pooled, compressed HTTP session with default timeouts.
+    Retries are left to popstats.client, which knows which calls are safe
+    to repeat, so the adapter itself never retries.
+    @param pool_size: the number of keep-alive connections per host (at least the number of threads)
+    @param connect_timeout: seconds to wait for a connection
+    @param read_timeout: seconds to wait between bytes of a response
+    @param hooks: response hooks to add to the session
+    @returns: a requests.Session
+    """
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(
+        timeout=(connect_timeout, read_timeout),
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=0,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.headers["Connection"] = "keep-alive"
+    for hook in hooks:
+        session.hooks["response"].append(hook)
+    return session
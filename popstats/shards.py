@@ -0,0 +1,258 @@
+"""Deterministic sharding of the patch scripts across processes or hosts.
+
+A single process spends much of a heavy run encoding and decoding large
+package structures, which threads can't spread across cores.  Every
+patch script therefore accepts --shard i/N (0 <= i < N), and only
+fetches and processes the packages whose ISO3 code falls in shard i, by
+the CRC-32 of the code modulo N.  The shard lists just the package names
+(a small response), works out which countries are its own, and asks
+package_search for the full packages of those countries only, so the
+heavy decoding is split N ways rather than repeated N times.  With a
+snapshot, it reads only its own countries' rows.  The assignment
+depends only on the name, so N copies of a script, started on one
+machine or several with the same N, cover every package exactly once
+with no coordination between them.  All of a country's datasets land in
+the same shard.
+
+A shard gets its share of max_rate from config.py, so N shards together
+stay under the same ceiling, and its own profile, trace and cache files
+(with the shard in the name).  The snapshot and journal files can be
+shared.
+
+launch() (and run-shards.py) starts the N shards of a script locally,
+merges their output with each line prefixed by its shard, adds up their
+results, and starts any shard that failed again.
+"""
+
+import argparse, json, logging, os, subprocess, sys, tempfile, threading, zlib
+from popstats import client, registry
+
+logger = logging.getLogger("popstats.shards")
+"""Python logging object"""
+
+DEFAULT_RETRIES = 2
+"""Default number of times a failed shard is started again"""
+
+SHARDED_FILES = ("profile", "trace", "cache")
+"""config.py keys for files that each shard needs its own copy of"""
+
+MAX_QUERY_TERMS = 200
+"""Maximum number of dataset names in one package_search filter query"""
+
+
+class Shard(object):
+    """One of N disjoint parts of the catalogue."""
+
+    __slots__ = ("index", "count")
+
+    def __init__(self, index, count):
+        """
+        @param index: the shard number, from 0 to count - 1
+        @param count: the total number of shards
+        """
+        if count < 1 or not 0 <= index < count:
+            raise Exception("Bad shard {}/{}: need 0 <= i < N".format(index, count))
+        self.index = index
+        self.count = count
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
+
+    def owns(self, name):
+        """Test whether a package belongs to this shard.
+        Names that don't parse (see popstats.registry) are assigned by
+        the whole name.
+        @param name: the package name
+        """
+        parsed = registry.parse_name(name)
+        return shard_of(parsed[1] if parsed is not None else name, self.count) == self.index
+
+    def codes(self, iso3_codes):
+        """Pick out this shard's ISO3 codes.
+        @param iso3_codes: an iterable of lowercase ISO3 codes
+        @returns: a sorted list of the distinct codes in this shard
+        """
+        return sorted(code for code in set(iso3_codes) if shard_of(code, self.count) == self.index)
+
+
+def shard_of(key, count):
+    """Assign an ISO3 code (or other key) to a shard.
+    @param key: the lowercase ISO3 code
+    @param count: the number of shards
+    @returns: the shard number, from 0 to count - 1
+    """
+    return zlib.crc32(key.lower().encode("utf-8")) % count
+
+
+def parse_shard(spec):
+    """Parse a shard specification like "2/8".
+    @returns: a Shard
+    """
+    index, sep, count = spec.partition("/")
+    try:
+        return Shard(int(index), int(count))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected i/N, not {!r}".format(spec))
+    except Exception as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def crawl(ckan, shard, types=None, fl=None):
+    """Stream a shard's packages from package_search.
+    @param ckan: the CKAN API access object
+    @param shard: the Shard, or None for all packages
+    @param types: a list of dataset type names (see popstats.registry), or None for all known types
+    @param fl: a list of the only fields needed from each package, or None for full packages
+    @returns: an iterable of CKAN package structures
+    """
+    if shard is None:
+        return client.packages(ckan, fq=registry.search_fq(types), fl=fl)
+    names = client.packages(ckan, fq=registry.search_fq(types), rows=1000, fl=["name"])
+    codes = shard.codes(parsed[1] for parsed in (registry.parse_name(package["name"]) for package in names) if parsed)
+    logger.info("Shard %s has %d countries", shard, len(codes))
+    batch = max(1, MAX_QUERY_TERMS // len(types if types is not None else registry.TYPES))
+    return _crawl_batches(ckan, types, fl, [codes[n:n + batch] for n in range(0, len(codes), batch)])
+
+
+def _crawl_batches(ckan, types, fl, batches):
+    for codes in batches:
+        for package in client.packages(ckan, fq=registry.search_fq(types, iso3=codes), fl=fl):
+            yield package
+
+
+def stored(store, shard, types=None):
+    """Read a shard's packages from a synced popstats.snapshot.Snapshot.
+    @param store: the Snapshot
+    @param shard: the Shard, or None for all packages
+    @param types: a list of dataset type names, or None for all known types
+    @returns: an iterable of CKAN package structures
+    """
+    types = types if types is not None else list(registry.TYPES)
+    if shard is None:
+        return store.packages(dataset_type=types)
+    codes = shard.codes(store.iso3_codes())
+    return store.packages(dataset_type=types, iso3=codes) if codes else iter(())
+
+
+def shard_path(path, shard):
+    """Insert the shard into a file name (e.g. run-profile.json -> run-profile.2-of-8.json)."""
+    root, ext = os.path.splitext(path)
+    return "{}.{}-of-{}{}".format(root, shard.index, shard.count, ext)
+
+
+def shard_config(config, shard):
+    """Adapt the settings in config.py for one shard.
+    @param config: the CONFIG dict
+    @param shard: the Shard, or None for an unsharded run
+    @returns: a copy of config with the shard's share of max_rate and its own files
+    """
+    if shard is None:
+        return config
+    config = dict(config)
+    config['max_rate'] = (config.get('max_rate') or client.DEFAULT_MAX_RATE) / shard.count
+    for key in SHARDED_FILES:
+        if isinstance(config.get(key), str) and config[key]: # not e.g. cache = True, which is memory only
+            config[key] = shard_path(config[key], shard)
+    return config
+
+
+def argument_parser(description):
+    """Create a command-line parser with the --shard and --shard-result options.
+    @param description: the script's description
+    @returns: an argparse.ArgumentParser, for the script to add any other options to
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--shard", type=parse_shard, help="process only shard i of N (e.g. 0/4)")
+    parser.add_argument("--shard-result", metavar="FILE", help="write the shard's counts to this JSON file (used by run-shards.py)")
+    return parser
+
+
+def finish(args, result):
+    """Report a script's result and exit, with a non-zero status if any package failed.
+    @param args: the parsed arguments from argument_parser()
+    @param result: the (succeeded, failed) counts from popstats.executor.PatchExecutor.run()
+    """
+    succeeded, failed = result
+    if args.shard_result:
+        with open(args.shard_result, "w", encoding="utf-8") as output:
+            json.dump({"shard": str(args.shard), "succeeded": succeeded, "failed": failed}, output)
+    sys.exit(1 if failed else 0)
+
+
+class _Worker(object):
+    """One running shard, with its output copied to ours line by line."""
+
+    def __init__(self, script, shard, args, result_path, output_lock):
+        self.shard = shard
+        self.result_path = result_path
+        self.process = subprocess.Popen(
+            [sys.executable, script, "--shard", str(shard), "--shard-result", result_path] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        )
+        self._output_lock = output_lock
+        self._copier = threading.Thread(target=self._copy_output, daemon=True)
+        self._copier.start()
+
+    def _copy_output(self):
+        prefix = "[{}] ".format(self.shard).encode("utf-8")
+        for line in self.process.stdout:
+            with self._output_lock:
+                sys.stdout.buffer.write(prefix + line)
+                sys.stdout.flush()
+
+    def wait(self):
+        """Wait for the shard to exit.
+        @returns: its result dict, with "failed" set to None if it didn't report one
+        """
+        status = self.process.wait()
+        self._copier.join()
+        try:
+            with open(self.result_path, "r", encoding="utf-8") as input:
+                result = json.load(input)
+        except (OSError, ValueError):
+            result = {"shard": str(self.shard), "succeeded": 0, "failed": None}
+        result["status"] = status
+        return result
+
+
+def launch(script, count, args=(), retries=DEFAULT_RETRIES):
+    """Run all the shards of a patch script as local processes.
+    A shard that exits with an error (failed packages, or a crash) is
+    started again, up to retries times; with a journal in config.py, the
+    restarted shard skips the packages it already finished.
+    @param script: the patch script (e.g. "20190829-fix-metadata.py")
+    @param count: the number of shards (and processes)
+    @param args: any other arguments for the script
+    @param retries: how many times to restart a failed shard
+    @returns: a dict of the "succeeded" and "failed" package counts (from
+    each shard's last attempt), and the "failed_shards" still failing
+    """
+    output_lock = threading.Lock()
+    pending = [Shard(index, count) for index in range(count)]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="shards-") as results_dir:
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                logger.warning("Restarting %d failed shard(s): %s", len(pending), ", ".join(str(shard) for shard in pending))
+            workers = [
+                _Worker(script, shard, args, os.path.join(results_dir, "{}-{}.json".format(shard.index, attempt)), output_lock)
+                for shard in pending
+            ]
+            pending = []
+            for worker in workers:
+                result = results[worker.shard.index] = worker.wait()
+                if result["status"] != 0:
+                    logger.warning("Shard %s exited with status %d", worker.shard, result["status"])
+                    pending.append(worker.shard)
+            if not pending:
+                break
+    totals = {
+        "succeeded": sum(result["succeeded"] for result in results.values()),
+        "failed": sum(result["failed"] or 0 for result in results.values()),
+        "failed_shards": [str(shard) for shard in pending],
+    }
+    logger.info(
+        "All shards finished: %d succeeded, %d failed, %d shard(s) still failing",
+        totals["succeeded"], totals["failed"], len(pending)
+    )
+    return totals
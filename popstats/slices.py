@@ -0,0 +1,327 @@
+"""Indexed HXL slice server for the published resource URLs.
+
+Every resource URL is an HXL Proxy request of the form
+
+    /data.csv?url=SOURCE&filter01=select&select-query01-01=PATTERN=COUNTRY
+             [&filter02=rename&rename-oldtag02=OLD&rename-newtag02=NEW ...]
+
+so each preview, Quick Charts render and download makes the public proxy
+fetch and filter a whole UNHCR source again.  This server answers the
+same URL grammar from an in-memory copy of each source.  The first
+request for a (pattern, renames) pair indexes the source by the value of
+the matching country column(s), with every slice serialised to CSV once;
+after that, a request is a dictionary lookup.  Responses carry an ETag
+(and are gzipped if the client accepts it), so unchanged slices cost a
+304.  The sources are refreshed on a schedule with conditional requests,
+and an index is only rebuilt when its source has changed.
+
+Only the sources in the resources table are served.  Set 'proxy' in
+config.py to point the resource URLs here (see popstats.inputs.Resource).
+"""
+
+import csv, email.utils, gzip, hashlib, http.server, io, logging, os, re, threading, time, urllib.error, urllib.parse, urllib.request
+from popstats import partition
+
+logger = logging.getLogger("popstats.slices")
+"""Python logging object"""
+
+DEFAULT_PORT = 8090
+"""Default port to listen on"""
+
+DEFAULT_REFRESH = 6 * 60 * 60
+"""Default seconds between source refreshes"""
+
+SOURCE_TIMEOUT = 300
+"""Seconds to wait for a UNHCR source to respond"""
+
+
+class BadRequest(Exception):
+    """A request outside the supported subset of the HXL Proxy URL grammar."""
+
+
+def parse_query(query):
+    """Parse the HXL Proxy query string of a resource URL.
+    Supports a single select query, optionally followed by rename filters,
+    which is all the resource URLs use.
+    @param query: the URL query string
+    @returns: a tuple of (source URL, tag pattern, value, renames), where
+    renames is a tuple of (old pattern, new tagspec) pairs
+    @raises BadRequest: if the query uses anything else
+    """
+    params = urllib.parse.parse_qs(query, keep_blank_values=True)
+    if set(len(values) for values in params.values()) - {1}:
+        raise BadRequest("Repeated parameters are not supported")
+    params = {key: values[0] for key, values in params.items()}
+    source_url = params.pop("url", None)
+    if not source_url:
+        raise BadRequest("No url parameter")
+    if params.pop("filter01", None) != "select" or "select-query01-01" not in params:
+        raise BadRequest("The first filter must be a select with one query")
+    pattern, sep, value = params.pop("select-query01-01").partition("=")
+    if not sep or not pattern.startswith("#"):
+        raise BadRequest("Unsupported select query")
+    renames = []
+    n = 2
+    while "filter{:02d}".format(n) in params:
+        if params.pop("filter{:02d}".format(n)) != "rename":
+            raise BadRequest("Only rename filters may follow the select")
+        old = params.pop("rename-oldtag{:02d}".format(n), "")
+        new = params.pop("rename-newtag{:02d}".format(n), "")
+        if not old or not new:
+            raise BadRequest("Incomplete rename filter {}".format(n))
+        renames.append(("#" + old.lstrip("#"), "#" + new.lstrip("#")))
+        n += 1
+    params.pop("force", None) # cache-busting parameter; slices are always current
+    if params:
+        raise BadRequest("Unsupported parameters: {}".format(", ".join(sorted(params))))
+    return (source_url, pattern, value, tuple(renames))
+
+
+class Slice(object):
+    """One pre-serialised CSV response."""
+
+    __slots__ = ("body", "etag", "_gzipped")
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, 6)
+        return self._gzipped
+
+
+def _serialise(rows):
+    output = io.StringIO()
+    csv.writer(output).writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+
+class SourceIndex(object):
+    """An in-memory copy of one source, with lazily built country indexes."""
+
+    def __init__(self, source_url, text, validators):
+        """
+        @param source_url: the source URL
+        @param text: the whole source as text
+        @param validators: a dict of "etag", "last_modified" and "mtime" for the next refresh
+        """
+        self.source_url = source_url
+        self.validators = validators
+        self.loaded = time.time()
+        self.text_headers = None
+        self.hashtags = None
+        reader = csv.reader(io.StringIO(text, newline=""))
+        for row in reader:
+            if partition.is_hashtag_row(row):
+                self.hashtags = row
+                break
+            self.text_headers = row
+        if self.hashtags is None:
+            raise Exception("No HXL hashtag row found in {}".format(source_url))
+        self.rows = list(reader)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, source_url, source, previous=None):
+        """Load a source, unless it is unchanged since the previous load.
+        @param source_url: the source URL
+        @param source: the URL or local file to read it from
+        @param previous: the SourceIndex from the last load, if any
+        @returns: a new SourceIndex, or None if the source hasn't changed
+        """
+        validators = previous.validators if previous is not None else {}
+        if not re.match(r"^https?:", source):
+            mtime = os.path.getmtime(source)
+            if mtime == validators.get("mtime"):
+                return None
+            with open(source, "r", encoding="utf-8", newline="") as input:
+                return cls(source_url, input.read(), {"mtime": mtime})
+        request = urllib.request.Request(source)
+        if validators.get("etag"):
+            request.add_header("If-None-Match", validators["etag"])
+        if validators.get("last_modified"):
+            request.add_header("If-Modified-Since", validators["last_modified"])
+        try:
+            with urllib.request.urlopen(request, timeout=SOURCE_TIMEOUT) as response:
+                return cls(source_url, response.read().decode("utf-8"), {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                })
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+    def header_rows(self, renames):
+        """Build the header rows as the proxy would return them after the renames."""
+        hashtags = []
+        for tagspec in self.hashtags:
+            for old, new in renames:
+                if tagspec and partition.pattern_matches(old, tagspec):
+                    tagspec = new
+                    break
+            hashtags.append(partition.display_tagspec(tagspec))
+        return [self.text_headers, hashtags] if self.text_headers is not None else [hashtags]
+
+    def index(self, pattern, renames=()):
+        """Get (building it if needed) the slices for a pattern, keyed by normalised value.
+        @returns: a tuple of (dict of value -> Slice, Slice for values with no rows)
+        """
+        key = (pattern, renames)
+        index = self._indexes.get(key)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                start = time.monotonic()
+                header_rows = self.header_rows(renames)
+                columns = [i for i, tagspec in enumerate(self.hashtags) if tagspec and partition.pattern_matches(pattern, tagspec)]
+                rows_by_value = {}
+                for row in self.rows:
+                    seen = set()
+                    for i in columns:
+                        if i < len(row):
+                            value = partition.normalise_string(row[i])
+                            if value not in seen:
+                                seen.add(value)
+                                rows_by_value.setdefault(value, []).append(row)
+                index = (
+                    {value: Slice(_serialise(header_rows + rows)) for value, rows in rows_by_value.items()},
+                    Slice(_serialise(header_rows)),
+                )
+                self._indexes[key] = index
+                logger.info("Indexed %s by %s: %d values in %.1f seconds", self.source_url, pattern, len(index[0]), time.monotonic() - start)
+        return index
+
+    def slice(self, pattern, value, renames=()):
+        """Look up the rows whose pattern column(s) equal a value, as the proxy's select does."""
+        slices, empty = self.index(pattern, renames)
+        return slices.get(partition.normalise_string(value), empty)
+
+
+class SliceServer(http.server.ThreadingHTTPServer):
+    """Threaded HTTP server answering HXL Proxy select URLs from SourceIndex copies."""
+
+    daemon_threads = True
+
+    def __init__(self, address, sources, refresh=DEFAULT_REFRESH):
+        """
+        @param address: the (host, port) to listen on (port 0 for any free port)
+        @param sources: a dict of each source URL to serve -> the URL or local file to load it from
+        @param refresh: the seconds between source refreshes
+        """
+        super().__init__(address, SliceHandler)
+        self.sources = sources
+        self.refresh_interval = refresh
+        self.indexes = {}
+        self._stop = threading.Event()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def refresh(self):
+        """Reload every source that has changed; a failed reload keeps the old copy."""
+        for source_url, source in self.sources.items():
+            try:
+                index = SourceIndex.load(source_url, source, self.indexes.get(source_url))
+            except Exception:
+                logger.exception("Can't refresh %s", source_url)
+                continue
+            if index is None:
+                logger.info("%s unchanged", source_url)
+            else:
+                self.indexes[source_url] = index # replaced whole, so requests in flight keep a consistent copy
+                logger.info("Loaded %s (%d rows)", source_url, len(index.rows))
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def start(self):
+        """Load the sources, then serve and refresh in background threads."""
+        self.refresh()
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self._stop.set()
+        super().shutdown()
+
+
+class SliceHandler(http.server.BaseHTTPRequestHandler):
+    """Handler for /data.csv requests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_text(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/data.csv":
+            return self.send_text(404, "Not found")
+        try:
+            source_url, pattern, value, renames = parse_query(url.query)
+        except BadRequest as e:
+            return self.send_text(400, str(e))
+        index = self.server.indexes.get(source_url)
+        if index is None:
+            return self.send_text(404, "Source not served here: {}".format(source_url))
+        result = index.slice(pattern, value, renames)
+
+        headers = {
+            "ETag": result.etag,
+            "Last-Modified": email.utils.formatdate(index.loaded, usegmt=True),
+            "Cache-Control": "public, max-age=300",
+            "Vary": "Accept-Encoding",
+        }
+        if result.etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            for name, header in headers.items():
+                self.send_header(name, header)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = result.body
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = result.gzipped
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv;charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, header in headers.items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(resources_by_category, port=DEFAULT_PORT, host="", refresh=DEFAULT_REFRESH, sources=None):
+    """Start a slice server for every source in the resources table.
+    @param resources_by_category: as returned by popstats.inputs.compile_inputs()
+    @param port: the port to listen on
+    @param host: the address to listen on ("" for all)
+    @param refresh: the seconds between source refreshes
+    @param sources: an optional dict mapping source URLs to local copies
+    @returns: the running SliceServer
+    """
+    served = {
+        source_url: (sources or {}).get(source_url, source_url)
+        for source_url in partition.routes_by_source(resources_by_category)
+    }
+    return SliceServer((host, port), served, refresh).start()
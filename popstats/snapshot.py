@@ -0,0 +1,318 @@
+"""Local incremental snapshot of the UNHCR organisation's packages.
+
+Packages (and, optionally, their resource views) are kept in a SQLite
+file keyed by package id and name.  A sync fetches only the packages
+whose metadata_modified is newer than the last sync, plus a cheap
+id-only listing to drop packages that have gone away, so a typical patch
+run reads a small delta from the API instead of the whole catalogue.
+
+Usage:
+
+    store = snapshot.Snapshot("unhcr-snapshot.sqlite")
+    store.sync(ckan)
+    for package in store.packages(dataset_type="time-series-residing"):
+        ...
+"""
+
+import json, logging, sqlite3, time
+from popstats import client, registry, shards
+
+logger = logging.getLogger("popstats.snapshot")
+"""Python logging object"""
+
+DEFAULT_PATH = "unhcr-snapshot.sqlite"
+"""Default location of the snapshot file"""
+
+DEFAULT_FQ = "organization:unhcr"
+"""Default filter query for the packages to snapshot"""
+
+VIEW_TTL = 24 * 60 * 60
+"""Seconds between refreshes of every stored view (view writes don't change
+metadata_modified, so views edited on HDX are only seen by a full refresh)"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    id TEXT PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    dataset_type TEXT,
+    iso3 TEXT,
+    metadata_modified TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_type ON packages (dataset_type, iso3);
+CREATE INDEX IF NOT EXISTS packages_iso3 ON packages (iso3);
+CREATE TABLE IF NOT EXISTS views (
+    id TEXT PRIMARY KEY,
+    resource_id TEXT NOT NULL,
+    package_id TEXT NOT NULL,
+    view_type TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS views_resource ON views (resource_id);
+CREATE INDEX IF NOT EXISTS views_package ON views (package_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+"""SQLite schema for the snapshot file"""
+
+
+def solr_date(timestamp):
+    """Convert a CKAN timestamp to a Solr date for a range query.
+    @param timestamp: a CKAN timestamp, e.g. "2018-08-09T22:28:46.422522"
+    @returns: a Solr date, e.g. "2018-08-09T22:28:46.422Z"
+    """
+    date, _, fraction = timestamp.rstrip("Z").partition(".")
+    return "{}.{}Z".format(date, (fraction + "000")[:3])
+
+
+class Snapshot(object):
+    """A local copy of the packages matching a filter query."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        @param path: the SQLite file to use (created if it doesn't exist)
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    #
+    # Synchronisation
+    #
+
+    def sync(self, ckan, fq=DEFAULT_FQ, views=False, prune=True, view_ttl=VIEW_TTL):
+        """Bring the snapshot up to date with the CKAN instance.
+        @param ckan: the CKAN API access object
+        @param fq: the filter query for the packages to keep
+        @param views: if True, also refresh the resource views of changed packages
+        (or of every package, the first time views are requested and every view_ttl seconds after)
+        @param prune: if True, drop local packages that no longer match the query
+        @param view_ttl: the seconds between refreshes of every stored view
+        @returns: the number of packages fetched
+        """
+        last_sync = self.get_meta("last_sync:" + fq)
+        query = fq
+        if last_sync:
+            query = "{} AND metadata_modified:[{} TO *]".format(fq, solr_date(last_sync))
+            logger.info("Syncing packages modified since %s", last_sync)
+        else:
+            logger.info("No previous sync for %s; fetching all packages", fq)
+
+        views_refreshed = float(self.get_meta("views:" + fq) or 0) # a time since the epoch
+        all_views = views and time.time() - views_refreshed > view_ttl
+        count = 0
+        newest = last_sync
+        for package in client.packages(ckan, fq=query):
+            self.put_package(package)
+            if views and not all_views:
+                self.refresh_views(ckan, package)
+            if newest is None or package["metadata_modified"] > newest:
+                newest = package["metadata_modified"]
+            count += 1
+        logger.info("Fetched %d new or changed packages", count)
+
+        if prune and last_sync:
+            self.prune(ckan, fq)
+        if all_views:
+            # views weren't kept before, or may have been edited without changing their package
+            logger.info("Fetching resource views for all packages")
+            for package in list(self.packages()):
+                self.refresh_views(ckan, package)
+            self.set_meta("views:" + fq, str(time.time()))
+        if newest:
+            self.set_meta("last_sync:" + fq, newest)
+        self.db.commit()
+        return count
+
+    def prune(self, ckan, fq=DEFAULT_FQ):
+        """Drop local packages that are no longer returned by the query.
+        Only package ids are transferred.
+        @param ckan: the CKAN API access object
+        @param fq: the filter query for the packages to keep
+        """
+        live_ids = set(package["id"] for package in client.packages(ckan, fq=fq, rows=1000, fl=["id"]))
+        local_ids = set(row[0] for row in self.db.execute("SELECT id FROM packages"))
+        for package_id in local_ids - live_ids:
+            logger.info("Dropping deleted package %s", package_id)
+            self.delete_package(package_id)
+
+    def put_view_index(self, view_index):
+        """Store the views in a view index that differ from the stored ones, and commit.
+        Patch runs update their view index as they write views (see
+        popstats.quickcharts.update_view()); since view writes don't change
+        metadata_modified, the next sync wouldn't see them otherwise.
+        @param view_index: a dict of resource id -> view, from view_index()
+        @returns: the number of views stored
+        """
+        stored = {row[0]: (row[1], row[2]) for row in self.db.execute("SELECT id, package_id, body FROM views")}
+        owners = None
+        count = 0
+        for resource_id, view in view_index.items():
+            existing = stored.get(view["id"])
+            if existing is not None and existing[1] == json.dumps(view):
+                continue
+            if existing is not None:
+                package_id = existing[0]
+            else:
+                if owners is None:
+                    owners = {resource["id"]: package["id"] for package in self.packages() for resource in package.get("resources", [])}
+                package_id = owners.get(resource_id)
+                if package_id is None:
+                    continue
+            self.put_view(view, package_id)
+            count += 1
+        self.db.commit()
+        return count
+
+    def refresh_package_views(self, ckan, names):
+        """Fetch and store the views of some stored packages, and commit.
+        @param ckan: the CKAN API access object
+        @param names: the package names (packages not in the snapshot yet are skipped)
+        """
+        for name in names:
+            package = self.package(name)
+            if package is not None:
+                self.refresh_views(ckan, package)
+        self.db.commit()
+
+    def refresh_views(self, ckan, package):
+        """Fetch and store the views for every resource in a package.
+        @param ckan: the CKAN API access object
+        @param package: the CKAN package (dataset) structure
+        """
+        self.db.execute("DELETE FROM views WHERE package_id=?", (package["id"],))
+        for resource in package.get("resources", []):
+            for view in ckan.call_action("resource_view_list", {"id": resource["id"]}):
+                self.put_view(view, package["id"])
+
+    #
+    # Low-level storage
+    #
+
+    def put_package(self, package):
+        """Insert or replace a package (does not commit)."""
+        parsed = registry.parse_name(package["name"]) or (None, None)
+        self.db.execute("DELETE FROM packages WHERE name=? AND id<>?", (package["name"], package["id"]))
+        self.db.execute(
+            "INSERT OR REPLACE INTO packages (id, name, dataset_type, iso3, metadata_modified, body) VALUES (?, ?, ?, ?, ?, ?)",
+            (package["id"], package["name"], parsed[0], parsed[1], package.get("metadata_modified"), json.dumps(package))
+        )
+
+    def put_view(self, view, package_id):
+        """Insert or replace a resource view (does not commit)."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO views (id, resource_id, package_id, view_type, body) VALUES (?, ?, ?, ?, ?)",
+            (view["id"], view["resource_id"], package_id, view.get("view_type"), json.dumps(view))
+        )
+
+    def delete_package(self, package_id):
+        """Remove a package and its views (does not commit)."""
+        self.db.execute("DELETE FROM views WHERE package_id=?", (package_id,))
+        self.db.execute("DELETE FROM packages WHERE id=?", (package_id,))
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    #
+    # Queries (no API access)
+    #
+
+    def packages(self, dataset_type=None, iso3=None):
+        """Iterate over the stored packages, optionally filtered.
+        @param dataset_type: the dataset type to include (e.g. "refugees-residing"),
+        a list of types, or None for all
+        @param iso3: the lowercase ISO3 code to include, a list of codes, or None for all
+        """
+        sql = "SELECT body FROM packages"
+        conditions = []
+        params = []
+        if isinstance(dataset_type, str):
+            conditions.append("dataset_type=?")
+            params.append(dataset_type)
+        elif dataset_type is not None:
+            conditions.append("dataset_type IN ({})".format(", ".join("?" * len(dataset_type))))
+            params.extend(dataset_type)
+        if isinstance(iso3, str):
+            conditions.append("iso3=?")
+            params.append(iso3.lower())
+        elif iso3 is not None:
+            conditions.append("iso3 IN ({})".format(", ".join("?" * len(iso3))))
+            params.extend(code.lower() for code in iso3)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY name"
+        for row in self.db.execute(sql, params).fetchall():
+            yield json.loads(row[0])
+
+    def iso3_codes(self):
+        """Return the ISO3 codes of the stored packages of known types."""
+        return [row[0] for row in self.db.execute("SELECT DISTINCT iso3 FROM packages WHERE iso3 IS NOT NULL")]
+
+    def package(self, name_or_id):
+        """Look up a single stored package by name or id.
+        @returns: the package structure, or None if not found
+        """
+        row = self.db.execute(
+            "SELECT body FROM packages WHERE name=? OR id=?", (name_or_id, name_or_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def resource_ids(self, name_or_id):
+        """Return the resource ids of a stored package, in order."""
+        package = self.package(name_or_id)
+        return [resource["id"] for resource in package["resources"]] if package else []
+
+    def views(self, resource_id, view_type=None):
+        """Return the stored views for a resource.
+        @param resource_id: the CKAN resource id
+        @param view_type: the view type to include (e.g. "hdx_hxl_preview"), or None for all
+        """
+        if view_type is None:
+            rows = self.db.execute("SELECT body FROM views WHERE resource_id=?", (resource_id,))
+        else:
+            rows = self.db.execute(
+                "SELECT body FROM views WHERE resource_id=? AND view_type=?", (resource_id, view_type)
+            )
+        return [json.loads(row[0]) for row in rows.fetchall()]
+
+    def view_ids(self, resource_id, view_type=None):
+        """Return the stored view ids for a resource."""
+        return [view["id"] for view in self.views(resource_id, view_type)]
+
+    def view_index(self, view_type):
+        """Return a dict of resource id -> stored view of one type.
+        Unlike the snapshot itself, the result is safe to share between threads.
+        @param view_type: the view type (e.g. "hdx_hxl_preview")
+        """
+        rows = self.db.execute("SELECT resource_id, body FROM views WHERE view_type=?", (view_type,))
+        return {row[0]: json.loads(row[1]) for row in rows.fetchall()}
+
+
+def open_packages(ckan, types=None, path=None, views=False, fl=None, shard=None):
+    """Return the packages for a patch run, from a synced snapshot if available.
+    Without a snapshot, the type filter (and field list, if any) is pushed
+    to package_search; with one, the whole organisation is synced and the
+    filter is applied locally.
+    @param ckan: the CKAN API access object
+    @param types: a list of dataset type names (see popstats.registry), or None for all known types
+    @param path: the snapshot file, or None to stream from the API directly
+    @param views: if True, also keep resource views in the snapshot
+    @param fl: a list of the only fields needed from each package, or None for full packages
+    (ignored with a snapshot, which always holds full packages)
+    @param shard: an optional popstats.shards.Shard, to fetch only that part of the catalogue
+    @returns: an iterable of CKAN package structures
+    """
+    if path is None:
+        return shards.crawl(ckan, shard, types, fl)
+    store = Snapshot(path)
+    store.sync(ckan, views=views)
+    return shards.stored(store, shard, types)
@@ -0,0 +1,255 @@
+"""Per-country headline totals from the UNHCR PopStats sources.
+
+Each source is streamed once in typed chunks (see popstats.loader), and
+the totals for every country x year x population type are computed
+with a bincount per chunk and route (country of residence or origin),
+instead of one HXL Proxy slice and browser-side aggregation per
+country.  Only the running totals are kept between chunks.  The result is written
+as one small summary CSV per country and route, for publishing with
+the refugees-residing-* and refugees-originating-* datasets.
+
+Figures that UNHCR has suppressed for confidentiality ("*", for values
+between 1 and 4) are not included in the totals, as the caveats say,
+but are counted in a separate column.
+"""
+
+import csv, logging, os
+import numpy
+from popstats import loader, partition
+
+logger = logging.getLogger("popstats.summary")
+"""Python logging object"""
+
+SUMMARY_SOURCES = (
+    ("persons-of-concern", "http://popstats.unhcr.org/en/persons_of_concern.hxl"),
+    ("time-series", "http://popstats.unhcr.org/en/time_series.hxl"),
+    ("asylum-seekers", "http://popstats.unhcr.org/en/asylum_seekers.hxl"),
+    ("resettlement", "http://popstats.unhcr.org/en/resettlement.hxl"),
+)
+"""The sources to summarise, as (short name, source URL)"""
+
+YEAR_PATTERN = "#date+year"
+"""HXL tag pattern for the year column"""
+
+VALUE_TAG = "#affected"
+"""HXL tag for count columns; in wide sources, each one's attributes name a population type"""
+
+TYPE_TAGS = ("#indicator", "#population")
+"""HXL tags for population-type columns in long-format sources"""
+
+KEY_STRIDE = 1 << 20
+"""Multiplier for packing (country, year, type) codes into one int64 grouping key"""
+
+FILENAME = "unhcr_summary_{}_{}.csv"
+"""Output filename template, filled with (category, country stub code)"""
+
+HEADERS = [
+    ["Year", "Source", "Population type", "Total", "Suppressed figures"],
+    ["#date+year", "#meta+source", "#indicator+type", "#affected+total", "#meta+suppressed"],
+]
+"""Header and hashtag rows for the summary files"""
+
+
+class Summary(object):
+    """Grouped totals for one source and route, for all countries at once."""
+
+    __slots__ = ("source_name", "category", "years", "types", "totals", "suppressed")
+
+    def __init__(self, source_name, category, years, types, totals, suppressed):
+        """
+        @param source_name: the short name of the source (e.g. "time-series")
+        @param category: "residence" or "origin"
+        @param years: an array of the years (axis 1)
+        @param types: an array of the population type labels (axis 2)
+        @param totals: a (countries x years x types) array of totals
+        @param suppressed: a (countries x years x types) array of suppressed-figure counts
+        """
+        self.source_name = source_name
+        self.category = category
+        self.years = years
+        self.types = types
+        self.totals = totals
+        self.suppressed = suppressed
+
+
+def type_label(tagspec):
+    """Label a wide-format count column by its attributes (e.g. "#affected+refugees" -> "refugees")."""
+    return " ".join(sorted(partition.parse_tagspec(tagspec)[1])) or "total"
+
+
+def _codes(values, codes):
+    """Map an array of labels to small integer codes, adding any new labels to a dict of label -> code."""
+    distinct, inverse = numpy.unique(values, return_inverse=True)
+    lookup = numpy.array([codes.setdefault(value, len(codes)) for value in distinct.tolist()], dtype=numpy.int64)
+    return lookup[inverse]
+
+
+def _reduce(keys, totals, suppressed):
+    """Combine the entries with the same grouping key."""
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    return (
+        keys,
+        numpy.bincount(inverse, weights=totals, minlength=len(keys)).astype(numpy.int64),
+        numpy.bincount(inverse, weights=suppressed, minlength=len(keys)).astype(numpy.int64),
+    )
+
+
+def _ranks(codes):
+    """Sort the labels in a dict of label -> code.
+    @returns: a tuple of (sorted labels, array mapping each code to its sorted position)
+    """
+    labels = sorted(codes, key=codes.get)
+    order = numpy.argsort(numpy.array(labels), kind="stable") if labels else numpy.zeros(0, dtype=numpy.int64)
+    ranks = numpy.empty(len(labels), dtype=numpy.int64)
+    ranks[order] = numpy.arange(len(labels))
+    return numpy.array(labels)[order], ranks
+
+
+def summarise_source(source_name, source, routes, countries, chunk_rows=loader.CHUNK_ROWS):
+    """Compute the grouped totals for every route of one source.
+    @param source_name: the short name of the source
+    @param source: the source URL or local file
+    @param routes: the popstats.partition.Route objects for the source
+    @param countries: a list of popstats.inputs.Country records (axis 0 of the results)
+    @param chunk_rows: the number of rows to read at a time
+    @returns: a list of Summary objects, one per route
+    """
+    logger.info("Summarising %s", source)
+    countries_by_name = {partition.normalise_string(country.unhcr_name): n for n, country in enumerate(countries)}
+    known_names = {} # raw country name -> index, or -1 if unknown
+    year_codes, type_codes = {}, {}
+    patterns = [YEAR_PATTERN, VALUE_TAG] + list(TYPE_TAGS) + [route.pattern for route in routes]
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    partials = [(empty, empty, empty) for route in routes]
+    row_count = 0
+
+    with loader.TypedReader(source, patterns, loader.INTEGER_PATTERNS, chunk_rows) as reader:
+        hashtags = reader.hashtags
+        year_columns = reader.matching(YEAR_PATTERN)
+        type_columns = [i for i in reader.wanted if partition.parse_tagspec(hashtags[i])[0] in TYPE_TAGS]
+        value_columns = reader.matching(VALUE_TAG)
+        if not year_columns or not value_columns:
+            raise Exception("No year or count columns in {}".format(source))
+        route_columns = [reader.matching(route.pattern) for route in routes]
+
+        for chunk in reader.chunks():
+            row_count += chunk.size
+            width = len(value_columns)
+
+            # years, as codes; rows without a year are left out
+            years = chunk.columns[year_columns[0]]
+            dated = numpy.tile(years.valid & (years.values > 0), width)
+            year_code = numpy.tile(_codes(years.values, year_codes), width)
+
+            # population types: the type column(s) in long sources, and/or the count column attributes in wide ones
+            if type_columns:
+                row_types = chunk.columns[type_columns[0]]
+                for i in type_columns[1:]:
+                    row_types = numpy.char.add(numpy.char.add(row_types, " / "), chunk.columns[i])
+            else:
+                row_types = None
+            labels = []
+            for i in value_columns:
+                label = type_label(hashtags[i])
+                if row_types is None:
+                    labels.append(numpy.full(chunk.size, label))
+                elif width > 1:
+                    labels.append(numpy.char.add(numpy.char.add(row_types, " / "), label))
+                else:
+                    labels.append(row_types)
+            type_code = _codes(numpy.concatenate(labels), type_codes)
+            values = numpy.concatenate([chunk.columns[i].values for i in value_columns])
+            suppressed = numpy.concatenate([chunk.columns[i].suppressed for i in value_columns])
+
+            for n, columns in enumerate(route_columns):
+                seen = None
+                for i in columns:
+                    names, inverse = numpy.unique(chunk.columns[i], return_inverse=True)
+                    lookup = numpy.array([
+                        known_names.setdefault(name, countries_by_name.get(partition.normalise_string(name), -1))
+                        for name in names.tolist()
+                    ], dtype=numpy.int64)
+                    country_code = lookup[inverse]
+                    if seen is not None:
+                        # a row counts once per country, even if the country is in two matching columns
+                        country_code = numpy.where(numpy.any(seen == country_code, axis=0), -1, country_code)
+                        seen = numpy.vstack([seen, country_code])
+                    else:
+                        seen = country_code[numpy.newaxis, :]
+                    country_code = numpy.tile(country_code, width)
+                    valid = (country_code >= 0) & dated
+                    keys = (country_code[valid] * KEY_STRIDE + year_code[valid]) * KEY_STRIDE + type_code[valid]
+                    partials[n] = _reduce(
+                        numpy.concatenate([partials[n][0], keys]),
+                        numpy.concatenate([partials[n][1], values[valid]]),
+                        numpy.concatenate([partials[n][2], suppressed[valid]]),
+                    )
+
+    # unpack the keys into dense arrays, with the years and types in sorted order
+    year_values, year_ranks = _ranks(year_codes)
+    type_values, type_ranks = _ranks(type_codes)
+    shape = (len(countries), len(year_values), len(type_values))
+    summaries = []
+    for route, (keys, totals, suppressed) in zip(routes, partials):
+        index = (keys // (KEY_STRIDE * KEY_STRIDE), year_ranks[keys // KEY_STRIDE % KEY_STRIDE], type_ranks[keys % KEY_STRIDE])
+        dense_totals = numpy.zeros(shape, dtype=numpy.int64)
+        dense_suppressed = numpy.zeros(shape, dtype=numpy.int64)
+        dense_totals[index] = totals
+        dense_suppressed[index] = suppressed
+        summaries.append(Summary(source_name, route.category, year_values, type_values, dense_totals, dense_suppressed))
+    logger.info("Summarised %d rows from %s", row_count, source)
+    return summaries
+
+
+def write_summaries(output_dir, countries, summaries):
+    """Write one summary CSV per country and category, combining all of the sources.
+    Only the year/type combinations with data are written.
+    @param output_dir: the directory for the output files
+    @param countries: the popstats.inputs.Country records (axis 0 of the summaries)
+    @param summaries: a list of Summary objects
+    @returns: a dict of output path -> number of data rows
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rows_by_path = {}
+    for summary in summaries:
+        present = (summary.totals > 0) | (summary.suppressed > 0)
+        country_index, year_index, type_index = numpy.nonzero(present)
+        for n, country in enumerate(countries):
+            path = os.path.join(output_dir, FILENAME.format(summary.category, country.stub_code))
+            rows = rows_by_path.setdefault(path, [])
+            start, end = numpy.searchsorted(country_index, [n, n + 1])
+            for y, t in zip(year_index[start:end], type_index[start:end]):
+                rows.append([
+                    int(summary.years[y]),
+                    summary.source_name,
+                    summary.types[t],
+                    int(summary.totals[n, y, t]),
+                    int(summary.suppressed[n, y, t]),
+                ])
+    counts = {}
+    for path, rows in rows_by_path.items():
+        rows.sort(key=lambda row: (row[0], row[1], row[2]))
+        with open(path, "w", encoding="utf-8", newline="") as output:
+            writer = csv.writer(output)
+            writer.writerows(HEADERS)
+            writer.writerows(rows)
+        counts[path] = len(rows)
+    return counts
+
+
+def summarise_all(output_dir, countries, resources_by_category, sources=None):
+    """Summarise every source in SUMMARY_SOURCES and write the per-country files.
+    @param output_dir: the directory for the output files
+    @param countries: a list of popstats.inputs.Country records
+    @param resources_by_category: as returned by popstats.inputs.compile_inputs()
+    @param sources: an optional dict mapping source URLs to local copies
+    @returns: a dict of output path -> number of data rows
+    """
+    routes = partition.routes_by_source(resources_by_category)
+    summaries = []
+    for source_name, source_url in SUMMARY_SOURCES:
+        if source_url not in routes:
+            logger.warning("No resources use %s (skipping)", source_url)
+            continue
+        summaries += summarise_source(source_name, (sources or {}).get(source_url, source_url), routes[source_url], countries)
+    return write_summaries(output_dir, countries, summaries)
@@ -0,0 +1,217 @@
+"""Cached, offline-capable loading of the dataset-creation input tables.
+
+The countries, datasets and resources tables live in a Google Sheet,
+with backups in Inputs/.  Each table is fetched as a CSV export with a
+conditional request (ETag/Last-Modified), so an unchanged sheet costs a
+304 and no parsing.  The parsed rows and the compiled records (see
+popstats.inputs) are kept in a pickle cache; if the sheet can't be
+reached, the cached copy is used, and failing that the backup in Inputs/.
+"""
+
+import csv, io, logging, os, pickle, urllib.error, urllib.request
+from popstats import inputs, partition
+
+logger = logging.getLogger("popstats.tables")
+"""Python logging object"""
+
+SHEET_URL = 'https://docs.google.com/spreadsheets/d/1tHbzC8F79wQhpLos7Zw2qLQJI-UzccddDt0ds7R88F8/export?format=csv&gid={gid}'
+"""CSV export URL for one tab of the input Google Sheet"""
+
+TABLES = (
+    ('countries', 1998541723),
+    ('datasets', 778105659),
+    ('resources', 828285269),
+)
+"""The input tables, as (name, sheet tab gid).  The backup for each is Inputs/<name>.csv."""
+
+DEFAULT_INPUTS_DIR = "Inputs"
+"""Default directory for the backup CSV files"""
+
+DEFAULT_CACHE_PATH = "inputs-cache.pickle"
+"""Default location of the parsed input cache"""
+
+CACHE_VERSION = 2
+"""Version of the cache layout; bump to discard old caches when the records change"""
+
+TIMEOUT = 30
+"""Seconds to wait for the Google Sheet"""
+
+
+class Table(object):
+    """A parsed HXL table: the hashtag row and the data rows (lists of strings)."""
+
+    __slots__ = ("hashtags", "rows", "_columns")
+
+    def __init__(self, hashtags, rows):
+        self.hashtags = hashtags
+        self.rows = rows
+        self._columns = {}
+
+    def __getstate__(self):
+        return (self.hashtags, self.rows)
+
+    def __setstate__(self, state):
+        self.hashtags, self.rows = state
+        self._columns = {}
+
+    def column(self, pattern):
+        """Find the first column matching an HXL tag pattern (e.g. "country+code+iso3").
+        @returns: the column index, or None
+        """
+        if pattern not in self._columns:
+            full_pattern = pattern if pattern.startswith("#") else "#" + pattern
+            self._columns[pattern] = next(
+                (i for i, tagspec in enumerate(self.hashtags) if tagspec.strip() and partition.pattern_matches(full_pattern, tagspec)),
+                None
+            )
+        return self._columns[pattern]
+
+    def __iter__(self):
+        for values in self.rows:
+            yield Row(self, values)
+
+    @classmethod
+    def parse(cls, text):
+        """Parse HXL-hashtagged CSV text.
+        @param text: the CSV text, with optional text header rows above the hashtag row
+        """
+        reader = csv.reader(io.StringIO(text))
+        for row in reader:
+            if partition.is_hashtag_row(row):
+                return cls(row, [values for values in reader if any(value.strip() for value in values)])
+        raise Exception("No HXL hashtag row found")
+
+
+class Row(object):
+    """One data row, with hxl-style get() by tag pattern."""
+
+    __slots__ = ("table", "values")
+
+    def __init__(self, table, values):
+        self.table = table
+        self.values = values
+
+    def get(self, pattern, default=None):
+        i = self.table.column(pattern)
+        if i is None or i >= len(self.values):
+            return default
+        return self.values[i]
+
+
+class Inputs(object):
+    """The compiled input tables, indexed for lookup."""
+
+    __slots__ = ("countries", "datasets", "resources_by_category", "countries_by_code", "datasets_by_category")
+
+    def __init__(self, countries, datasets, resources_by_category):
+        self.countries = countries
+        self.datasets = datasets
+        self.resources_by_category = resources_by_category
+        self.countries_by_code = {country.code: country for country in countries}
+        self.datasets_by_category = {dataset.category: dataset for dataset in datasets}
+
+    def __getstate__(self):
+        return (self.countries, self.datasets, self.resources_by_category)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __iter__(self):
+        """Allow countries, datasets, resources_by_category = load()"""
+        return iter((self.countries, self.datasets, self.resources_by_category))
+
+
+def _read_cache(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as input:
+            cache = pickle.load(input)
+    except Exception:
+        logger.warning("Ignoring unreadable input cache %s", path)
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache
+
+
+def _write_cache(path, cache):
+    if path is None:
+        return
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as output:
+        pickle.dump(cache, output, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def fetch(url, cached=None):
+    """Conditionally fetch a sheet export.
+    @param url: the CSV export URL
+    @param cached: the cache entry from the last fetch (with "etag" and "last_modified"), if any
+    @returns: a new cache entry, or None if the cached copy is still current
+    """
+    request = urllib.request.Request(url)
+    if cached is not None:
+        if cached.get("etag"):
+            request.add_header("If-None-Match", cached["etag"])
+        if cached.get("last_modified"):
+            request.add_header("If-Modified-Since", cached["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            text = response.read().decode("utf-8")
+            return {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "table": Table.parse(text),
+                "source": url,
+            }
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+def load(cache_path=DEFAULT_CACHE_PATH, inputs_dir=DEFAULT_INPUTS_DIR, offline=False):
+    """Load and compile the input tables, as cheaply as possible.
+    Online, each table is fetched from the sheet only if it has changed;
+    offline (or if the sheet can't be reached), the cached copy is used,
+    or the backup in inputs_dir if there is none.  The records are only
+    recompiled when a table has changed.
+    @param cache_path: the pickle cache file, or None for no cache
+    @param inputs_dir: the directory with the backup CSV files
+    @param offline: if True, don't contact the sheet at all
+    @returns: an Inputs object
+    """
+    cache = _read_cache(cache_path)
+    entries = cache.get("tables", {})
+    changed = not cache.get("compiled")
+    for name, gid in TABLES:
+        cached = entries.get(name)
+        entry = None
+        if not offline:
+            try:
+                entry = fetch(SHEET_URL.format(gid=gid), cached if cached and cached["source"] != "backup" else None)
+                if entry is None:
+                    logger.info("%s table unchanged", name)
+            except Exception as e:
+                logger.warning("Can't fetch the %s table from the sheet (%s)", name, e)
+        if entry is None and cached is None:
+            path = os.path.join(inputs_dir, name + ".csv")
+            logger.info("Using backup %s", path)
+            with open(path, "r", encoding="utf-8", newline="") as input:
+                entry = {"etag": None, "last_modified": None, "table": Table.parse(input.read()), "source": "backup"}
+        if entry is not None:
+            entries[name] = entry
+            changed = True
+
+    if changed:
+        logger.info("Compiling input tables")
+        cache = {
+            "version": CACHE_VERSION,
+            "tables": entries,
+            "compiled": Inputs(*inputs.compile_inputs(
+                entries["countries"]["table"], entries["datasets"]["table"], entries["resources"]["table"]
+            )),
+        }
+        _write_cache(cache_path, cache)
+    return cache["compiled"]
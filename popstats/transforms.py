@@ -0,0 +1,192 @@
+"""Pluggable package transforms, so that several patches share one crawl.
+
+A transform looks at one package in memory and records the changes it
+wants in an Edits object, without writing anything.  For each package,
+every selected transform runs first, and then the edits are merged and
+written: at most one package_patch with the changed fields from all of
+them, at most one resource_patch per resource, and the Quick Charts view
+write if needed.  Unchanged fields are never written (see
+popstats.writes).  Two transforms that want different values for the
+same field are an error for that package.
+
+Register a transform with the @transform decorator; the function is
+called as func(package, dataset_type, edits).
+"""
+
+import collections, logging
+from popstats import quickcharts, reconcile, registry, writes
+
+logger = logging.getLogger("popstats.transforms")
+"""Python logging object"""
+
+TRANSFORMS = collections.OrderedDict()
+"""Registered transforms, keyed by name, in the order they run"""
+
+
+class Transform(object):
+    """A registered transform."""
+
+    __slots__ = ("name", "func", "types", "setup")
+
+    def __init__(self, name, func, types=None, setup=None):
+        """
+        @param name: the name used to select the transform (e.g. "fix-caveats")
+        @param func: the function, called as func(package, dataset_type, edits)
+        @param types: a list of the dataset types it applies to, or None for all known types
+        @param setup: an optional function called once as setup(context) before the crawl
+        """
+        self.name = name
+        self.func = func
+        self.types = types
+        self.setup = setup
+
+    def applies_to(self, dataset_type):
+        return self.types is None or dataset_type in self.types
+
+
+def transform(name, types=None, setup=None):
+    """Decorator to register a transform function (see Transform)."""
+    def register(func):
+        TRANSFORMS[name] = Transform(name, func, types, setup)
+        return func
+    return register
+
+
+class Context(object):
+    """Shared state for one run of transforms."""
+
+    def __init__(self, ckan, view_index=None):
+        """
+        @param ckan: the CKAN API access object
+        @param view_index: an optional dict of resource id -> known Quick Charts view
+        """
+        self.ckan = ckan
+        self.view_index = view_index
+        self.models = None
+
+
+class Edits(object):
+    """The merged changes that the transforms want for one package."""
+
+    __slots__ = ("package", "resources", "quickcharts", "transform", "_owners")
+
+    def __init__(self):
+        self.package = {}
+        self.resources = collections.OrderedDict() # resource id -> changes
+        self.quickcharts = False
+        self.transform = None # the name of the transform currently running
+        self._owners = {}
+
+    def _merge(self, target, key, changes):
+        for field, value in changes.items():
+            owner = self._owners.get((key, field))
+            if owner is not None and not writes.matches(target[field], value):
+                raise Exception("Transforms {} and {} conflict on {} of {}".format(owner, self.transform, field, key))
+            target[field] = value
+            self._owners[(key, field)] = self.transform
+
+    def patch_package(self, changes):
+        """Ask for package field values."""
+        self._merge(self.package, "package", changes)
+
+    def patch_resource(self, resource, changes):
+        """Ask for field values on one of the package's resources."""
+        self._merge(self.resources.setdefault(resource["id"], {}), resource["id"], changes)
+
+    def add_quickcharts(self):
+        """Ask for the model Quick Charts view on the first resource."""
+        self.quickcharts = True
+
+
+def select(names=None):
+    """Look up transforms by name.
+    @param names: a list of transform names, or None for all of them
+    @returns: a list of Transform objects, in registration order
+    """
+    if names is None:
+        return list(TRANSFORMS.values())
+    unknown = set(names) - set(TRANSFORMS)
+    if unknown:
+        raise Exception("Unknown transforms: {} (known: {})".format(", ".join(sorted(unknown)), ", ".join(TRANSFORMS)))
+    return [transform for name, transform in TRANSFORMS.items() if name in names]
+
+
+def types_for(selected):
+    """List the dataset types that any of the transforms apply to, or None if that's all of them."""
+    if any(transform.types is None for transform in selected):
+        return None
+    return sorted(set(type_name for transform in selected for type_name in transform.types))
+
+
+def setup(context, selected):
+    """Run each selected transform's setup once, before the crawl."""
+    for transform in selected:
+        if transform.setup is not None:
+            transform.setup(context)
+
+
+def process(context, selected, package):
+    """Run the selected transforms on one package, then write the merged edits.
+    @param context: the Context
+    @param selected: a list of Transform objects
+    @param package: the CKAN package (dataset) structure
+    @returns: the number of writes made
+    """
+    parsed = registry.parse_name(package["name"])
+    if parsed is None:
+        logger.warning("Skipping %s", package["name"])
+        return 0
+    dataset_type = parsed[0]
+    edits = Edits()
+    for transform in selected:
+        if transform.applies_to(dataset_type):
+            edits.transform = transform.name
+            transform.func(package, dataset_type, edits)
+
+    written = 0
+    if edits.package and writes.patch_package(context.ckan, package, edits.package):
+        written += 1
+    for resource in package.get("resources", []):
+        changes = edits.resources.get(resource["id"])
+        if changes and writes.patch_resource(context.ckan, resource, changes):
+            written += 1
+    if edits.quickcharts:
+        written += quickcharts.update_view(context.ckan, package, dataset_type, context.models, context.view_index)
+    return written
+
+
+#
+# The registered transforms
+#
+
+@transform("update-concern", types=["refugees-residing", "refugees-originating"])
+def update_concern_notes(package, dataset_type, edits):
+    """Rewrite the notes about populations of concern (2018-12-05)."""
+    edits.patch_package({"notes": reconcile.PARENT_NOTES.format(
+        context="residing in" if dataset_type == "refugees-residing" else "originating from",
+        country=package["groups"][0]["display_name"]
+    )})
+
+
+@transform("fix-metadata")
+def update_resource_metadata(package, dataset_type, edits):
+    """Set url_type and resource_type to "api" on every resource (2019-08-29)."""
+    for resource in package["resources"]:
+        edits.patch_resource(resource, reconcile.RESOURCE_FIELDS)
+
+
+@transform("fix-caveats", types=list(registry.PATCHED_FIELDS))
+def update_patched_fields(package, dataset_type, edits):
+    """Apply the later per-type field changes, such as the new caveats (2019-10-09)."""
+    edits.patch_package(registry.PATCHED_FIELDS[dataset_type])
+
+
+def _load_models(context):
+    context.models = quickcharts.Models(quickcharts.DEFAULT_CACHE_PATH).load(context.ckan)
+
+
+@transform("add-quickcharts", setup=_load_models)
+def add_quickcharts(package, dataset_type, edits):
+    """Turn on the Quick Charts preview and copy the model view for the type (2019-02-04)."""
+    edits.patch_package(quickcharts.PACKAGE_FLAGS)
+    edits.add_quickcharts()
@@ -0,0 +1,80 @@
+"""Field-level writes to CKAN packages and resources.
+
+Diff the intended change against the object already fetched, skip the
+call entirely when nothing differs, and otherwise send only the changed
+keys through package_patch or resource_patch instead of round-tripping
+the whole package through package_update.
+"""
+
+import logging
+from popstats import instrument
+
+logger = logging.getLogger("popstats.writes")
+"""Python logging object"""
+
+
+def matches(current, wanted):
+    """Test whether a current value already satisfies a wanted value.
+    Dicts match if every wanted key matches; lists match item by item.
+    This lets [{"name": "hxl"}] match a CKAN tag list whose entries also
+    carry ids and display names.
+    @param current: the value from the fetched CKAN object
+    @param wanted: the intended value
+    @returns: True if no write is needed
+    """
+    if isinstance(wanted, dict):
+        return isinstance(current, dict) and all(
+            matches(current.get(key), value) for key, value in wanted.items()
+        )
+    elif isinstance(wanted, (list, tuple)):
+        return isinstance(current, (list, tuple)) and len(current) == len(wanted) and all(
+            matches(c, w) for c, w in zip(current, wanted)
+        )
+    else:
+        return current == wanted
+
+
+def diff(current, changes):
+    """Return only the changes that differ from the current object.
+    @param current: the CKAN package or resource structure
+    @param changes: a dict of intended field values
+    @returns: a (possibly empty) dict of the fields that need writing
+    """
+    return {key: value for key, value in changes.items() if not matches(current.get(key), value)}
+
+
+def patch_package(ckan, package, changes):
+    """Apply field changes to a package with package_patch, if needed.
+    Updates the local package structure to match on success.
+    @param ckan: the CKAN API access object
+    @param package: the CKAN package (dataset) structure
+    @param changes: a dict of intended field values
+    @returns: True if a write was made, False if the package was already up to date
+    """
+    changed = diff(package, changes)
+    if not changed:
+        logger.info("%s already up to date (skipping)", package["name"])
+        instrument.record_skip("package_patch")
+        return False
+    logger.info("Patching %s (%s)", package["name"], ", ".join(sorted(changed)))
+    ckan.call_action("package_patch", dict(changed, id=package["id"]))
+    package.update(changed)
+    return True
+
+
+def patch_resource(ckan, resource, changes):
+    """Apply field changes to a resource with resource_patch, if needed.
+    Updates the local resource structure to match on success.
+    @param ckan: the CKAN API access object
+    @param resource: the CKAN resource structure
+    @param changes: a dict of intended field values
+    @returns: True if a write was made, False if the resource was already up to date
+    """
+    changed = diff(resource, changes)
+    if not changed:
+        instrument.record_skip("resource_patch")
+        return False
+    logger.info("Patching resource %s (%s)", resource["name"], ", ".join(sorted(changed)))
+    ckan.call_action("resource_patch", dict(changed, id=resource["id"]))
+    resource.update(changed)
+    return True
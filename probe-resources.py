@@ -0,0 +1,62 @@
+"""Probe every UNHCR resource URL and report the empty, broken and slow ones.
+
+By default, the resources come from the catalogue (the local snapshot
+if ``snapshot`` is set in config.py).  With --from-inputs, they come
+from the input tables instead, with no CKAN access; with --urls, from a
+file of URLs, one per line (e.g. to test against a local server).
+
+Usage: python3 probe-resources.py [--workers N] [--ttl SECONDS] [--slow SECONDS] [--from-inputs | --urls FILE] [--json FILE]
+"""
+
+import argparse, json, logging
+from popstats import client, inputs, probe, registry, snapshot, tables
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("probe-resources")
+"""Python logging object"""
+
+
+def catalogue_targets(config):
+    """List the resources of every known UNHCR dataset in the catalogue."""
+    ckan = client.from_config(config)
+    return probe.targets_from_packages(snapshot.open_packages(ckan, list(registry.TYPES), config.get('snapshot')))
+
+
+def input_targets():
+    """List the resources that the input tables define, without CKAN access."""
+    countries, datasets, resources_by_category = tables.load()
+    return probe.targets_from_packages(inputs.render_all(countries, datasets, resources_by_category, None))
+
+
+def file_targets(path):
+    """List the URLs in a file, one per line."""
+    with open(path, "r", encoding="utf-8") as input:
+        return [{"url": line.strip()} for line in input if line.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find empty, broken and slow UNHCR resources.")
+    parser.add_argument("--workers", type=int, default=probe.DEFAULT_WORKERS, help="URLs to probe at once")
+    parser.add_argument("--ttl", type=int, default=probe.DEFAULT_TTL, help="seconds to reuse a cached result (0 to probe everything)")
+    parser.add_argument("--slow", type=float, default=probe.DEFAULT_SLOW, help="report resources slower than this many seconds")
+    parser.add_argument("--timeout", type=float, default=probe.DEFAULT_TIMEOUT, help="seconds to wait for each response")
+    parser.add_argument("--json", help="also write the full results to this JSON file")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--from-inputs", action="store_true", help="probe the resources defined by the input tables")
+    source.add_argument("--urls", help="probe the URLs listed in this file")
+    args = parser.parse_args()
+
+    if args.urls:
+        targets = file_targets(args.urls)
+    elif args.from_inputs:
+        targets = input_targets()
+    else:
+        from config import CONFIG
+        targets = catalogue_targets(CONFIG)
+
+    cache = probe.ProbeCache(ttl=args.ttl)
+    results = probe.probe_all(targets, workers=args.workers, cache=cache, timeout=args.timeout)
+    probe.report(results, slow=args.slow)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
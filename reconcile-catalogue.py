@@ -0,0 +1,113 @@
+"""Bring the whole UNHCR catalogue into its desired state in one run.
+
+Computes the desired state of every dataset, resource and Quick Charts
+view (see popstats/reconcile.py), compares it with a snapshot of the
+catalogue, and prints the operations needed.  Nothing is written unless
+--apply is given.
+
+With --apply or --changed-only, each country's slice of the PopStats
+sources is hashed and compared with the manifest (see
+popstats/manifest.py); resources whose data changed get their
+last_modified bumped.  With --changed-only, datasets whose data hasn't
+changed are left out of the plan altogether (so metadata edits to them
+wait for a full run).  The manifest is updated after a successful
+--apply; if there is none yet, the current hashes are saved as the
+baseline and nothing counts as changed.  Dry runs don't download the
+sources, and neither does --offline (so it can't be combined with
+--changed-only).
+
+Usage: python3 reconcile-catalogue.py [--apply] [--no-delete] [--changed-only] [--workers N] [--rate N] [--offline]
+"""
+
+import argparse, collections, logging
+from popstats import client, executor, inputs, manifest, quickcharts, reconcile, snapshot, tables
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("reconcile-catalogue")
+"""Python logging object"""
+
+DEFAULT_RATE = 4
+"""Default global limit on API calls per second"""
+
+def reconcile_catalogue(config, apply=False, delete=True, rate=DEFAULT_RATE, workers=executor.DEFAULT_WORKERS, snapshot_path=snapshot.DEFAULT_PATH, offline=False, changed_only=False, manifest_path=manifest.DEFAULT_PATH, sources=None):
+    """Plan (and optionally apply) the changes needed across the catalogue.
+    This is the main external entry point.
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent, and creator,
+    the CKAN username to record as package_creator for new datasets; optionally proxy)
+    @param apply: if True, apply the plan; otherwise just print it
+    @param delete: if True, include deletions of unwanted resources and datasets
+    @param rate: the starting rate of API calls per second
+    @param workers: the number of datasets to write in parallel
+    @param snapshot_path: the local snapshot file to compare against
+    @param offline: if True, use the cached input tables or Inputs/ without checking the Google Sheet
+    @param changed_only: if True, plan only for the datasets whose source data changed since the
+    manifest was saved (and never delete)
+    @param manifest_path: the content-hash manifest file
+    @param sources: an optional dict mapping source URLs to local copies, for hashing
+    (with offline and no local copies, the sources aren't hashed)
+    @returns: the list of planned operations
+    """
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    inputs.configure(config)
+    countries, datasets, resources_by_category = tables.load(offline=offline)
+    models = quickcharts.Models().load(ckan)
+    store = snapshot.Snapshot(snapshot_path)
+    store.sync(ckan, views=True)
+
+    display_names = reconcile.display_names_from(store.packages(dataset_type=["refugees-residing", "refugees-originating"]))
+    desired = reconcile.desired_state(countries, datasets, resources_by_category, config['creator'], models, display_names)
+
+    saved = manifest.Manifest(manifest_path)
+    hashes = None
+    data_changed = {}
+    if offline and not sources:
+        if changed_only:
+            raise Exception("--changed-only needs the sources, so it can't be used offline")
+        logger.info("Offline: not hashing the sources, so no last_modified changes")
+    elif apply or changed_only:
+        hashes = manifest.hash_all(countries, resources_by_category, sources)
+        if not saved.hashes:
+            logger.info("No manifest at %s yet; saving the current hashes as the baseline", manifest_path)
+            saved.update(hashes)
+            saved.save()
+        changed = saved.changed(hashes)
+        data_changed = reconcile.datasets_for_changes(changed, countries, datasets, resources_by_category)
+        logger.info("Data changed for %d of %d country slices (%d datasets)", len(changed), len(hashes), len(data_changed))
+    if changed_only:
+        # the rest of the catalogue isn't in the plan, so nothing can be judged unwanted
+        desired = collections.OrderedDict((name, want) for name, want in desired.items() if name in data_changed)
+        delete = False
+
+    operations = reconcile.plan(desired, store, delete=delete, data_changed=data_changed)
+    reconcile.print_plan(operations)
+
+    if apply:
+        failed = reconcile.apply(ckan, operations, workers)[1] if operations else 0
+        # view writes don't change metadata_modified, so the next sync wouldn't see them
+        store.refresh_package_views(ckan, set(
+            operation.package for operation in operations if operation.action.startswith("resource_view_")
+        ))
+        if hashes is not None:
+            if failed:
+                logger.warning("%d datasets failed; not updating %s, so they will be retried", failed, manifest_path)
+            else:
+                saved.update(hashes)
+                saved.save()
+    return operations
+
+if __name__ == '__main__':
+    from config import CONFIG
+    parser = argparse.ArgumentParser(description="Reconcile the UNHCR catalogue with its desired state.")
+    parser.add_argument("--apply", action="store_true", help="apply the plan (default: dry run)")
+    parser.add_argument("--no-delete", action="store_true", help="don't delete unwanted resources or datasets")
+    parser.add_argument("--changed-only", action="store_true", help="only plan for datasets whose source data changed (implies --no-delete)")
+    parser.add_argument("--workers", type=int, default=executor.DEFAULT_WORKERS, help="datasets to write in parallel")
+    parser.add_argument("--offline", action="store_true", help="use the cached input tables or Inputs/ without checking the Google Sheet")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="starting API calls per second (adapts to the server)")
+    args = parser.parse_args()
+    reconcile_catalogue(
+        CONFIG,
+        apply=args.apply, delete=not args.no_delete, rate=args.rate, workers=args.workers,
+        snapshot_path=CONFIG.get('snapshot') or snapshot.DEFAULT_PATH, offline=args.offline,
+        changed_only=args.changed_only, manifest_path=CONFIG.get('manifest') or manifest.DEFAULT_PATH
+    )
@@ -0,0 +1,47 @@
+"""Run a patch script as several processes, one per shard of the catalogue.
+
+Starts SHARDS copies of the script with --shard 0/SHARDS ... SHARDS-1/SHARDS
+(see popstats/shards.py), prints their merged output with each line
+prefixed by its shard, and starts any shard that failed again.  If
+'snapshot' is set in config.py, it is synced once first, so the shards
+only read it.
+
+To spread a run over several hosts instead, start the script on each
+with its own --shard i/N and the same N.
+
+Usage: python3 run-shards.py [--retries N] SHARDS SCRIPT [ARGS ...]
+"""
+
+import argparse, logging, sys
+from popstats import client, shards, snapshot
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("run-shards")
+"""Python logging object"""
+
+def run_shards(config, script, count, args=(), retries=shards.DEFAULT_RETRIES):
+    """Run every shard of a patch script locally.
+    This is the main external entry point.
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent, snapshot)
+    @param script: the patch script (e.g. "20190829-fix-metadata.py")
+    @param count: the number of shards
+    @param args: any other arguments for the script
+    @param retries: how many times to restart a failed shard
+    @returns: the totals from popstats.shards.launch()
+    """
+    if config.get('snapshot'):
+        store = snapshot.Snapshot(config['snapshot'])
+        store.sync(client.from_config(config), views=True) # so the shards' own syncs find nothing to write
+        store.close()
+    return shards.launch(script, count, args, retries)
+
+if __name__ == '__main__':
+    from config import CONFIG
+    parser = argparse.ArgumentParser(description="Run a patch script as several processes, one per shard of the catalogue.")
+    parser.add_argument("--retries", type=int, default=shards.DEFAULT_RETRIES, help="times to restart a failed shard")
+    parser.add_argument("shards", type=int, help="the number of shards (processes)")
+    parser.add_argument("script", help="the patch script to run (e.g. 20190829-fix-metadata.py)")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="any other arguments for the script")
+    args = parser.parse_args()
+    totals = run_shards(CONFIG, args.script, args.shards, args.args, args.retries)
+    sys.exit(1 if totals["failed_shards"] else 0)
@@ -0,0 +1,77 @@
+"""Run several patches over the UNHCR datasets in a single crawl.
+
+Streams the packages once and runs every selected transform (see
+popstats/transforms.py) on each one, then writes the merged edits: at
+most one package write per package, plus any resource and view writes,
+however many transforms are selected.
+
+Usage: python3 run-transforms.py [--list] [--workers N] [--rate N] [--shard i/N] [TRANSFORM ...]
+"""
+
+import functools, logging
+from popstats import client, executor, journal, quickcharts, shards, snapshot, transforms
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("run-transforms")
+"""Python logging object"""
+
+DEFAULT_RATE = 4
+"""Default global limit on API calls per second"""
+
+DEFAULT_WORKERS = 8
+"""Default number of worker threads"""
+
+def run_transforms(config, names=None, rate=DEFAULT_RATE, workers=DEFAULT_WORKERS, snapshot_path=None, journal_path=None, shard=None):
+    """Apply the selected transforms to every matching dataset.
+    This is the main external entry point.
+    @param config: the CONFIG dict from config.py (ckanurl, apikey, user_agent)
+    @param names: a list of transform names, or None for all of them
+    @param rate: the starting rate of API calls per second
+    @param workers: the number of packages to process in parallel
+    @param snapshot_path: a local snapshot file to sync and read packages from, or None to crawl
+    @param journal_path: a checkpoint journal file for resuming interrupted runs, or None
+    @param shard: an optional popstats.shards.Shard, to process only that part of the catalogue
+    @returns: the (succeeded, failed) package counts
+    """
+    selected = transforms.select(names)
+    ckan = client.from_config(config, rate=rate, workers=workers)
+    context = transforms.Context(ckan)
+    transforms.setup(context, selected)
+
+    types = transforms.types_for(selected)
+    store = None
+    if snapshot_path:
+        store = snapshot.Snapshot(snapshot_path)
+        store.sync(ckan, views=True)
+        context.view_index = store.view_index(quickcharts.VIEW_TYPE)
+        packages = shards.stored(store, shard, types)
+    else:
+        packages = shards.crawl(ckan, shard, types) # one crawl for all of the transforms
+
+    operation = "transforms:" + "+".join(transform.name for transform in selected)
+    result = executor.PatchExecutor(workers, journal=journal.open_journal(journal_path), operation=operation).run(
+        packages, functools.partial(transforms.process, context, selected)
+    )
+    if store is not None:
+        store.put_view_index(context.view_index) # the views we wrote, which the next sync wouldn't see
+    return result
+
+#
+# Invoke as a command-line script using the info in config.py
+#
+if __name__ == '__main__':
+    parser = shards.argument_parser("Run several patches over the UNHCR datasets in one crawl.")
+    parser.add_argument("--list", action="store_true", help="list the available transforms and exit")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="packages to process in parallel")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="starting API calls per second (adapts to the server)")
+    parser.add_argument("transforms", nargs="*", help="transforms to run (default: all)")
+    args = parser.parse_args()
+    if args.list:
+        for transform in transforms.TRANSFORMS.values():
+            print("{:16} {}".format(transform.name, transform.func.__doc__))
+    else:
+        from config import CONFIG
+        config = shards.shard_config(CONFIG, args.shard)
+        shards.finish(args, run_transforms(
+            config, args.transforms or None, args.rate, args.workers, config.get('snapshot'), config.get('journal'), args.shard
+        ))
@@ -0,0 +1,32 @@
+"""Serve the per-country slices of the UNHCR PopStats sources locally.
+
+Answers the HXL Proxy URLs used by the resources (/data.csv?url=...&
+filter01=select&...) from indexed in-memory copies of the sources,
+refreshed on a schedule.  Set 'proxy' in config.py to this server's
+address to point the resource URLs at it.
+
+Usage: python3 serve-slices.py [--port N] [--host ADDRESS] [--refresh SECONDS] [--offline]
+"""
+
+import argparse, logging, threading
+from popstats import slices, tables
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("serve-slices")
+"""Python logging object"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve HXL Proxy-compatible slices of the UNHCR PopStats sources.")
+    parser.add_argument("--port", type=int, default=slices.DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--host", default="", help="address to listen on (default: all)")
+    parser.add_argument("--refresh", type=float, default=slices.DEFAULT_REFRESH, help="seconds between source refreshes")
+    parser.add_argument("--offline", action="store_true", help="use the cached input tables or Inputs/ without checking the Google Sheet")
+    args = parser.parse_args()
+
+    countries, datasets, resources_by_category = tables.load(offline=args.offline)
+    server = slices.serve(resources_by_category, args.port, args.host, args.refresh)
+    logger.info("Serving slices at %s", server.url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
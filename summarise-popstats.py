@@ -0,0 +1,26 @@
+"""Compute per-country summary tables from the UNHCR PopStats sources.
+
+Loads each source (persons of concern, time series, asylum seekers and
+resettlement) once, totals every country x year x population type in one
+vectorised pass, and writes one summary file per country and category
+(e.g. unhcr_summary_residence_afg.csv).
+
+Usage: python3 summarise-popstats.py [--offline] OUTPUT_DIR
+"""
+
+import argparse, logging
+from popstats import summary, tables
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("summarise-popstats")
+"""Python logging object"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute per-country summary tables from the UNHCR PopStats sources.")
+    parser.add_argument("--offline", action="store_true", help="use the cached input tables or Inputs/ without checking the Google Sheet")
+    parser.add_argument("output_dir", help="directory for the summary files")
+    args = parser.parse_args()
+
+    countries, datasets, resources_by_category = tables.load(offline=args.offline)
+    counts = summary.summarise_all(args.output_dir, countries, resources_by_category)
+    logger.info("Wrote %d files (%d rows)", len(counts), sum(counts.values()))
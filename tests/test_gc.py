@@ -0,0 +1,61 @@
+"""Regression tests for popstats.gc, whose deletions can't be undone.
+
+Run from the repository root with: python3 -m unittest discover tests
+"""
+
+import unittest
+from popstats import gc, reconcile
+
+
+def desired_dataset(name, resource_names):
+    return reconcile.DesiredDataset(name, None, {}, {}, [{"name": resource_name} for resource_name in resource_names])
+
+
+def package(name, resource_names=(), package_id=None):
+    return {
+        "id": package_id or name + "-id",
+        "name": name,
+        "resources": [{"id": "{}-{}".format(name, n), "name": resource_name} for n, resource_name in enumerate(resource_names)],
+    }
+
+
+class FindGarbageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.desired = {
+            "unhcr-time-series-residing-afg": desired_dataset("unhcr-time-series-residing-afg", ["a.csv"]),
+        }
+
+    def deletions(self, packages):
+        return [(operation.action, operation.package, operation.target) for operation in gc.find_garbage(self.desired, packages)]
+
+    def test_unwanted_dataset_of_known_type_is_deleted(self):
+        self.assertEqual(
+            self.deletions([package("unhcr-time-series-residing-zzz")]),
+            [("package_delete", "unhcr-time-series-residing-zzz", None)]
+        )
+
+    def test_dataset_with_known_prefix_but_unknown_name_is_kept(self):
+        # package_search matches the name prefix, so these can come back from the crawl
+        self.assertEqual(self.deletions([
+            package("refugees-residing-syr-2019-archive"),
+            package("unhcr-time-series-residing-afg-copy"),
+            package("unhcr-time-series-residing-"),
+        ]), [])
+
+    def test_orphaned_and_duplicate_resources_are_deleted(self):
+        self.assertEqual(
+            self.deletions([package("unhcr-time-series-residing-afg", ["a.csv", "old.csv", "a.csv"])]),
+            [
+                ("resource_delete", "unhcr-time-series-residing-afg", "old.csv"),
+                ("resource_delete", "unhcr-time-series-residing-afg", "a.csv"),
+            ]
+        )
+
+    def test_empty_desired_state_is_refused(self):
+        with self.assertRaises(Exception):
+            gc.find_garbage({}, [package("unhcr-time-series-residing-afg")])
+
+
+if __name__ == '__main__':
+    unittest.main()